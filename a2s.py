@@ -0,0 +1,324 @@
+#!/usr/bin/python3
+
+# Valve server queries (A2S) over UDP, on the event loop.
+#
+# A2S_INFO (name, map, player counts), A2S_PLAYER (names, frags, time connected) and A2S_RULES
+# (server cvars, where mp_timeleft lives) are one datagram each way. Servers patched against
+# reflection attacks first answer with a challenge (S2C_CHALLENGE, 'A') that has to be echoed back;
+# A2SClient keeps the last challenge it got, so after the first query each one is a single round
+# trip, and keeps answers for a few seconds, so a burst of commands costs one query. GoldSrc
+# servers may answer INFO in either the Source format ('I') or the old GoldSrc one ('m'), and
+# split long RULES replies over several datagrams.
+
+import asyncio
+import struct
+import time
+
+HEADER = b"\xff\xff\xff\xff"
+SPLIT_HEADER = b"\xfe\xff\xff\xff"
+A2S_INFO = HEADER + b"TSource Engine Query\x00"
+A2S_PLAYER = HEADER + b"U"
+A2S_RULES = HEADER + b"V"
+NO_CHALLENGE = b"\xff\xff\xff\xff"
+S2C_CHALLENGE = ord("A")
+INFO_SOURCE = ord("I")
+INFO_GOLDSRC = ord("m")
+PLAYER_REPLY = ord("D")
+RULES_REPLY = ord("E")
+
+TIMEOUT = 1.0
+CACHE_TTL = 5.0
+
+
+class QueryError(Exception):
+    pass
+
+
+class _Reader:
+    def __init__(self, data, offset=0):
+        self.data = data
+        self.offset = offset
+
+    def byte(self):
+        value = self.data[self.offset]
+        self.offset += 1
+        return value
+
+    def _unpack(self, fmt):
+        (value,) = struct.unpack_from(fmt, self.data, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return value
+
+    def short(self):
+        return self._unpack("<h")
+
+    def long(self):
+        return self._unpack("<l")
+
+    def float(self):
+        return self._unpack("<f")
+
+    def string(self):
+        end = self.data.index(b"\x00", self.offset)
+        value = self.data[self.offset:end].decode("utf-8", "replace")
+        self.offset = end + 1
+        return value
+
+
+def _reader(data, kinds):
+    if not data.startswith(HEADER) or len(data) < 5:
+        raise QueryError("not an A2S reply")
+    r = _Reader(data, len(HEADER))
+    kind = r.byte()
+    if kind not in kinds:
+        raise QueryError("unexpected A2S reply type %r" % chr(kind))
+    return r, kind
+
+
+def parse_info(data):
+    """{name, map, folder, game, players, maxPlayers, bots} from an A2S_INFO reply (header included)."""
+    r, kind = _reader(data, (INFO_SOURCE, INFO_GOLDSRC))
+    try:
+        if kind == INFO_SOURCE:
+            r.byte()  # protocol
+            name, mapName, folder, game = r.string(), r.string(), r.string(), r.string()
+            r.short()  # steam app id
+            players, maxPlayers, bots = r.byte(), r.byte(), r.byte()
+        else:
+            r.string()  # address
+            name, mapName, folder, game = r.string(), r.string(), r.string(), r.string()
+            players, maxPlayers = r.byte(), r.byte()
+            bots = 0
+    except (IndexError, ValueError, struct.error) as e:
+        raise QueryError("truncated A2S_INFO reply") from e
+    return {
+        "name": name,
+        "map": mapName,
+        "folder": folder,
+        "game": game,
+        "players": players,
+        "maxPlayers": maxPlayers,
+        "bots": bots,
+    }
+
+
+def parse_players(data):
+    """[{name, score, seconds}] from an A2S_PLAYER reply; connecting players (no name yet) are left out."""
+    r, _ = _reader(data, (PLAYER_REPLY,))
+    players = []
+    try:
+        for _ in range(r.byte()):
+            r.byte()  # index, always 0 on most servers
+            name, score, seconds = r.string(), r.long(), r.float()
+            if name:
+                players.append({"name": name, "score": score, "seconds": seconds})
+    except (IndexError, ValueError, struct.error) as e:
+        raise QueryError("truncated A2S_PLAYER reply") from e
+    return players
+
+
+def parse_rules(data):
+    """{cvar: value} from an A2S_RULES reply."""
+    r, _ = _reader(data, (RULES_REPLY,))
+    rules = {}
+    try:
+        for _ in range(r.short()):
+            name = r.string()
+            rules[name] = r.string()
+    except (IndexError, ValueError, struct.error) as e:
+        raise QueryError("truncated A2S_RULES reply") from e
+    return rules
+
+
+class _QueryProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.replies = asyncio.Queue()
+        self._parts = {}  # split reply id -> {index: payload}
+
+    def datagram_received(self, data, addr):
+        if not data.startswith(SPLIT_HEADER):
+            self.replies.put_nowait(data)
+            return
+        # GoldSrc split reply: id (long), then a byte with this part's index (high nibble) and the
+        # number of parts (low nibble); the parts joined are a normal reply
+        if len(data) < 9:
+            return
+        splitId = data[4:8]
+        total, index = data[8] & 0x0F, data[8] >> 4
+        parts = self._parts.setdefault(splitId, {})
+        parts[index] = data[9:]
+        if len(parts) == total:
+            del self._parts[splitId]
+            self.replies.put_nowait(b"".join(parts[idx] for idx in range(total)))
+
+    def error_received(self, exc):
+        # e.g. ICMP port unreachable: nothing is listening, no point waiting out the timeout
+        self.replies.put_nowait(exc)
+
+
+async def query(host, port, request, challenge=b"", timeout=TIMEOUT):
+    """Send request + challenge, answering a challenge if the server asks for one. Returns
+    (reply, seconds, challenge): the round trip of the exchange that got the answer, and the
+    challenge to use next time. Raises QueryError."""
+    loop = asyncio.get_running_loop()
+    try:
+        transport, protocol = await loop.create_datagram_endpoint(_QueryProtocol, remote_addr=(host, port))
+    except OSError as e:
+        raise QueryError(str(e)) from e
+    deadline = time.monotonic() + timeout
+    try:
+        for _ in range(3):  # a server may hand out a fresh challenge once more; don't loop forever
+            sent = time.perf_counter()
+            transport.sendto(request + challenge)
+            reply = await asyncio.wait_for(protocol.replies.get(), max(deadline - time.monotonic(), 0))
+            if isinstance(reply, Exception):
+                raise QueryError(str(reply))
+            rtt = time.perf_counter() - sent
+            if len(reply) >= 9 and reply.startswith(HEADER) and reply[4] == S2C_CHALLENGE:
+                challenge = reply[5:9]
+                continue
+            return reply, rtt, challenge
+        raise QueryError("server kept sending challenges")
+    except asyncio.TimeoutError:
+        raise QueryError("no reply within %gs" % timeout) from None
+    finally:
+        transport.close()
+
+
+class A2SClient:
+    def __init__(self, host, port, ttl=CACHE_TTL, timeout=TIMEOUT):
+        self.host = host
+        self.port = port
+        self.ttl = ttl
+        self.timeout = timeout
+        self.queries = 0
+        self.hits = 0
+        self._challenges = {}  # request -> last challenge the server gave us for it
+        self._cache = {}  # request -> (monotonic time, parsed reply)
+        self._inflight = {}  # request -> future, so concurrent callers share one query
+
+    async def _get(self, request, firstChallenge, parse, fresh):
+        cached = self._cache.get(request)
+        if not fresh and cached is not None and time.monotonic() - cached[0] < self.ttl:
+            self.hits += 1
+            return cached[1]
+        if request in self._inflight:
+            self.hits += 1
+            return await asyncio.shield(self._inflight[request])
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[request] = future
+        try:
+            self.queries += 1
+            reply, rtt, challenge = await query(
+                self.host, self.port, request, self._challenges.get(request, firstChallenge), self.timeout
+            )
+            self._challenges[request] = challenge
+            result = parse(reply)
+            if isinstance(result, dict):
+                result["latency"] = rtt
+            self._cache[request] = (time.monotonic(), result)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # retrieved here, so a future nobody else awaited doesn't warn
+            raise
+        finally:
+            del self._inflight[request]
+
+    async def info(self, fresh=False):
+        """A2S_INFO, plus the round trip in seconds ("latency"). Raises QueryError."""
+        return await self._get(A2S_INFO, b"", parse_info, fresh)
+
+    async def players(self, fresh=False):
+        return await self._get(A2S_PLAYER, NO_CHALLENGE, parse_players, fresh)
+
+    async def rules(self, fresh=False):
+        return await self._get(A2S_RULES, NO_CHALLENGE, parse_rules, fresh)
+
+    async def timeleft(self, fresh=False):
+        """Seconds left on the map from mp_timeleft, or None if the server doesn't report it."""
+        value = (await self.rules(fresh)).get("mp_timeleft")
+        try:
+            return int(float(value)) if value is not None else None
+        except ValueError:
+            return None
+
+
+if __name__ == "__main__":
+    # A local stand-in server speaking A2S: challenges every query type, splits RULES over three
+    # datagrams and answers after a simulated 20 ms. Shows round trips for a cold query, a warm one
+    # (challenge known) and a cached one.
+    class StandIn(asyncio.DatagramProtocol):
+        CHALLENGE = b"\x10\x20\x30\x40"
+        DELAY = 0.02
+
+        def __init__(self):
+            self.received = 0
+
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def datagram_received(self, data, addr):
+            self.received += 1
+            if data.startswith(A2S_INFO):
+                challenge = data[len(A2S_INFO):]
+                reply = HEADER + b"I\x30Stand-in\x002fort\x00tfc\x00TFC\x00" + struct.pack("<h", 20) + bytes((8, 24, 0))
+            elif data.startswith(A2S_PLAYER):
+                challenge, reply = data[5:], HEADER + b"D" + bytes((2,))
+                for name, score, seconds in (("alice", 12, 600.5), ("bob", 7, 420.0)):
+                    reply += b"\x00" + name.encode() + b"\x00" + struct.pack("<lf", score, seconds)
+            elif data.startswith(A2S_RULES):
+                challenge = data[5:]
+                rules = {"mp_timeleft": "754", "mp_timelimit": "30"}
+                rules.update({"cvar%03d" % idx: "x" * 20 for idx in range(60)})  # long enough to split
+                reply = HEADER + b"E" + struct.pack("<h", len(rules))
+                reply += b"".join(k.encode() + b"\x00" + v.encode() + b"\x00" for k, v in rules.items())
+            else:
+                return
+
+            if challenge != self.CHALLENGE:
+                self.send(HEADER + b"A" + self.CHALLENGE, addr)
+            elif data.startswith(A2S_RULES):
+                size = -(-len(reply) // 3)
+                for idx in range(3):
+                    part = reply[idx * size:(idx + 1) * size]
+                    self.send(SPLIT_HEADER + b"\x01\x00\x00\x00" + bytes(((idx << 4) | 3,)) + part, addr)
+            else:
+                self.send(reply, addr)
+
+        def send(self, data, addr):
+            asyncio.get_running_loop().call_later(self.DELAY, self.transport.sendto, data, addr)
+
+    async def main():
+        transport, standIn = await asyncio.get_running_loop().create_datagram_endpoint(
+            StandIn, local_addr=("127.0.0.1", 0)
+        )
+        client = A2SClient("127.0.0.1", transport.get_extra_info("sockname")[1])
+
+        for label, fresh in (("cold", True), ("warm", True), ("cached", False)):
+            before = standIn.received
+            start = time.perf_counter()
+            info, players, timeleft = await asyncio.gather(
+                client.info(fresh), client.players(fresh), client.timeleft(fresh)
+            )
+            print(
+                "%-6s %5.1f ms, %d datagrams sent: %s on %s, %d/%d players %s, %d:%02d left"
+                % (
+                    label,
+                    (time.perf_counter() - start) * 1000,
+                    standIn.received - before,
+                    info["name"],
+                    info["map"],
+                    info["players"],
+                    info["maxPlayers"],
+                    [p["name"] for p in players],
+                    timeleft // 60,
+                    timeleft % 60,
+                )
+            )
+        print("%d queries, %d answered from the cache" % (client.queries, client.hits))
+        transport.close()
+
+    asyncio.run(main())
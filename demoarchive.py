@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+
+# On-disk archive of HLTV demo zips, one per match, and the logic for getting them to Discord.
+#
+# Discord rejects attachments over the guild's upload limit, so before sending we pick the
+# cheapest way that fits: the zip as-is, the zip recompressed harder, the zip split into numbered
+# volumes (demo.zip.001, .002, ... which 7-Zip opens directly), or a link to the archive served by
+# a small HTTP endpoint. The archive is pruned by total size and age.
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+
+ARCHIVE_DIR = "demos"
+INDEX_FILE = "index.json"
+MAX_ARCHIVE_BYTES = 5 * 1024 * 1024 * 1024
+MAX_AGE_DAYS = 30
+MAX_PARTS = 4
+DEMO_ZIP_RATIO = 0.5  # demos deflate to roughly half; only used to plan before downloading
+PART_MARGIN = 64 * 1024  # stay a little under the limit for the multipart overhead
+
+
+class DemoArchive:
+    def __init__(self, root=ARCHIVE_DIR, maxBytes=MAX_ARCHIVE_BYTES, maxAgeDays=MAX_AGE_DAYS, baseUrl=None):
+        self.root = root
+        self.maxBytes = maxBytes
+        self.maxAge = maxAgeDays * 24 * 60 * 60
+        self.baseUrl = baseUrl.rstrip("/") if baseUrl else None
+        os.makedirs(root, exist_ok=True)
+        self.index = self._load_index()
+        # building and sending run in worker threads, the stats job's and !hltv's at the same time
+        self._lock = threading.RLock()
+
+    # ---- index / retention ----
+
+    def _load_index(self):
+        path = os.path.join(self.root, INDEX_FILE)
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            logging.warning("demo archive index unreadable, starting a new one")
+            return {}
+
+    def _save_index(self):
+        path = os.path.join(self.root, INDEX_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(path + ".tmp", path)
+
+    def prune(self):
+        with self._lock:
+            self._prune()
+
+    def _prune(self):
+        now = time.time()
+        entries = sorted(self.index.items(), key=lambda item: item[1]["created"])
+        total = sum(entry["size"] for _, entry in entries)
+        for key, entry in entries:
+            if total <= self.maxBytes and now - entry["created"] <= self.maxAge:
+                continue
+            path = os.path.join(self.root, entry["zip"])
+            if os.path.exists(path):
+                os.remove(path)
+            total -= entry["size"]
+            del self.index[key]
+            logging.info("pruned demo archive entry %s" % key)
+        self._save_index()
+
+    def path(self, key):
+        entry = self.index.get(str(key))
+        return os.path.join(self.root, entry["zip"]) if entry else None
+
+    def url(self, key):
+        entry = self.index.get(str(key))
+        if entry is None or self.baseUrl is None:
+            return None
+        return "%s/%s" % (self.baseUrl, entry["zip"])
+
+    # ---- building ----
+
+    def add(self, key, demoPaths, name, level=6):
+        """Zip the demos into the archive under key (the match id); returns the zip path."""
+        zipName = name if name.endswith(".zip") else name + ".zip"
+        zipPath = os.path.join(self.root, zipName)
+        with self._lock:
+            with zipfile.ZipFile(zipPath, "w", zipfile.ZIP_DEFLATED, compresslevel=level) as zf:
+                for demoPath in demoPaths:
+                    zf.write(demoPath, os.path.basename(demoPath))
+            return self._store(key, zipName)
+
+    def adopt(self, key, zipPath, name):
+        """Move an already built zip (e.g. zipped on the game server) into the archive under key."""
+        zipName = name if name.endswith(".zip") else name + ".zip"
+        with self._lock:
+            shutil.move(zipPath, os.path.join(self.root, zipName))
+            return self._store(key, zipName)
+
+    def _store(self, key, zipName):
+        zipPath = os.path.join(self.root, zipName)
+        previous = self.index.get(str(key))
+        if previous is not None and previous["zip"] != zipName:
+            oldPath = os.path.join(self.root, previous["zip"])
+            if os.path.exists(oldPath):
+                os.remove(oldPath)
+
+        self.index[str(key)] = {"zip": zipName, "created": time.time(), "size": os.path.getsize(zipPath)}
+        self._prune()
+        return zipPath
+
+    def _recompress(self, key, level):
+        zipPath = self.path(key)
+        tmpPath = zipPath + ".tmp"
+        with zipfile.ZipFile(zipPath) as src, zipfile.ZipFile(
+            tmpPath, "w", zipfile.ZIP_DEFLATED, compresslevel=level
+        ) as dst:
+            for info in src.infolist():
+                with src.open(info) as data, dst.open(info.filename, "w") as out:
+                    shutil.copyfileobj(data, out, 1024 * 1024)
+        os.replace(tmpPath, zipPath)
+        self.index[str(key)]["size"] = os.path.getsize(zipPath)
+        self._save_index()
+
+    def _split(self, key, partSize):
+        zipPath = self.path(key)
+        os.makedirs(os.path.join(self.root, "parts"), exist_ok=True)
+        # a directory per send, so two sends of the same zip don't overwrite or delete each other's parts
+        partDir = tempfile.mkdtemp(dir=os.path.join(self.root, "parts"))
+        parts = []
+        with open(zipPath, "rb") as f:
+            while True:
+                chunk = f.read(partSize)
+                if not chunk:
+                    break
+                partPath = os.path.join(partDir, "%s.%03d" % (os.path.basename(zipPath), len(parts) + 1))
+                with open(partPath, "wb") as out:
+                    out.write(chunk)
+                parts.append(partPath)
+        return parts
+
+    # ---- delivery ----
+
+    def can_deliver(self, estimatedBytes, limit):
+        """Whether a zip of about this size could be delivered at all; checked before downloading."""
+        return self.baseUrl is not None or estimatedBytes <= limit * MAX_PARTS
+
+    def estimate_zip_size(self, demoSizes):
+        return int(sum(demoSizes) * DEMO_ZIP_RATIO)
+
+    def plan(self, key, limit):
+        """How to send match key's zip: ("files", [paths]) to attach (one message each),
+        ("link", url), or ("toolarge", None). Split volumes are temporary; see cleanup_parts."""
+        with self._lock:
+            return self._plan(key, limit)
+
+    def _plan(self, key, limit):
+        zipPath = self.path(key)
+        size = os.path.getsize(zipPath)
+        if size <= limit:
+            return "files", [zipPath]
+
+        if size <= limit * 1.05:
+            # close enough that maximum compression may get it under
+            self._recompress(key, 9)
+            size = os.path.getsize(zipPath)
+            if size <= limit:
+                return "files", [zipPath]
+
+        partSize = limit - min(PART_MARGIN, limit // 10)
+        if -(-size // partSize) <= MAX_PARTS:
+            return "files", self._split(key, partSize)
+
+        if self.baseUrl is not None:
+            return "link", self.url(key)
+        return "toolarge", None
+
+    def cleanup_parts(self, paths):
+        partsRoot = os.path.join(self.root, "parts")
+        for partDir in {os.path.dirname(path) for path in paths}:
+            if os.path.dirname(partDir) == partsRoot:
+                shutil.rmtree(partDir, ignore_errors=True)
+
+    # ---- HTTP ----
+
+    async def serve(self, port):
+        """Serve the archived zips read-only; returns the aiohttp runner. Only zips in the index are
+        served: not the index itself, split volumes, or a zip still being written."""
+        from aiohttp import web
+
+        async def handle(request):
+            name = request.match_info["name"]
+            zipNames = {entry["zip"] for entry in self.index.values()}
+            path = os.path.join(self.root, name)
+            if name not in zipNames or not os.path.isfile(path):
+                raise web.HTTPNotFound()
+            return web.FileResponse(path)
+
+        app = web.Application()
+        app.router.add_get("/{name}", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "0.0.0.0", port).start()
+        logging.info("serving demo archive on port %d" % port)
+        return runner
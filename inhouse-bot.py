@@ -1,25 +1,52 @@
 #!/usr/bin/python3
 
+import time
+
+STARTED = time.perf_counter()  # for the time-to-ready report
+
+# paramiko (SSH), ftplib and urllib.request are imported where they're used: paramiko's crypto
+# imports alone are a good part of startup, and most restarts never need them
 import asyncio
 import datetime
 import discord
+import functools
 import json
 import os
-import paramiko
 import random
 import re
+import shutil
+import signal
 import socket
-import urllib.request
-from ftplib import FTP
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from collections import deque
 from dotenv import load_dotenv
 from discord.ext import commands
 from discord.ext import tasks
-import zipfile
 import logging
 import traceback
 
+import a2s
+import demoarchive
+import logparser
+import logtail
+import loopwatch
+import mappool
+import mapselect
+import metrics
+import prefetch
+import rcon
+import roundpick
+import servers
+import statspipeline
+import storage
+import timers
+import wire
+import transfer
+import matchhistory
+import ratings
+import snapshot
+
 logging.basicConfig(
     format="%(asctime)s %(levelname)-8s %(message)s",
     level=logging.INFO,
@@ -45,41 +72,160 @@ SERVER_PASSWORD = os.getenv("SERVER_PASSWORD")
 CLIENT_PORT = os.getenv(
     "CLIENT_PORT"
 )  # port to communicate with client plugin listener (serverComms.py)
+BOT_PORT = int(
+    os.getenv("BOT_PORT", "16534")
+)  # port serverComms.py forwards server events (END) to
+STATS_CHANNEL_ID = 1249752385476235376
+LOG_SETTLE_SECONDS = 30  # the pickup's round 2 log must stop growing this long before we fetch it
+DEMO_HTTP_PORT = os.getenv("DEMO_HTTP_PORT")  # serve the demo archive over HTTP when set
+DEMO_BASE_URL = os.getenv("DEMO_BASE_URL")  # public URL of that endpoint, for links
+DEMO_REMOTE_ZIP = bool(
+    os.getenv("DEMO_REMOTE_ZIP")
+)  # zip demos on the game server and download the zip instead of the raw demos
+
+METRICS_PORT = os.getenv("METRICS_PORT")  # Prometheus /metrics endpoint, when set
+
+# latency/API/loop-lag metrics; off (and nearly free) unless METRICS or METRICS_PORT is set
+perfMetrics = metrics.Metrics(enabled=bool(os.getenv("METRICS") or METRICS_PORT))
+
+# where the game server keeps its logs and demos (hardcoding directory, sorry)
+LOG_DIR = "/root/.steam/steamcmd/tfc/tfc/logs"
+HLTV_DIR = "/root/.steam/steamcmd/tfc/tfc/HLTV"
+FTP_DIRS = {"logs": "/logs", "hltv": "/HLTV"}  # the FTP account is rooted at the tfc directory
+LOCAL_GAME_DIR = os.getenv("LOCAL_GAME_DIR", "/root/.steam/steamcmd/tfc/tfc")  # when on the game server
+STORAGE = os.getenv("STORAGE", "sftp,ftp")  # backends to read game files with, in order of preference
+
+# map vote automation; 0 turns each off
+VOTE_REMIND_SECONDS = int(os.getenv("VOTE_REMIND_SECONDS", "60"))  # ping whoever hasn't voted yet
+VOTE_DEADLINE_SECONDS = int(os.getenv("VOTE_DEADLINE_SECONDS", "300"))  # lock whatever is leading
+VOTE_AUTOLOCK = os.getenv("VOTE_AUTOLOCK", "1") != "0"  # lock once everyone voted or the leader can't be caught
+
+
+@client.before_invoke
+async def StartCommandTimer(ctx):
+    ctx.perfStart = time.perf_counter()
+
+
+@client.after_invoke
+async def StopCommandTimer(ctx):
+    # runs after failed commands too
+    start = getattr(ctx, "perfStart", None)
+    if start is not None:
+        perfMetrics.observe("command_seconds", time.perf_counter() - start, command=ctx.command.qualified_name)
 
 
 @client.event
 async def on_command_error(ctx, error):
+    perfMetrics.inc("command_errors_total", command=ctx.command.qualified_name if ctx.command else "unknown")
     if isinstance(error, commands.CommandOnCooldown):
         await ctx.send("This command is on a %.2fs cooldown" % error.retry_after)
     raise error  # re-raise the error so all the errors will still show up in console
 
 
-def hltv_file_handler(ssh_client):
+def ConnectSSH(server):
+    import paramiko
+
+    ssh_client = paramiko.SSHClient()
+    ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh_client.connect(
+        hostname=server.fileHost,
+        port=22,
+        username=server.fileUser,
+        password=server.filePassword,
+    )
+    return ssh_client
+
+
+def LastMatchServer():
+    # where the last pickup was played; older matches (and removed servers) fall back to the default
+    match = matchHistory.last_match()
+    server = serverRegistry.get(match["server"]) if match is not None else None
+    return server if server is not None else serverRegistry.default
+
+
+def LastMatchMap():
+    match = matchHistory.last_match()
+    return match["map"] if match is not None else None
+
+
+def LastMatchId():
+    match = matchHistory.last_match()
+    return match["id"] if match is not None else None
+
+
+def OpenSFTP(server, features=None):
+    return storage.SFTPBackend(functools.partial(ConnectSSH, server), {"logs": LOG_DIR, "hltv": HLTV_DIR})
+
+
+def OpenFTP(server, features=None):
+    return storage.FTPBackend(server.fileHost, server.fileUser, server.filePassword, FTP_DIRS, features)
+
+
+def OpenLocal(server, features=None):
+    # only makes sense for the server the bot runs on
+    return storage.LocalBackend(
+        {"logs": os.path.join(LOCAL_GAME_DIR, "logs"), "hltv": os.path.join(LOCAL_GAME_DIR, "HLTV")}
+    )
+
+
+def ServerFiles(server):
+    # a pool of connections to the server's files, over the first backend that works
+    backends = {"sftp": OpenSFTP, "ftp": OpenFTP, "local": OpenLocal}
+    return storage.BackendPool(
+        storage.GameStorage(
+            [(kind, functools.partial(backends[kind], server)) for kind in server.storage if kind in backends]
+        )
+    )
+
+
+def DefaultServer():
+    # the one server described by .env; servers.json replaces it with a list
+    return servers.GameServer(
+        "main",
+        SERVER_IP,
+        password=SERVER_PASSWORD,
+        pluginPort=int(SERVER_PORT) if SERVER_PORT else None,
+        joinUrl="https://tinyurl.com/etfcvultr",
+        vultrId=os.getenv("VULTR_INSTANCE_ID", "4ba36623-81ab-4b99-815b-922598d0b8a8"),
+        fileHost=os.getenv("FTP_SERVER"),
+        fileUser=os.getenv("FTP_USER"),
+        filePassword=os.getenv("FTP_PASSWD"),
+        storage=[kind.strip() for kind in STORAGE.split(",")],
+        rconPassword=os.getenv("RCON_PASSWORD"),
+    )
+
+
+def find_round_logs(store, expectedMap=None):
+    # (round1, round2) LogInfo for the last pickup, read from the log headers/tails on the server
+    store.chdir(store.dirs["logs"])
+    with perfMetrics.timer("op_seconds", op="find_round_logs", storage=store.kind):
+        return roundpick.find_round_logs(store, expectedMap)
+
+
+def hltv_file_handler(store, rounds=None, expectedMap=None, limit=None, matchKey=None):
+    # Returns the demo archive key of the zipped demos, or None. !hltv and the stats job's hltv stage
+    # both run this in a worker thread and download into the working directory, so one at a time;
+    # the second one for a match finds the first one's zip in the archive.
+    with hltvLock:
+        return fetch_hltv_demos(store, rounds, expectedMap, limit, matchKey)
+
+
+def fetch_hltv_demos(store, rounds, expectedMap, limit, matchKey):
     try:
-        ftp = ssh_client.open_sftp()
+        if rounds is None:
+            rounds = find_round_logs(store, expectedMap)
+
         output_filename = None
-        ftp.chdir("/root/.steam/steamcmd/tfc/tfc/HLTV")
-        # getting lists
-
-        HLTVListNameDesc = list(
-            reversed(sorted(ftp.listdir()))
-        )  # Reverse the list of logs so it's in descending order
-        lastTwoBigHLTVList = []
-        for HLTVFile in HLTVListNameDesc:
-            size = int(ftp.stat(HLTVFile).st_size)
-            # Do a simple heuristic check to see if this is a "real" round.  TODO: maybe use a smarter heuristic
-            # if we find any edge cases.
-            if (size > 11000000) and (
-                ".dem" in HLTVFile
-            ):  # Rounds with logs of players and time will be big
-                print("passed heuristic!")
-                lastTwoBigHLTVList.append(HLTVFile)
-                if len(lastTwoBigHLTVList) >= 2:
-                    break
-
-        if len(lastTwoBigHLTVList) >= 2:
-            HLTVToZip1 = lastTwoBigHLTVList[1]
-            HLTVToZip2 = lastTwoBigHLTVList[0]
+        hltvDir = store.dirs["hltv"]
+        store.chdir(hltvDir)
+
+        # pick the demos recorded alongside the two round logs
+        demos = roundpick.find_round_demos(store, rounds) if rounds is not None else None
+        if demos is None:
+            print("Could not find demos for the last pickup")
+
+        if demos is not None:
+            HLTVToZip1, HLTVToZip2 = demos
 
             # zip file stuff.. get rid of slashes so we dont error.
             split_filename = HLTVToZip1.split("-")
@@ -87,17 +233,59 @@ def hltv_file_handler(ssh_client):
                 1
             ]  # Just use the time of the first round, it's good enough
             pickup_map = split_filename[2].replace(".dem", "")
-            ftp.get(HLTVToZip1, HLTVToZip1)
-            ftp.get(HLTVToZip2, HLTVToZip2)
-            mode = zipfile.ZIP_DEFLATED
-            output_filename = pickup_map + "-" + pickup_date + ".zip"
-            zip = zipfile.ZipFile(output_filename, "w", mode)
-            zip.write(HLTVToZip1)
-            zip.write(HLTVToZip2)
-            zip.close()
-            ftp.close()
-            os.remove(HLTVToZip1)
-            os.remove(HLTVToZip2)
+
+            output_filename = pickup_map + "-" + pickup_date
+            matchKey = matchKey if matchKey is not None else output_filename
+            archived = demoArchive.path(matchKey)
+            sameDemos = archived is not None and os.path.basename(archived) == output_filename + ".zip"
+            if sameDemos and os.path.exists(archived):
+                print("demos for %s are already archived" % matchKey)
+                return str(matchKey)
+
+            attrs = {HLTVFile: store.stat(HLTVFile) for HLTVFile in demos}
+            sizes = {HLTVFile: a.st_size for HLTVFile, a in attrs.items()}
+            cached = [
+                prefetcher.cached("hltv", HLTVFile, a.st_size, a.st_mtime) for HLTVFile, a in attrs.items()
+            ]
+
+            # don't spend minutes downloading something we have no way of delivering
+            if limit is not None:
+                if not demoArchive.can_deliver(demoArchive.estimate_zip_size(sizes.values()), limit):
+                    print("demos too large for the upload limit and no HTTP archive; not downloading")
+                    return None
+
+            zipped = False
+            if None not in cached:
+                print("using prefetched demos")
+                with perfMetrics.timer("op_seconds", op="zip_demos"):
+                    demoArchive.add(matchKey, cached, output_filename)
+                zipped = True
+
+            if DEMO_REMOTE_ZIP and "exec" in store.features and not zipped:
+                # about half the bytes on the wire, but no resume; on any failure download the raw demos
+                try:
+                    with perfMetrics.timer("op_seconds", op="remote_zip"):
+                        stats = transfer.fetch_remote_zip(
+                            store.ssh, hltvDir, demos, output_filename + ".zip", sizes
+                        )
+                    perfMetrics.inc("download_bytes_total", stats["bytes"], kind="remote_zip")
+                    print("downloaded server-side zip: %s" % stats)
+                    demoArchive.adopt(matchKey, output_filename + ".zip", output_filename)
+                    zipped = True
+                except Exception as e:
+                    logging.warning("server-side zip failed, downloading the raw demos: %s" % e)
+
+            if not zipped:
+                for HLTVFile in (HLTVToZip1, HLTVToZip2):
+                    with perfMetrics.timer("op_seconds", op="download_demo", storage=store.kind):
+                        stats = store.get(hltvDir + "/" + HLTVFile, HLTVFile)
+                    perfMetrics.inc("download_bytes_total", stats["bytes"], kind="demo")
+                    print("downloaded %s: %s" % (HLTVFile, stats))
+                with perfMetrics.timer("op_seconds", op="zip_demos"):
+                    demoArchive.add(matchKey, [HLTVToZip1, HLTVToZip2], output_filename)
+                os.remove(HLTVToZip1)
+                os.remove(HLTVToZip2)
+            output_filename = str(matchKey)
         return output_filename
     except Exception as e:
         logging.warning(traceback.format_exc())
@@ -105,57 +293,28 @@ def hltv_file_handler(ssh_client):
         return None
 
 
-def hampalyze_logs_sftp(ssh_client):
-    ftp = ssh_client.open_sftp()
-    # hardcoding directory, sorry
-    ftp.chdir(
-        "/root/.steam/steamcmd/tfc/tfc/logs"
-    )  # Navigate to the logs subfolder
-
-    # Get the list of files in the logs folder
-    logFiles = list(
-        reversed(sorted(ftp.listdir()))
-    )  # Reverse the list of logs so it's in descending order
-    firstLog = None
-    secondLog = None
-    round1log = None  # Redundant, workaround for my own inadequacies
-    round2log = None  # Redundant, workaround for my own inadequacies
-
-    for logFile in logFiles:  # Just check the last few logs
-        if ".log" not in logFile:
-            continue
-        # Log files from 4v4 games are generally over 100k bytes
-        if (
-            int(ftp.stat(logFile).st_size) > 50000
-        ):  # Log files from 2v2 games may be more like 70k
-            # Check the current file's modified time based on the unix modified timestamp
-            logModified = datetime.datetime.fromtimestamp(ftp.stat(logFile).st_mtime)
-            if firstLog is None:
-                print(logFile + " is set to round2log")
-                round2log = logFile
-                firstLog = (logFile, logModified)
-                continue
-
-            # otherwise, verify that there was another round played at least <60 minutes within the last found log
-            if (firstLog[1] - logModified).total_seconds() < 3600:
-                round1log = logFile
-                print(logFile + " is set to round1log")
-                secondLog = (logFile, logModified)
-
-            # if secondLog is not populated, this is probably the first pickup of the day; abort
-            break
-
-    # Abort if we didn't find two logs
-    if firstLog is None or secondLog is None:
-        print("Could not find a log")
-        return
+def fetch_round_logs(store, rounds):
+    round1log = rounds[0].name
+    round2log = rounds[1].name
+    print(round2log + " is set to round2log")
+    print(round1log + " is set to round1log")
 
-    # Retrieve first log file (most recent; round 2)
-    ftp.get(round2log, round2log)
+    # Retrieve first log file (most recent; round 2), then the second (round 1); the
+    # prefetcher has usually copied them already
+    for info in (rounds[1], rounds[0]):
+        cached = prefetcher.cached("logs", info.name, info.size, info.mtime)
+        if cached is not None:
+            shutil.copyfile(cached, info.name)
+        else:
+            with perfMetrics.timer("op_seconds", op="download_log", storage=store.kind):
+                store.get(store.dirs["logs"] + "/" + info.name, info.name)
+    return round1log, round2log
 
-    # Retrieve second log file (round 1)
-    ftp.get(round1log, round1log)
-    ftp.close()
+
+def hampalyze_round_logs(round1log, round2log):
+    # Work out our own stats first so there's something to post even if tfcstats is down
+    with perfMetrics.timer("op_seconds", op="parse_logs"):
+        summary = logparser.format_summary(logparser.parse_logs([round1log, round2log]))
 
     # Send the retrieved log files to hampalyzer
     hampalyze = (
@@ -163,129 +322,76 @@ def hampalyze_logs_sftp(ssh_client):
         % (round1log, round2log)
     )
     # Capture the result
-    output = os.popen(hampalyze).read()
+    with perfMetrics.timer("op_seconds", op="hampalyzer_upload"):
+        output = os.popen(hampalyze).read()
     print(output)
 
     # Check if it worked or not
-    status = json.loads(output)
+    site = None
+    try:
+        status = json.loads(output)
+    except ValueError:
+        status = {}
     if "success" in status:
         site = status["success"]["path"]
         print("Parsed logs available: %s" % site)
-        # not using json stuff currently
-        # with open('prevlog.json', 'w') as f:
-        #     prevlog = { 'site': site, 'logFiles': [ firstLog[0], secondLog[0] ] }
-        #     json.dump(prevlog, f)
-        os.remove(round2log)
-        os.remove(round1log)
     else:
         print("error parsing logs: %s" % output)
-    return site  # Give the hampalyzer link
-
-
-def hampalyze_logs():
-    # Connect to FTP using info from .env file
-    ftp = FTP()
-    ftp.connect(os.getenv("FTP_SERVER"), 21)
-    ftp.login(os.getenv("FTP_USER"), os.getenv("FTP_PASSWD"))
-    ftp.cwd("/logs")  # Navigate to the logs subfolder
-
-    # Get the list of files in the logs folder
-    logFiles = list(
-        reversed(ftp.nlst())
-    )  # Reverse the list of logs so it's in descending order
-    firstLog = None
-    secondLog = None
-    round1log = None  # Redundant, workaround for my own inadequacies
-    round2log = None  # Redundant, workaround for my own inadequacies
-
-    for logFile in logFiles[:300]:  # Just check the last few logs
-        if ".log" not in logFile:
-            continue
-
-        # not using json stuff currently
-        # if 'logFiles' in prevlog and logFile in prevlog['logFiles']:
-        #     print("already parsed the latest log")
-        #     return
-
-        # Log files from 4v4 games are generally over 100k bytes
-        if (
-            int(ftp.size(logFile)) > 50000
-        ):  # Log files from 2v2 games may be more like 70k
-            # Hamp's inhouse bot does this and I don't fully understand it but it works like magic - thanks hamp!
-            logModified = datetime.datetime.strptime(
-                ftp.voidcmd("MDTM %s" % logFile).split()[-1], "%Y%m%d%H%M%S"
-            )
-            if firstLog is None:
-                print(logFile + " is set to round2log")
-                round2log = logFile
-                firstLog = (logFile, logModified)
-                continue
-
-            # otherwise, verify that there was another round played at least <60 minutes within the last found log
-            if (firstLog[1] - logModified).total_seconds() < 3600:
-                round1log = logFile
-                print(logFile + " is set to round1log")
-                secondLog = (logFile, logModified)
-
-            # if secondLog is not populated, this is probably the first pickup of the day; abort
-            break
-
-    # Abort if we didn't find two logs
-    if firstLog is None or secondLog is None:
-        print("Could not find a log")
-        return
+    os.remove(round2log)
+    os.remove(round1log)
+    return site, summary  # Give the hampalyzer link and our own summary
 
-    # Retrieve first log file (most recent; round 2)
-    # ftp.retrbinary("RETR %s" % round2log, open('logs/%s' % round2log, 'wb').write) # Not sure why this doesn't work
-    with open(round2log, "wb") as fp:  # Workaround
-        print("Downloading " + round2log)
-        ftp.retrbinary("RETR {0}".format(round2log), fp.write)
 
-    # Retrieve second log file (round 1)
-    # ftp.retrbinary("RETR %s" % secondLog[0], open('logs/%s' % secondLog[0], 'wb').write) # Not sure why this doesn't work
-    with open(round1log, "wb") as fp:  # Workaround
-        print("Downloading " + round1log)
-        ftp.retrbinary("RETR {0}".format(round1log), fp.write)
+def OpenMatchHistory():
+    history = matchhistory.MatchHistory()
+    history.import_json()  # the old prev* files, the first time
+    return history
 
-    # Send the retrieved log files to hampalyzer
-    hampalyze = (
-        "curl -X POST -F logs[]=@%s -F logs[]=@%s https://www.tfcstats.com/api/parsePickup"
-        % (round1log, round2log)
-    )
-    # Capture the result
-    output = os.popen(hampalyze).read()
-    print(output)
 
-    # Check if it worked or not
-    status = json.loads(output)
-    if "success" in status:
-        site = status["success"]["path"]
-        print("Parsed logs available: %s" % site)
-        # not using json stuff currently
-        # with open('prevlog.json', 'w') as f:
-        #     prevlog = { 'site': site, 'logFiles': [ firstLog[0], secondLog[0] ] }
-        #     json.dump(prevlog, f)
-    else:
-        print("error parsing logs: %s" % output)
+def LoadMapPool():
+    cache = mappool.MapPoolCache()
+    cache.get()  # parsed once here, so a broken maplist.json fails at startup
+    return cache
+
+
+def LoadState():
+    # the match history, map pool and demo archive index don't depend on each other; read them side by side
+    with ThreadPoolExecutor(max_workers=3, thread_name_prefix="startup") as pool:
+        archive = pool.submit(
+            demoarchive.DemoArchive,
+            maxBytes=int(os.getenv("DEMO_ARCHIVE_MAX_MB", "5000")) * 1024 * 1024,
+            baseUrl=DEMO_BASE_URL,
+        )
+        history = pool.submit(OpenMatchHistory)
+        mapPool = pool.submit(LoadMapPool)
+        return archive.result(), history.result(), mapPool.result()
+
+
+IMPORTED = time.perf_counter()
+demoArchive, matchHistory, mapPoolCache = LoadState()
+hltvLock = threading.Lock()  # see hltv_file_handler
+STATE_LOADED = time.perf_counter()
 
-    return site  # Give the hampalyzer link
+# logs the stack (and command) whenever something blocks the event loop for more than 250 ms
+loopWatchdog = loopwatch.LoopWatchdog(metrics=perfMetrics if perfMetrics.enabled else None)
 
+# the game servers; each reads its files over SFTP, FTP or the local disk, whichever works (found
+# once, not retried on every fetch), and keeps a couple of those connections open for reuse
+serverRegistry = servers.ServerRegistry.load(DefaultServer())
+for gameServer in serverRegistry.servers:
+    gameServer.files = ServerFiles(gameServer)
 
-# on load, load previous teams + map from the prev* files
-if os.path.exists("prevmaps.json"):
-    with open("prevmaps.json", "r") as f:
-        previousMaps = deque(json.load(f), maxlen=5)
-else:
-    previousMaps = []
+# copies a locked pickup's logs and demos off the server as they're written
+prefetcher = prefetch.Prefetcher(lambda: LastMatchServer().files.storage.open())
 
-if os.path.exists("prevteams.json"):
-    with open("prevteams.json", "r") as f:
-        previousTeam = json.load(f)
-else:
-    previousTeam = []
+# previous teams + maps come from the match history; the map pool is re-read only when it changes
+previousMaps = matchHistory.recent_maps(mapPoolCache.get().excludeRecent)
+lastMatch = matchHistory.last_match()
+previousTeam = [name for (_, name, _) in lastMatch["players"]] if lastMatch else []
 
 emoji = ["1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣", "6️⃣", "7️⃣"]
-mapList = []
+mapSelector = None
+mapSlots = None
 
 playerList = {}
 pickupStarted = False
@@ -293,15 +399,31 @@ pickupActive = False
 playerNumber = 8
 lastAdd = datetime.datetime.utcnow()
 lastAddCtx = None
+pickupChannelId = None
+
+# idle cancel and the !add countdown, keyed (kind, channel id)
+pickupTimers = timers.Scheduler()
+IDLE_SECONDS = 3 * 60 * 60  # a pickup nobody has added to for this long is canceled
+COUNTDOWN_STEP = 5  # !pickup counts down to !add in two of these
+AUTOLOCK_GRACE = 3  # a clinched vote locks this long after the deciding vote, unless it changes
+SNAPSHOT_DELAY = 2  # changes to the pickup are written to disk at most this often
+snapshotLock = asyncio.Lock()  # one snapshot write at a time
 
 mapChoices = []
 
 recentlyPlayedMapsMsg = None
 mapVote = False
+lockVoteLock = asyncio.Lock()  # !lockmap and the vote timers can both try to lock the same vote
 mapVoteMessage = None
 mapVoteMessageView = None
 nextCancelConfirms = False
 
+liveTailer = None
+liveTailerServer = None
+liveScoreMessage = None
+liveScoreText = None
+liveScoreEdited = 0
+
 
 class MapChoice:
     def __init__(self, mapName, decoration=None):
@@ -317,13 +439,17 @@ async def HandleMapButtonCallback(
 ):
     global mapVoteMessage
     if self is mapVoteMessageView:
-        processVote(interaction.user, int(button.custom_id))
-        await interaction.response.edit_message(embed=GenerateMapVoteEmbed())
+        with perfMetrics.timer("command_seconds", command="vote button"):
+            processVote(interaction.user, int(button.custom_id.split(":")[-1]))
+            SavePickupState()
+            VoteCast()
+            await interaction.response.edit_message(embed=GenerateMapVoteEmbed())
 
 
 class MapChoiceView(discord.ui.View):
     def __init__(self, mapChoices):
-        super().__init__()
+        # no timeout + fixed custom_ids makes this a persistent view that can be re-attached after a restart
+        super().__init__(timeout=None)
         self.addButtons()
 
     def addButtons(self):
@@ -331,7 +457,8 @@ class MapChoiceView(discord.ui.View):
         for idx, mapChoice in enumerate(mapChoices):
             self.add_item(
                 self.createButton(
-                    label=f"{emoji[idx]} {mapChoice.mapName}", custom_id=f"{idx + 1}"
+                    label=f"{emoji[idx]} {mapChoice.mapName}",
+                    custom_id=f"mapvote:{idx + 1}",
                 )
             )
 
@@ -345,6 +472,124 @@ class MapChoiceView(discord.ui.View):
         return button
 
 
+def SavePickupState():
+    # called after every change to the pickup; the changes of the next couple of seconds (a burst of
+    # !adds or votes) are written together, in a worker thread, so a slow disk doesn't stall the bot
+    if (pickupStarted or mapVote) and ("snapshot", pickupChannelId) not in pickupTimers:
+        pickupTimers.call_later(("snapshot", pickupChannelId), SNAPSHOT_DELAY, WritePickupState)
+
+
+async def WritePickupState():
+    async with snapshotLock:
+        state = PickupState()  # taken once it's our turn, so it's never older than the last write
+        if state is None:
+            return
+        await asyncio.to_thread(snapshot.save_snapshot, state)
+        if not (pickupStarted or mapVote):
+            snapshot.clear_snapshot()  # the pickup ended while we were writing
+
+
+async def FlushPickupState():
+    # write the pickup now, e.g. on shutdown, instead of waiting for SavePickupState's timer; after
+    # any write already under way, so that one can't land on top of this one with older state
+    pickupTimers.cancel(("snapshot", pickupChannelId))
+    async with snapshotLock:
+        state = PickupState()
+        if state is not None:
+            snapshot.save_snapshot(state)
+
+
+def PickupState():
+    if not (pickupStarted or mapVote):
+        return None
+
+    if mapVote:
+        phase = "voting"
+    elif pickupActive:
+        phase = "adding"
+    else:
+        phase = "starting"
+    return snapshot.encode_pickup_state(
+        phase,
+        pickupChannelId,
+        mapVoteMessage.id if mapVote and mapVoteMessage is not None else None,
+        playerList,
+        [(m.mapName, m.decoration, m.votes) for m in mapChoices] if mapVote else [],
+        playerNumber,
+        recentlyPlayedMapsMsg,
+        lastAdd.replace(tzinfo=datetime.timezone.utc).timestamp(),
+        nextCancelConfirms,
+    )
+
+
+def RestorePickupState():
+    # put back a pickup that was running when the bot went down; returns the restored state or None
+    global pickupStarted
+    global pickupActive
+    global playerList
+    global playerNumber
+    global mapChoices
+    global mapVote
+    global mapVoteMessage
+    global mapVoteMessageView
+    global recentlyPlayedMapsMsg
+    global nextCancelConfirms
+    global lastAdd
+    global pickupChannelId
+
+    start = time.perf_counter()
+    state = snapshot.load_snapshot()
+    if state is None:
+        return None
+
+    try:
+        state = snapshot.decode_pickup_state(state)
+    except (KeyError, IndexError, TypeError, ValueError):
+        logging.warning("discarding unreadable pickup snapshot")
+        snapshot.clear_snapshot()
+        return None
+
+    playerList = state["playerList"]
+    playerNumber = state["playerNumber"]
+    recentlyPlayedMapsMsg = state["recentMsg"]
+    nextCancelConfirms = state["cancelConfirms"]
+    pickupChannelId = state["channelId"]
+    if state["lastAdd"]:
+        lastAdd = datetime.datetime.utcfromtimestamp(state["lastAdd"])
+    BuildMapSelector()  # so a "New Maps" reroll still works
+
+    pickupStarted = True
+    if state["phase"] == "voting":
+        pickupActive = False
+        mapChoices = []
+        for mapName, decoration, votes in state["mapChoices"]:
+            mapChoice = MapChoice(mapName, decoration)
+            mapChoice.votes = votes
+            mapChoices.append(mapChoice)
+
+        mapVote = True
+        mapVoteMessageView = MapChoiceView(mapChoices)
+        if state["messageId"] is not None:
+            client.add_view(mapVoteMessageView, message_id=state["messageId"])
+            mapVoteMessage = client.get_partial_messageable(
+                state["channelId"]
+            ).get_partial_message(state["messageId"])
+        # the vote's timers start over; it may already be clinched
+        StartVoteTimers()
+        VoteCast()
+    else:
+        # a restart in the middle of the !add countdown just skips the rest of it
+        pickupActive = True
+        idle = (datetime.datetime.utcnow() - lastAdd).total_seconds()
+        pickupTimers.call_later(("idle", pickupChannelId), max(IDLE_SECONDS - idle, 0), IdleCancel)
+
+    logging.info(
+        "restored pickup (%s, %d players, %d maps) in %.2f ms"
+        % (state["phase"], len(playerList), len(state["mapChoices"]), (time.perf_counter() - start) * 1000)
+    )
+    return state
+
+
 # @debounce(2)
 async def printPlayerList(ctx):
     global playerList
@@ -369,95 +614,86 @@ async def DePopulatePickup(ctx):
     pickupActive = False
     playerNumber = 8
     playerList = {}
+    snapshot.clear_snapshot()
 
-    if idlecancel.is_running():
-        idlecancel.stop()
+    pickupTimers.cancel(("snapshot", pickupChannelId))
+    pickupTimers.cancel(("idle", pickupChannelId))
+    pickupTimers.cancel(("countdown", pickupChannelId))
+    StopVoteTimers()
 
     if ctx:
         await updateNick(ctx)
 
 
 def PickMaps(initial=False):
-    global mapList
+    global mapSelector
+    global mapSlots
     global mapChoices
 
-    mapChoices = []
-    if initial:
-        for i in range(6):
-            if i == 0:
-                mapname = random.choice(mapList["tier1"] + mapList["tier2"])
-                RemoveMap(mapname)
-                mapChoices.append(MapChoice(mapname))
-            elif i == 1:
-                mapname = random.choice(mapList["tier2"] + mapList["tier3"])
-                RemoveMap(mapname)
-                mapChoices.append(MapChoice(mapname))
-            elif i == 2:
-                mapname = random.choice(mapList["tier3"])
-                RemoveMap(mapname)
-                mapChoices.append(MapChoice(mapname))
-            elif i == 3:
-                mapname = random.choice(mapList["tier1"] + mapList["tier2"])
-                RemoveMap(mapname)
-                mapChoices.append(MapChoice(mapname))
-            elif i == 4:
-                mapname = random.choice(mapList["tier2"] + mapList["tier3"])
-                RemoveMap(mapname)
-                mapChoices.append(MapChoice(mapname))
-            elif i == 5:
-                mapname = random.choice(mapList["tier3"])
-                RemoveMap(mapname)
-                mapChoices.append(MapChoice(mapname))
-    else:
-        for i in range(6):
-            if i == 0:
-                mapname = random.choice(mapList["tier1"] + mapList["tier2"])
-                RemoveMap(mapname)
-                mapChoices.append(MapChoice(mapname))
-            elif i == 1:
-                mapname = random.choice(mapList["tier1"] + mapList["tier2"])
-                RemoveMap(mapname)
-                mapChoices.append(MapChoice(mapname))
-            elif i == 2:
-                mapname = random.choice(mapList["tier1"] + mapList["tier2"])
-                RemoveMap(mapname)
-                mapChoices.append(MapChoice(mapname))
-            elif i == 3:
-                mapname = random.choice(mapList["tier1"] + mapList["tier2"])
-                RemoveMap(mapname)
-                mapChoices.append(MapChoice(mapname))
-            elif i == 4:
-                mapname = random.choice(mapList["tier3"] + mapList["tier1"] + mapList["tier2"])
-                RemoveMap(mapname)
-                mapChoices.append(MapChoice(mapname))
-            elif i == 5:
-                mapname = random.choice(mapList["tier3"] + mapList["tier1"] + mapList["tier2"])
-                RemoveMap(mapname)
-                mapChoices.append(MapChoice(mapname))
-
-def RemoveMap(givenMap):
-    global mapList
-
-    if givenMap in mapList["tier1"]:
-        mapList["tier1"].remove(givenMap)
-    elif givenMap in mapList["tier2"]:
-        mapList["tier2"].remove(givenMap)
-    elif givenMap in mapList["tier3"]:
-        mapList["tier3"].remove(givenMap)
-
-
-def RecordMapAndTeams(winningMap):
+    template = mapSlots["initial"] if initial else mapSlots["reroll"]
+    mapChoices = [MapChoice(mapName) for mapName in mapSelector.draw(template)]
+
+
+def BalanceTeams():
+    global playerList
+
+    playerRatings = matchHistory.ratings(playerList.keys())
+    return ratings.balance_teams(playerRatings, playerList.keys())
+
+
+async def RecordMapAndTeams(winningMap, team1, team2, server=None):
     global previousMaps
     global playerList
     global previousTeam
 
     previousMaps.append(winningMap)
-    with open("prevmaps.json", "w") as f:
-        json.dump(list(previousMaps), f)
+    previousTeam = [playerList[playerId] for playerId in team1 + team2]
+
+    await matchHistory.record_match(
+        winningMap,
+        [(playerId, playerList[playerId], 1) for playerId in team1]
+        + [(playerId, playerList[playerId], 2) for playerId in team2],
+        server=server.name if server is not None else None,
+    )
+
+
+async def PushPickup(server, mapName, team1, team2):
+    # hand the plugin the map and teams as soon as they're locked instead of waiting for it to ask
+    # serverComms, and put the server on the map before anyone connects
+    with perfMetrics.timer("op_seconds", op="push_pickup"):
+        await asyncio.gather(PushToPlugin(server, mapName, team1, team2), ChangeLevel(server, mapName))
+
+
+async def PushToPlugin(server, mapName, team1, team2):
+    if server.pluginPort is None or botMessages is None:
+        return
+    # one frame, retransmitted until the plugin acks it
+    link = botMessages.link((server.host, server.pluginPort))
+    acked = await asyncio.gather(
+        link.send("MAP", mapName), link.send("TEAMS", ", ".join(team1)), link.send("TEAMS", ", ".join(team2))
+    )
+    if not all(acked):
+        logging.warning(
+            "%s: plugin never acked the map and teams; it can still ask serverComms for them" % server.name
+        )
+
 
-    previousTeam = list(playerList.values())
-    with open("prevteams.json", "w") as f:
-        json.dump(previousTeam, f)
+async def ChangeLevel(server, mapName):
+    if server.rcon is None or not re.fullmatch(r"[\w.+-]+", mapName):
+        return
+    try:
+        info = await server.query.info()
+    except a2s.QueryError:
+        info = None  # try anyway; rcon may get through where the query didn't
+    if info is not None and info["players"] - info["bots"] > 0:
+        logging.info("%s: not changing level, %d players still on %s" % (server.name, info["players"], info["map"]))
+        return
+    if info is not None and info["map"] == mapName:
+        return
+    try:
+        await server.rcon.execute("changelevel %s" % mapName)
+    except rcon.RconError as e:
+        logging.warning("%s: changelevel %s failed: %s" % (server.name, mapName, e))
 
 
 async def updateNick(ctx, status=None):
@@ -466,7 +702,35 @@ async def updateNick(ctx, status=None):
     else:
         status = "ETFC (" + status + ")"
 
-    await ctx.message.guild.me.edit(nick=status)
+    await SetNick(ctx.message.guild, status)
+
+
+async def SetNick(guild, status=None):
+    if guild is not None:
+        await guild.me.edit(nick=status)
+
+
+def BuildMapSelector():
+    global mapSelector
+    global mapSlots
+    global previousMaps
+
+    mapPool = mapPoolCache.get()
+    previousMaps = matchHistory.recent_maps(mapPool.excludeRecent)
+
+    # the last few played maps are left out of the vote altogether, and the rest
+    # are weighted down by how recently / how often they've been played
+    recencyWindow = mapPool.weights.get("recency", {}).get("window", mapPool.excludeRecent)
+    mapWeights = mapselect.map_weights(
+        mapPool.maps,
+        matchHistory.recent_maps(recencyWindow),
+        matchHistory.map_play_counts(),
+        mapPool.weights,
+    )
+    mapSelector = mapselect.MapSelector(
+        mappool.eligible_tiers(mapPool, previousMaps), mapWeights
+    )
+    mapSlots = mapPool.slots
 
 
 @client.command(pass_context=True)
@@ -474,11 +738,11 @@ async def pickup(ctx):
     global pickupStarted
     global pickupActive
     global mapVote
-    global mapList
     global playerNumber
     global previousMaps
     global recentlyPlayedMapsMsg
     global nextCancelConfirms
+    global pickupChannelId
 
     if (
         pickupStarted == False
@@ -486,12 +750,8 @@ async def pickup(ctx):
         and mapVote == False
         and ctx.channel.name == CHANNEL_NAME
     ):
-        with open("maplist.json") as f:
-            mapList = json.load(f)
-            for prevMap in previousMaps:
-                for tier in mapList.values():
-                    if prevMap in tier:
-                        tier.remove(prevMap)
+        BuildMapSelector()
+        pickupChannelId = ctx.channel.id
 
         DePopulatePickup
 
@@ -501,19 +761,29 @@ async def pickup(ctx):
             "Maps %s were recently played and are removed from voting."
             % ", ".join(previousMaps)
         )
+        SavePickupState()
 
-        await ctx.send("Pickup started. !add in 10 seconds")
+        await ctx.send("Pickup started. !add in %d seconds" % (2 * COUNTDOWN_STEP))
         await updateNick(ctx, "starting...")
-        await asyncio.sleep(5)
-        await ctx.send("!add in 5 seconds")
-        await asyncio.sleep(5)
+        # !cancel drops the rest of the countdown along with the pickup's other timers
+        pickupTimers.call_later(("countdown", ctx.channel.id), COUNTDOWN_STEP, PickupCountdown, ctx, COUNTDOWN_STEP)
 
-        if pickupStarted == True:
-            pickupActive = True
-            await ctx.send("!add enabled")
-            await printPlayerList(ctx)
-        else:
-            await ctx.send("Pickup was canceled before countdown finished.")
+
+async def PickupCountdown(ctx, remaining):
+    global pickupActive
+
+    if remaining > 0:
+        await ctx.send("!add in %d seconds" % remaining)
+        pickupTimers.call_later(
+            ("countdown", ctx.channel.id), COUNTDOWN_STEP, PickupCountdown, ctx, remaining - COUNTDOWN_STEP
+        )
+        return
+
+    if pickupStarted == True:
+        pickupActive = True
+        SavePickupState()
+        await ctx.send("!add enabled")
+        await printPlayerList(ctx)
 
 
 @client.command(pass_context=True)
@@ -521,19 +791,17 @@ async def cancel(ctx):
     global pickupStarted
     global pickupActive
     global mapVote
-    global mapVoteMessage
     global nextCancelConfirms
 
     if mapVote != False and not nextCancelConfirms:
         await ctx.send("You're still picking maps, still want to cancel?")
         nextCancelConfirms = True
+        SavePickupState()
         return
     if pickupStarted == True or pickupActive == True:
         pickupStarted = False
         pickupActive = False
-        if mapVoteMessage is not None:
-            await mapVoteMessage.edit(view=None)
-            mapVoteMessage = None
+        await HideVoteButtons()
         await ctx.send("Pickup canceled.")
         await DePopulatePickup(ctx)
     else:
@@ -555,6 +823,7 @@ async def playernumber(ctx, numPlayers: int):
 
     if players % 2 == 0 and players <= 20 and players >= 2:
         playerNumber = players
+        SavePickupState()
         await ctx.send("Set pickup to fill at %d players" % playerNumber)
         await updateNick(ctx, str(len(playerList)) + "/" + str(playerNumber))
     else:
@@ -563,6 +832,7 @@ async def playernumber(ctx, numPlayers: int):
         )
 
 
+@perfMetrics.timed("op_seconds", op="render_vote_embed")
 def GenerateMapVoteEmbed():
     global emoji
     global mapChoices
@@ -666,17 +936,15 @@ async def add(ctx):
         if playerId not in playerList:
             playerList[playerId] = playerName
             lastAdd = datetime.datetime.utcnow()
-
-            if not idlecancel.is_running():
-                idlecancel.start()
-                lastAddCtx = ctx
+            lastAddCtx = ctx
+            pickupTimers.call_later(("idle", ctx.channel.id), IDLE_SECONDS, IdleCancel)
 
             if len(playerList) < playerNumber:
+                SavePickupState()
                 await printPlayerList(ctx)
             else:
                 pickupActive = False
-                if idlecancel.is_running():
-                    idlecancel.stop()
+                pickupTimers.cancel(("idle", ctx.channel.id))
 
                 await printPlayerList(ctx)
                 await updateNick(ctx, "voting...")
@@ -692,6 +960,8 @@ async def add(ctx):
                 embed = GenerateMapVoteEmbed()
                 mapVoteMessageView = MapChoiceView(mapChoices)
                 mapVoteMessage = await ctx.send(embed=embed, view=mapVoteMessageView)
+                SavePickupState()
+                StartVoteTimers()
 
                 mentionString = ""
                 for playerId in playerList.keys():
@@ -699,23 +969,16 @@ async def add(ctx):
                 await ctx.send(mentionString)
 
 
-@tasks.loop(minutes=30)
-async def idlecancel():
-    global lastAdd
-    global lastAddCtx
-    global pickupActive
-    global mapVote
-
+async def IdleCancel():
+    # fires IDLE_SECONDS after the last !add; every !add pushes it back
     if pickupActive == True and pickupStarted == True and mapVote == False:
-        # check if 3 hours since last add
-        lastAddDiff = (datetime.datetime.utcnow() - lastAdd).total_seconds()
-        print("last add was %d minutes ago" % (lastAddDiff / 60))
-
-        if lastAddDiff > (3 * 60 * 60):
-            print("stopping pickup")
+        idle = (datetime.datetime.utcnow() - lastAdd).total_seconds()
+        print("stopping pickup, last add was %d minutes ago" % (idle / 60))
 
-            await lastAddCtx.send("Pickup idle for more than three hours, canceling.")
-            await DePopulatePickup(lastAddCtx)
+        # after a restart there's no ctx, just the channel id from the snapshot
+        channel = lastAddCtx.channel if lastAddCtx else client.get_partial_messageable(pickupChannelId)
+        await channel.send("Pickup idle for more than three hours, canceling.")
+        await DePopulatePickup(lastAddCtx)
 
 
 @client.command(pass_context=True)
@@ -726,6 +989,7 @@ async def remove(ctx):
     if pickupActive == True and ctx.channel.name == CHANNEL_NAME:
         if ctx.author.id in playerList:
             del playerList[ctx.author.id]
+            SavePickupState()
             await printPlayerList(ctx)
 
 
@@ -736,6 +1000,7 @@ async def kick(ctx, player: discord.User):
 
     if player is not None and player.id in playerList:
         del playerList[player.id]
+        SavePickupState()
         await ctx.send("Kicked %s from the pickup." % player.mention)
         await printPlayerList(ctx)
 
@@ -769,20 +1034,47 @@ def processVote(player: discord.Member = None, vote=None):
 @client.command(pass_context=True, aliases=["fv"])
 @commands.has_any_role('admin', 'Pickup Ranger')
 async def lockmap(ctx):
+    if ctx.channel.name != CHANNEL_NAME:
+        return
+
+    await LockVote(ctx.channel, ctx.message.guild)
+
+
+async def LockVote(channel, guild, reason=None):
+    # !lockmap, and the vote timers when they lock it themselves (reason says why). Whichever of
+    # them gets the lock second finds the vote it came for already locked (or rerolled), and stops.
+    choices = mapChoices
+    async with lockVoteLock:
+        if mapChoices is choices:
+            await LockCurrentVote(channel, guild, reason)
+
+
+async def HideVoteButtons():
+    # the message can be gone, or unknown after a restart that couldn't keep it
+    global mapVoteMessage
+    global mapVoteMessageView
+
+    message = mapVoteMessage
+    mapVoteMessage = None
+    mapVoteMessageView = None
+    if message is not None:
+        try:
+            await message.edit(view=None)
+        except discord.HTTPException as e:
+            logging.warning("couldn't remove the map vote buttons: %s" % e)
+
+
+async def LockCurrentVote(channel, guild, reason):
     global mapVote
     global mapVoteMessage
     global mapVoteMessageView
 
     global mapChoices
 
-    global mapList
     global previousMaps
     global recentlyPlayedMapsMsg
     global nextCancelConfirms
 
-    if ctx.channel.name != CHANNEL_NAME:
-        return
-
     rankedVotes = []
     highestVote = 0
     winningMap = " "
@@ -800,12 +1092,18 @@ async def lockmap(ctx):
 
         # don't allow lockmap if no votes were cast
         if highestVote == 0:
-            await ctx.send("!lockmap denied; no votes were cast.")
+            if reason is None:
+                await channel.send("!lockmap denied; no votes were cast.")
+            else:
+                await channel.send("Nobody has voted for a map; an admin can !lockmap once someone does.")
             return
 
+        StopVoteTimers()
+        if reason is not None:
+            await channel.send("Map vote locked: %s." % reason)
+
         # Hide voting buttons now that the vote is complete.
-        mapVoteMessageView = None
-        await mapVoteMessage.edit(view=None)
+        await HideVoteButtons()
 
         winningMaps = [
             pickedMap for (pickedMap, votes) in rankedVotes if votes == highestVote
@@ -832,18 +1130,107 @@ async def lockmap(ctx):
             embed = GenerateMapVoteEmbed()
             mapVoteMessageView = MapChoiceView(mapChoices)
 
-            mapVoteMessage = await ctx.send(embed=embed, view=mapVoteMessageView)
+            mapVoteMessage = await channel.send(embed=embed, view=mapVoteMessageView)
+            SavePickupState()
+            StartVoteTimers()
         else:
-            mapVoteMessage = None
-            mapVoteMessageView = None
-
             mapVote = False
-            RecordMapAndTeams(winningMap)
+            team1, team2 = BalanceTeams()
+            # with several servers, the emptiest (then closest) one that answers gets the pickup
+            server = await serverRegistry.pick()
+            await RecordMapAndTeams(winningMap, team1, team2, server)
+            asyncio.ensure_future(
+                PushPickup(
+                    server,
+                    winningMap,
+                    [playerList[playerId] for playerId in team1],
+                    [playerList[playerId] for playerId in team2],
+                )
+            )
+
+            await channel.send("The winning map is: " + winningMap)
+            await channel.send(
+                "```\nTeam 1: %s\nTeam 2: %s```"
+                % (
+                    ", ".join(playerList[playerId] for playerId in team1),
+                    ", ".join(playerList[playerId] for playerId in team2),
+                )
+            )
+            StartLiveScore()
+            StartPrefetch(winningMap)
+            if len(serverRegistry.servers) > 1:
+                await channel.send("Server: %s" % server.name)
+            if server.joinUrl:
+                await channel.send("Please join the server: %s" % server.joinUrl)
+            await channel.send(server.connect_command())
+            await DePopulatePickup(None)
+            await SetNick(guild)
+
+
+def VoteClinched():
+    # why the vote can be locked without waiting for anyone else, or None: everybody has voted, or
+    # the leader is further ahead than the votes still out could make up (so no tie either)
+    tallies = sorted((len(mapChoice.votes) for mapChoice in mapChoices), reverse=True)
+    outstanding = len(playerList) - sum(tallies)
+    if outstanding <= 0:
+        return "everyone has voted"
+    if tallies[0] - (tallies[1] if len(tallies) > 1 else 0) > outstanding:
+        return "%s can't be caught" % max(mapChoices, key=lambda mapChoice: len(mapChoice.votes)).mapName
+    return None
+
+
+def PickupChannel():
+    channel = client.get_channel(pickupChannelId)
+    return channel if channel is not None else client.get_partial_messageable(pickupChannelId)
+
+
+def StartVoteTimers():
+    # called whenever a map vote opens (a full pickup, a reroll, a restored vote)
+    if VOTE_REMIND_SECONDS:
+        pickupTimers.call_later(("voteremind", pickupChannelId), VOTE_REMIND_SECONDS, RemindVoters)
+    if VOTE_DEADLINE_SECONDS:
+        pickupTimers.call_later(("votedeadline", pickupChannelId), VOTE_DEADLINE_SECONDS, AutoLockVote, "time's up")
+
+
+def StopVoteTimers():
+    for kind in ("voteremind", "votedeadline", "autolock"):
+        pickupTimers.cancel((kind, pickupChannelId))
+
+
+def VoteCast():
+    # after every vote: lock a clinched vote shortly (a misclick can still be changed), or call
+    # that off if a changed vote un-clinched it
+    if not VOTE_AUTOLOCK:
+        return
+    reason = VoteClinched()
+    if reason is not None:
+        if ("autolock", pickupChannelId) not in pickupTimers:
+            pickupTimers.call_later(("autolock", pickupChannelId), AUTOLOCK_GRACE, AutoLockVote, reason)
+    else:
+        pickupTimers.cancel(("autolock", pickupChannelId))
 
-            await ctx.send("The winning map is: " + winningMap)
-            await ctx.send("Please join the server: https://tinyurl.com/etfcvultr")
-            await ctx.send(f"connect {SERVER_IP}:27015;password " + SERVER_PASSWORD)
-            await DePopulatePickup(ctx)
+
+async def AutoLockVote(reason):
+    if mapVote == True:
+        if reason != "time's up":
+            reason = VoteClinched() or reason
+        channel = PickupChannel()
+        await LockVote(channel, getattr(channel, "guild", None), reason)
+
+
+def AbstainerMentions():
+    playersVoted = {
+        playerId for mapChoice in mapChoices for playerId in mapChoice.votes
+    }
+    return [
+        "<@%s>" % playerId for playerId in playerList.keys() if playerId not in playersVoted
+    ]
+
+
+async def RemindVoters():
+    mentions = AbstainerMentions()
+    if mapVote == True and mentions:
+        await PickupChannel().send("Please vote for maps: " + " ".join(mentions))
 
 
 @client.command(pass_context=True)
@@ -853,17 +1240,7 @@ async def vote(ctx):
     global mapChoices
 
     if mapVote == True and ctx.channel.name == CHANNEL_NAME:
-        playersVoted = [
-            playerId for mapChoice in mapChoices for playerId in mapChoice.votes
-        ]
-        playersAbstained = [
-            playerId for playerId in playerList.keys() if playerId not in playersVoted
-        ]
-
-        mentionString = "Please vote for maps: "
-        for playerId in playersAbstained:
-            mentionString = mentionString + ("<@%s> " % playerId)
-        await ctx.send(mentionString + "")
+        await ctx.send("Please vote for maps: " + " ".join(AbstainerMentions()))
 
 
 @client.command(pass_context=True)
@@ -883,36 +1260,212 @@ async def lockset(ctx, mapToLockset):
 
     previousMaps.pop()
     previousMaps.append(mapToLockset)
-
-    with open("prevmaps.json", "w") as f:
-        json.dump(list(previousMaps), f)
+    await matchHistory.set_last_map(mapToLockset)
 
     await ctx.send("Set pickup map to %s" % mapToLockset)
 
 
 @client.command(pass_context=True)
-async def timeleft(ctx):
+@commands.has_any_role('admin', 'Pickup Ranger')
+async def result(ctx, winner):
     if ctx.channel.name != CHANNEL_NAME:
         return
 
-    # construct a UDP packet and send it to the server
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.sendto("BOT_MSG@TIMELEFT@".encode(), (SERVER_IP, int(SERVER_PORT)))
+    scores = {"1": (1, 1.0), "2": (2, 0.0), "draw": (0, 0.5)}
+    if winner.lower() not in scores:
+        await ctx.send("Usage: !result 1, !result 2 or !result draw")
+        return
+    winnerCode, team1Score = scores[winner.lower()]
 
-    await asyncio.sleep(3)
-    if os.path.exists("timeleft.json"):
-        with open("timeleft.json", "r") as f:
+    match = matchHistory.last_match()
+    if match is None or match["winner"] is not None:
+        await ctx.send("No match is waiting for a result.")
+        return
+
+    team1 = [playerId for (playerId, _, team) in match["players"] if team == 1]
+    team2 = [playerId for (playerId, _, team) in match["players"] if team == 2]
+    if not team1 or not team2:
+        await ctx.send("The last match has no recorded teams.")
+        return
+
+    oldRatings = matchHistory.ratings(team1 + team2)
+    newRatings = ratings.update_ratings(oldRatings, team1, team2, team1Score)
+    await matchHistory.record_result(match["id"], winnerCode, newRatings)
+
+    delta = newRatings[team1[0]] - oldRatings.get(team1[0], ratings.DEFAULT_RATING)
+    await ctx.send(
+        "Recorded result for %s; team 1 %+.0f, team 2 %+.0f rating."
+        % (match["map"], delta, -delta)
+    )
+
+
+def StartLiveScore():
+    global liveTailer
+    global liveTailerServer
+
+    server = LastMatchServer()
+    if liveTailer is not None and liveTailerServer is not server:
+        liveTailer.close()
+        liveTailer = None
+    if liveTailer is None:
+        liveTailer = logtail.LogTailer(server.files.storage.open)
+        liveTailerServer = server
+    liveTailer.lastData = time.monotonic()
+    if not livescore.is_running():
+        livescore.start()
+
+
+@tasks.loop(seconds=5)
+async def livescore():
+    global liveTailer
+    global liveScoreMessage
+    global liveScoreText
+    global liveScoreEdited
+
+    await asyncio.to_thread(liveTailer.poll)
+
+    # nothing logged for a while: the game is over (or never started)
+    if time.monotonic() - liveTailer.lastData > 15 * 60:
+        print("stopping live score, log is idle")
+        liveTailer.close()
+        liveScoreMessage = None
+        livescore.stop()
+        return
+
+    # keep edits well under Discord's rate limits
+    text = liveTailer.scoreboard()
+    if liveScoreMessage is not None and text != liveScoreText and time.monotonic() - liveScoreEdited > 15:
+        liveScoreEdited = time.monotonic()
+        try:
             try:
-                timeleft = json.load(f)
-                if timeleft is not None and timeleft["timeleft"]:
-                    await ctx.send("Timeleft: %s" % timeleft["timeleft"])
-                    return
-            except:
-                await ctx.send("Server did not respond.")
+                await liveScoreMessage.edit(content=text)
+            except discord.NotFound:
+                # someone deleted the scoreboard; post it again rather than going quiet for the match
+                liveScoreMessage = await liveScoreMessage.channel.send(text)
+            liveScoreText = text
+        except discord.HTTPException as e:
+            # try again on the next change; an exception here would end the loop for good
+            logging.warning("couldn't update the live score: %s" % e)
+
+
+@tasks.loop(seconds=servers.PROBE_INTERVAL)
+async def serverprobe():
+    # keeps the picture fresh, so !lockmap rarely has to wait for a probe
+    with perfMetrics.timer("op_seconds", op="server_probe"):
+        await serverRegistry.probe_all()
+
+
+def StartPrefetch(mapName):
+    prefetcher.start(mapName)
+    if not prefetchloop.is_running():
+        prefetchloop.start()
+
+
+@tasks.loop(seconds=prefetch.POLL_INTERVAL)
+async def prefetchloop():
+    if prefetcher.expired():
+        StopPrefetch()
+        return
+    await asyncio.to_thread(prefetcher.poll)
+
+
+def StopPrefetch():
+    if prefetchloop.is_running():
+        prefetchloop.stop()
+        prefetcher.close()
+        print(prefetcher.summary())
+
+
+@client.command(pass_context=True)
+async def score(ctx):
+    global liveScoreMessage
+    global liveScoreText
+
+    if ctx.channel.name != CHANNEL_NAME:
+        return
+
+    StartLiveScore()
+    if liveTailer.current is None:
+        await asyncio.to_thread(liveTailer.poll)
+
+    # the newest !score message is the one that keeps getting updated
+    liveScoreText = liveTailer.scoreboard()
+    liveScoreMessage = await ctx.send(liveScoreText)
+
+
+@client.command(pass_context=True)
+async def timeleft(ctx):
+    if ctx.channel.name != CHANNEL_NAME:
+        return
+
+    # ask the server itself (A2S, one round trip, cached for a few seconds); the plugin only if
+    # the server doesn't report mp_timeleft
+    server = LastMatchServer()
+    try:
+        info, seconds = await asyncio.gather(server.query.info(), server.query.timeleft())
+    except a2s.QueryError as e:
+        logging.warning("A2S query of %s failed: %s" % (server.name, e))
+        info = seconds = None
+    if seconds is not None:
+        await ctx.send(
+            "Timeleft: %d:%02d on %s (%d/%d players)"
+            % (seconds // 60, seconds % 60, info["map"], info["players"] - info["bots"], info["maxPlayers"])
+        )
+        return
+
+    timeleft = await PluginTimeleft(server)
+    if timeleft is not None:
+        await ctx.send("Timeleft: %s" % timeleft)
     else:
         await ctx.send("Server did not respond.")
 
 
+async def PluginTimeleft(server):
+    # the server plugin answers BOT_MSG@TIMELEFT to serverComms.py, which writes timeleft.json
+    if server.pluginPort is None:
+        return None
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setblocking(False)
+        await asyncio.get_running_loop().sock_sendto(
+            sock, "BOT_MSG@TIMELEFT@".encode(), (server.host, server.pluginPort)
+        )
+
+    await asyncio.sleep(3)
+    if not os.path.exists("timeleft.json"):
+        return None
+    with open("timeleft.json", "r") as f:
+        try:
+            timeleft = json.load(f)
+        except ValueError:
+            return None
+    if not isinstance(timeleft, dict) or not timeleft.get("timeleft"):
+        return None
+    return timeleft["timeleft"]
+
+
+@client.command(pass_context=True)
+async def players(ctx):
+    if ctx.channel.name != CHANNEL_NAME:
+        return
+
+    server = LastMatchServer()
+    try:
+        info, players = await asyncio.gather(server.query.info(), server.query.players())
+    except a2s.QueryError:
+        await ctx.send("Server did not respond.")
+        return
+    players.sort(key=lambda p: p["score"], reverse=True)
+    await ctx.send(
+        "%s: %d/%d players%s"
+        % (
+            info["map"],
+            info["players"] - info["bots"],
+            info["maxPlayers"],
+            "\n" + ", ".join("%s (%d)" % (p["name"], p["score"]) for p in players) if players else "",
+        )
+    )
+
+
 """@client.command(pass_context=True)
  async def stats(ctx):
     with open('prevlog.json', 'r') as f:
@@ -925,35 +1478,37 @@ async def timeleft(ctx):
 async def forcestats(ctx):
     print("forcestats -- channel name" + ctx.channel.name)
     if ctx.channel.name == "pickup":
-        await ctx.send("force-parsing stats; wait 5 sec...")
-
-        with open("prevlog.json", "w") as f:
-            f.write("[]")
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto("BOT_MSG@END".encode(), ("0.0.0.0", int(CLIENT_PORT)))
-
-        await asyncio.sleep(5)
-
-        with open("prevlog.json", "r") as f:
-            prevlog = json.load(f)
-            await ctx.send("Stats: %s" % prevlog["site"])
+        if SubmitStats("!forcestats") is None:
+            await ctx.send("Stats are already being fetched.")
+        else:
+            await ctx.send("force-parsing stats; they'll show up in <#%d>." % STATS_CHANNEL_ID)
 
 
 @client.command(pass_context=True)
 async def hltv(ctx):
-    ssh_client = paramiko.SSHClient()
-    ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh_client.connect(
-        hostname=os.getenv("FTP_SERVER"),
-        port=22,
-        username=os.getenv("FTP_USER"),
-        password=os.getenv("FTP_PASSWD"),
-    )
-    output_zipfile = hltv_file_handler(ssh_client)
-    await ctx.send(file=discord.File(output_zipfile), content="HLTV Here")
-    os.remove(output_zipfile)
-    ssh_client.close()
+    # connecting and downloading take seconds to minutes; keep them off the event loop
+    server = LastMatchServer()
+    try:
+        store = await asyncio.to_thread(server.files.acquire)
+    except storage.StorageUnavailable:
+        await ctx.send("Can't reach the game server's files right now.")
+        return
+    fetched = False
+    try:
+        demoKey = await asyncio.to_thread(
+            hltv_file_handler,
+            store,
+            expectedMap=LastMatchMap(),
+            limit=ctx.guild.filesize_limit,
+            matchKey=LastMatchId(),
+        )
+        fetched = True
+    finally:
+        server.files.release(store, reuse=fetched)
+    if demoKey is None:
+        await ctx.send("Couldn't find the demos for the last pickup.")
+        return
+    await SendDemos(ctx.channel, demoKey, "HLTV Here")
 
 
 @client.command(pass_context=True)
@@ -964,80 +1519,424 @@ async def logs(ctx):
 @client.command(pass_context=True)
 async def tfcmap(ctx, map):
     map = map.lower()
-    with urllib.request.urlopen(r"http://mrclan.com/tfcmaps/") as mapIndex:
-        response = mapIndex.read().decode("utf-8")
-        matches = re.findall('<a href="/tfcmaps/%s.zip' % (map), response, re.I)
-        if len(matches) != 0:
-            await ctx.send("Found map: http://mrclan.com/tfcmaps/%s.zip" % (map))
-        else:
-            await ctx.send(
-                "Didn't find specified map. [All known maps are here](http://mrclan.com/tfcmaps/)."
-            )
+    response = await asyncio.to_thread(FetchMapIndex)
+    matches = re.findall('<a href="/tfcmaps/%s.zip' % (map), response, re.I)
+    if len(matches) != 0:
+        await ctx.send("Found map: http://mrclan.com/tfcmaps/%s.zip" % (map))
+    else:
+        await ctx.send(
+            "Didn't find specified map. [All known maps are here](http://mrclan.com/tfcmaps/)."
+        )
+
+
+def FetchMapIndex():
+    import urllib.request
+
+    with urllib.request.urlopen(r"http://mrclan.com/tfcmaps/", timeout=30) as mapIndex:
+        return mapIndex.read().decode("utf-8")
 
 
 @client.command(pass_context=True)
 async def server(ctx):
-    await ctx.send("steam://connect/95.179.239.153:27015/%s" % SERVER_PASSWORD)
+    await ctx.send(LastMatchServer().steam_url())
+
+
+@client.command(name="servers", pass_context=True)
+async def serverstatus(ctx):
+    await serverRegistry.probe_all()
+    await ctx.send("```\n%s```" % serverRegistry.summary())
 
 
 @client.command(pass_context=True)
 async def help(ctx):
     await ctx.send("pickup: !pickup !add !remove !teams !lockmap !cancel")
-    await ctx.send("info: !stats !timeleft !hltv !logs !tfcmap !server")
-    await ctx.send("admin: !playernumber !kick !lockset !forcestats !vote")
+    await ctx.send("info: !stats !score !timeleft !players !hltv !logs !tfcmap !server !servers")
+    await ctx.send("admin: !playernumber !kick !lockset !result !forcestats !vote !perf")
+
+
+def UploadLimit(channel):
+    # fetched channels may only have a stub guild; 25 MB is Discord's default
+    return getattr(channel.guild, "filesize_limit", 25 * 1024 * 1024)
 
 
-# retrieve logs from FTP and get hampalyzer link
+async def SendDemos(channel, demoKey, content=None):
+    kind, payload = await asyncio.to_thread(demoArchive.plan, demoKey, UploadLimit(channel))
+    if kind == "files":
+        for idx, path in enumerate(payload):
+            await channel.send(file=discord.File(path), content=content if idx == 0 else None)
+        if len(payload) > 1:
+            await channel.send(
+                "Demos were split into %d parts; download them all and open the .001 with 7-Zip."
+                % len(payload)
+            )
+        demoArchive.cleanup_parts(payload)
+    elif kind == "link":
+        await channel.send(((content + "\n") if content else "") + "HLTV: " + payload)
+    else:
+        await channel.send(((content + "\n") if content else "") + "HLTV demos are too large to upload.")
+
+
+async def SendStats(channel, logs_link, summary):
+    if summary is not None:
+        await channel.send(summary)
+    if logs_link is not None:
+        await channel.send(logs_link)
+
+
+# Post-match stats pipeline: END from the server (or !stats) -> wait for the log to stop growing ->
+# pick the two rounds -> fetch -> parse/upload -> package HLTV -> post, as one background job.
+
+
+def newest_log_size(store):
+    logs = [a for a in store.listdir_attr(store.dirs["logs"]) if a.filename.endswith(".log")]
+    if not logs:
+        return None
+    newest = max(logs, key=lambda a: (a.st_mtime, a.filename))
+    return (newest.filename, newest.st_size)
+
+
+def settle_log(store, expectedMap):
+    # After END the server has often opened the next map's log already, and that one keeps growing;
+    # the one to wait for is this pickup's round 2, else the newest log that looks like a round.
+    rounds = find_round_logs(store, expectedMap)
+    if rounds is not None:
+        return rounds[1].name
+    for info in roundpick.recent_logs(store):
+        if roundpick.is_round(info):
+            return info.name
+    return None
+
+
+def log_size(store, name):
+    if name is None:
+        return newest_log_size(store)
+    return (name, store.stat(store.dirs["logs"] + "/" + name).st_size)
+
+
+def JobServer(job):
+    return serverRegistry.get(job.data.get("server")) or serverRegistry.default
+
+
+def JobMatch(job):
+    # jobs saved before they carried their match fall back to the newest one
+    if "match" not in job.data:
+        match = matchHistory.last_match()
+        job.data["match"] = match["id"] if match is not None else None
+        job.data["map"] = match["map"] if match is not None else None
+    return job.data["match"]
+
+
+async def JobStorage(job):
+    # jobs resumed after a restart start past the connect stage, so any stage may have to connect
+    if "storage" not in job.local:
+        job.local["storage"] = await asyncio.to_thread(JobServer(job).files.acquire)
+    return job.local["storage"]
+
+
+async def StageConnect(job):
+    # the same stages follow over SFTP, FTP or the local disk, on the server the pickup was played on
+    job.data.setdefault("server", LastMatchServer().name)
+    JobMatch(job)
+    await JobStorage(job)
+
+
+async def StageSettle(job):
+    if not job.data.get("settle"):
+        return
+
+    if "settleLog" not in job.data:
+        JobMatch(job)
+        job.data["settleLog"] = await asyncio.to_thread(settle_log, await JobStorage(job), job.data.get("map"))
+
+    lastSize = None
+    stableSince = time.monotonic()
+    deadline = time.monotonic() + 10 * 60
+    while time.monotonic() < deadline:
+        size = await asyncio.to_thread(log_size, await JobStorage(job), job.data["settleLog"])
+        if size != lastSize:
+            lastSize = size
+            stableSince = time.monotonic()
+        elif time.monotonic() - stableSince >= LOG_SETTLE_SECONDS:
+            return
+        await asyncio.sleep(5)
+
+
+async def StageRounds(job):
+    JobMatch(job)  # pins job.data["map"] for jobs saved before they carried it
+    rounds = await asyncio.to_thread(find_round_logs, await JobStorage(job), job.data.get("map"))
+    if rounds is None:
+        raise RuntimeError("could not find the two round logs")
+    job.data["rounds"] = [roundpick.log_info_to_json(info) for info in rounds]
+
+    # the server can send END more than once; don't post the same pickup twice
+    logFiles = [info.name for info in rounds]
+    if job.reason == "END" and os.path.exists("prevlog.json"):
+        with open("prevlog.json", "r") as f:
+            prevlog = json.load(f)
+        if isinstance(prevlog, dict) and prevlog.get("logFiles") == logFiles:
+            print("already parsed the latest log")
+            job.data["done"] = True
+
+
+def JobRounds(job):
+    return [roundpick.log_info_from_json(state) for state in job.data["rounds"]]
+
+
+async def StageFetchLogs(job):
+    job.data["logFiles"] = await asyncio.to_thread(
+        fetch_round_logs, await JobStorage(job), JobRounds(job)
+    )
+
+
+async def StageParse(job):
+    job.data["site"], job.data["summary"] = await asyncio.to_thread(
+        hampalyze_round_logs, *job.data["logFiles"]
+    )
+
+
+async def StageHLTV(job):
+    stats_channel = await client.fetch_channel(STATS_CHANNEL_ID)
+    job.data["zip"] = await asyncio.to_thread(
+        hltv_file_handler,
+        await JobStorage(job),
+        JobRounds(job),
+        limit=UploadLimit(stats_channel),
+        matchKey=JobMatch(job),
+    )
+
+
+async def StagePost(job):
+    stats_channel = await client.fetch_channel(STATS_CHANNEL_ID)
+    logs_link = job.data.get("site")
+    demoKey = job.data.get("zip")
+
+    await matchHistory.set_stats(JobMatch(job), logs_link, demoArchive.path(demoKey) if demoKey else None)
+    if demoKey is not None and demoArchive.path(demoKey) is not None:
+        if job.data.get("summary") is not None:
+            await stats_channel.send(job.data["summary"])
+        await SendDemos(stats_channel, demoKey, logs_link)
+    else:
+        await SendStats(stats_channel, logs_link, job.data.get("summary"))
+
+    if "rounds" in job.data:
+        with open("prevlog.json", "w") as f:
+            json.dump({"site": logs_link, "logFiles": [state[0] for state in job.data["rounds"]]}, f)
+
+    # this pickup's files are all in now
+    StopPrefetch()
+
+
+async def CloseJobConnections(job):
+    store = job.local.pop("storage", None)
+    if store is not None:
+        JobServer(job).files.release(store, reuse=job.error is None)
+
+
+statsPipeline = statspipeline.StatsPipeline(
+    [
+        ("connect", StageConnect),
+        ("settle", StageSettle),
+        ("rounds", StageRounds),
+        ("logs", StageFetchLogs),
+        ("parse", StageParse),
+        ("hltv", StageHLTV),
+        ("post", StagePost),
+    ],
+    cleanup=CloseJobConnections,
+    observe=lambda stage, seconds, failed: perfMetrics.observe(
+        "stats_stage_seconds", seconds, stage=stage, failed=failed
+    ),
+)
+
+
+def SubmitStats(reason, **data):
+    # the job is for the pickup that just ended: pin it now, a new pickup may be recorded before it runs
+    match = matchHistory.last_match()
+    if match is not None:
+        data.update(match=match["id"], map=match["map"], server=match["server"])
+    return statsPipeline.submit(reason, **data)
+
+
+class BotMessageProtocol(asyncio.DatagramProtocol):
+    # server events forwarded by serverComms.py: wire.py frames (acked, so serverComms retransmits a
+    # lost END) or the old BOT_MSG@TYPE text
+    def connection_made(self, transport):
+        self.transport = transport
+        self.links = {}
+
+    def link(self, addr):
+        if addr not in self.links:
+            self.links[addr] = wire.Link(self.transport.sendto, addr)
+        return self.links[addr]
+
+    def datagram_received(self, data, addr):
+        if wire.is_frame(data):
+            try:
+                messages = self.link(addr).receive(data)
+            except wire.FrameError as e:
+                logging.warning("bad frame from %s:%d: %s" % (addr[0], addr[1], e))
+                return
+        else:
+            legacy = wire.legacy_decode(data)
+            messages = [] if legacy is None else [(legacy[0], "@".join(legacy[1]))]
+
+        for msgType, _ in messages:
+            if msgType == "END":
+                if SubmitStats("END", settle=True) is None:
+                    print("stats job already running, ignoring END")
+
+
+botMessages = None  # the BotMessageProtocol on BOT_PORT, once setup_hook has started it
+
+
+# retrieve the last pickup's logs from the game server and get hampalyzer link
 @client.command(
     name="stats", help="Hamaplyze most recent pair of large log files from FTP."
 )
 @commands.cooldown(1, 30, commands.BucketType.user)
 async def get_logs(ctx):
-    # Connect to FTP using info from .env file
-    # Check if the server connection uses SFTP or FTP
-    stats_channel = await client.fetch_channel(1249752385476235376)
-    try:
-        ssh_client = paramiko.SSHClient()
-        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh_client.connect(
-            hostname=os.getenv("FTP_SERVER"),
-            port=22,
-            username=os.getenv("FTP_USER"),
-            password=os.getenv("FTP_PASSWD"),
-        )
-        logs_link = hampalyze_logs_sftp(ssh_client)
-        output_zipfile = hltv_file_handler(ssh_client)
-        if output_zipfile is not None:
-            await stats_channel.send(file=discord.File(output_zipfile), content=logs_link)
-            os.remove(output_zipfile)
-        ssh_client.close()
-    except paramiko.ssh_exception.NoValidConnectionsError:
-        # Assumption: If SFTP connection failed, try FTP instead
-        logs_link = hampalyze_logs()
-        await stats_channel.send(logs_link)
-    except paramiko.ssh_exception.AuthenticationException:
-        logs_link = hampalyze_logs()
-        await stats_channel.send(logs_link)
-    """if output_zipfile is not None:
-        await stats_channel.send(file=discord.File(output_zipfile), content=logs_link)
-        os.remove(output_zipfile)
+    if SubmitStats("!stats") is None:
+        await ctx.send("Stats are already being fetched, they'll show up in <#%d>." % STATS_CHANNEL_ID)
     else:
-        await stats_channel.send(logs_link)
-    """
+        await ctx.send("Fetching stats, they'll show up in <#%d>." % STATS_CHANNEL_ID)
+
+@client.event
+async def setup_hook():
+    global botMessages
+
+    # put back the pickup (and re-attach the vote buttons) that was running when the bot went down
+    restored = RestorePickupState()
+    if restored is not None and restored["channelId"] is not None:
+        try:
+            await client.get_partial_messageable(restored["channelId"]).send(
+                "Bot restarted; pickup restored (%d/%d players%s)."
+                % (
+                    len(playerList),
+                    playerNumber,
+                    ", map vote still open" if restored["phase"] == "voting" else "",
+                )
+            )
+        except discord.HTTPException:
+            logging.warning("couldn't announce the restored pickup")
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, lambda sig=sig: asyncio.ensure_future(Shutdown(sig.name)))
+
+    statsPipeline.start()
+    metrics.instrument_http(perfMetrics, client.http)
+    perfMetrics.gauge("prefetch_bytes", lambda: prefetcher.stats.get("bytes", 0))
+    perfMetrics.gauge("stats_jobs_pending", lambda: len(statsPipeline.pending))
+    loopWatchdog.start()
+    if len(serverRegistry.servers) > 1:
+        serverprobe.start()
+    if METRICS_PORT:
+        await perfMetrics.serve(int(METRICS_PORT))
+    if DEMO_HTTP_PORT:
+        await demoArchive.serve(int(DEMO_HTTP_PORT))
+    _, botMessages = await asyncio.get_running_loop().create_datagram_endpoint(
+        BotMessageProtocol, local_addr=("0.0.0.0", BOT_PORT)
+    )
+
+
+# pm2 sends SIGINT on restart and SIGKILLs after --kill-timeout (15s in deploy.yml); stay well inside it
+DRAIN_SECONDS = 10
+shuttingDown = False
+
+
+async def Shutdown(reason):
+    global shuttingDown
+
+    if shuttingDown:
+        return
+    shuttingDown = True
+    start = time.perf_counter()
+    logging.info("%s: shutting down" % reason)
+
+    # the pickup comes back from this on the next start
+    await FlushPickupState()
+    saved = time.perf_counter()
+
+    for loop in (livescore, prefetchloop, serverprobe):
+        if loop.is_running():
+            loop.cancel()
+    pickupTimers.close()
+    if liveTailer is not None:
+        liveTailer.close()
+    prefetcher.close()
+    if botMessages is not None:
+        for link in botMessages.links.values():
+            link.close()
+
+    # let a running stats stage finish; anything left resumes from its saved stage after the restart
+    drained = await statsPipeline.drain(DRAIN_SECONDS)
+    await asyncio.to_thread(matchHistory.close)
+    for server in serverRegistry.servers:
+        await asyncio.to_thread(server.files.close)
+    loopWatchdog.stop()
+
+    logging.info(
+        "shutdown in %.2fs (pickup snapshot %.2f ms, stats %s)"
+        % (
+            time.perf_counter() - start,
+            (saved - start) * 1000,
+            "drained" if drained else "cut off, will resume",
+        )
+    )
+    await client.close()
+
+
+readyReported = False
+
 
 @client.event
 async def on_ready():
+    global readyReported
+
     print(f"{client.user} is aliiiiiive!")
+    if readyReported:
+        return  # reconnected
+    readyReported = True
+
+    ready = time.perf_counter()
+    logging.info(
+        "ready in %.2fs: imports %.2fs, state %.3fs, login/connect %.2fs"
+        % (ready - STARTED, IMPORTED - STARTED, STATE_LOADED - IMPORTED, ready - STATE_LOADED)
+    )
+    perfMetrics.gauge("time_to_ready_seconds", lambda: round(ready - STARTED, 3))
+
+    # work out SFTP/FTP/local (and import paramiko) before the first !stats/!hltv needs it, without
+    # holding up startup
+    await asyncio.gather(
+        *(asyncio.to_thread(server.files.storage.detect) for server in serverRegistry.servers)
+    )
+
+@client.command(pass_context=True)
+@commands.has_role("admin")
+async def perf(ctx):
+    if not perfMetrics.enabled:
+        await ctx.send("Metrics are off; set METRICS=1 to turn them on.")
+        return
+    await ctx.send(perfMetrics.summary())
+
 
 @client.command(pass_context=True)
 @commands.has_role("admin")
-async def reboot(ctx):
-    """Reboot the Vultr instance. Admin only command."""
+async def reboot(ctx, name=None):
+    """Reboot a game server's Vultr instance (the last pickup's, or the one named). Admin only command."""
     if ctx.channel.name != CHANNEL_NAME:
         return
 
+    server = serverRegistry.get(name) if name is not None else LastMatchServer()
+    if server is None:
+        await ctx.send("No server called %s; try %s." % (name, ", ".join(s.name for s in serverRegistry.servers)))
+        return
+    if server.vultrId is None:
+        await ctx.send("No Vultr instance configured for %s." % server.name)
+        return
+
     vultr_api_key = os.getenv("VULTR_API_KEY")
-    instance_id = "4ba36623-81ab-4b99-815b-922598d0b8a8"
+    instance_id = server.vultrId
     
     headers = {
         "Authorization": f"Bearer {vultr_api_key}",
@@ -1048,6 +1947,8 @@ async def reboot(ctx):
         "instance_ids": [instance_id]
     }
 
+    import urllib.request
+
     try:
         response = urllib.request.Request(
             "https://api.vultr.com/v2/instances/reboot",
@@ -1056,13 +1957,22 @@ async def reboot(ctx):
             method='POST'
         )
         
-        with urllib.request.urlopen(response) as f:
-            if f.status == 204:  # Successful reboot returns 204 No Content
-                await ctx.send("🔄 Server reboot initiated successfully!")
-            else:
-                await ctx.send(f"❌ Reboot failed with status code: {f.status}")
+        status = await asyncio.to_thread(RequestStatus, response)
+        if status == 204:  # Successful reboot returns 204 No Content
+            await ctx.send("🔄 Server reboot of %s initiated successfully!" % server.name)
+        else:
+            await ctx.send(f"❌ Reboot failed with status code: {status}")
     except Exception as e:
         await ctx.send(f"❌ Error rebooting server: {str(e)}")
 
 
-client.run(TOKEN)
+def RequestStatus(request):
+    import urllib.request
+
+    with urllib.request.urlopen(request, timeout=30) as f:
+        return f.status
+
+
+# imported (rather than run) by simulate.py
+if __name__ == "__main__":
+    client.run(TOKEN)
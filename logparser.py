@@ -0,0 +1,231 @@
+#!/usr/bin/python3
+
+# Local stats from HL/TFC server logs, so !stats still says something when tfcstats is slow or down.
+#
+# Logs are read line by line (never whole files). Each line is dispatched on a cheap substring
+# check to one compiled regex, and per-player totals are accumulated as we go.
+
+import re
+import time
+
+LINE_PREFIX_LEN = len("L 10/19/2024 - 20:01:02: ")
+
+# "Name<uid><STEAM_0:1:234><Blue>"
+PLAYER = r'"(?P<{0}name>.*?)<(?P<{0}uid>-?\d+)><(?P<{0}steam>[^>]*)><(?P<{0}team>[^>]*)>"'
+
+KILL_RE = re.compile(PLAYER.format("a") + r' killed ' + PLAYER.format("v") + r' with "(?P<weapon>[^"]*)"')
+ATTACK_RE = re.compile(
+    PLAYER.format("a") + r' attacked ' + PLAYER.format("v") + r' with "[^"]*" \(damage "(?P<damage>\d+)"\)'
+)
+SUICIDE_RE = re.compile(PLAYER.format("a") + r' committed suicide with "(?P<weapon>[^"]*)"')
+TRIGGER_RE = re.compile(PLAYER.format("a") + r' triggered "(?P<event>[^"]*)"')
+TEAM_RE = re.compile(PLAYER.format("a") + r' joined team "(?P<newteam>[^"]*)"')
+ROLE_RE = re.compile(PLAYER.format("a") + r' changed role to "(?P<role>[^"]*)"')
+MAP_RE = re.compile(r'(?:Loading|Started) map "(?P<map>[^"]*)"')
+
+# flag events are map-specific goal names; these cover the usual TFC naming
+CAP_RE = re.compile(r"cap|dropoff|score", re.I)
+TOUCH_RE = re.compile(r"flag|pickup|item_tfgoal", re.I)
+
+
+class PlayerStats:
+    __slots__ = (
+        "name", "team", "roles", "kills", "deaths", "teamkills", "suicides",
+        "caps", "touches", "damage", "damageTaken",
+    )
+
+    def __init__(self, name):
+        self.name = name
+        self.team = None
+        self.roles = []
+        self.kills = 0
+        self.deaths = 0
+        self.teamkills = 0
+        self.suicides = 0
+        self.caps = 0
+        self.touches = 0
+        self.damage = 0
+        self.damageTaken = 0
+
+
+class LogStats:
+    def __init__(self):
+        self.players = {}
+        self.maps = []
+        self.lines = 0
+
+    def player(self, match, prefix):
+        # bots and listen-server players have no steam id; fall back to the name
+        steam = match.group(prefix + "steam")
+        name = match.group(prefix + "name")
+        key = steam if steam.startswith("STEAM_") else name
+        stats = self.players.get(key)
+        if stats is None:
+            stats = self.players[key] = PlayerStats(name)
+        else:
+            stats.name = name
+        team = match.group(prefix + "team")
+        if team:
+            stats.team = team
+        return stats
+
+    def feed_line(self, line):
+        self.lines += 1
+        body = line[LINE_PREFIX_LEN:]
+
+        if " killed " in body:
+            m = KILL_RE.match(body)
+            if m:
+                attacker = self.player(m, "a")
+                victim = self.player(m, "v")
+                victim.deaths += 1
+                if m.group("ateam") and m.group("ateam") == m.group("vteam"):
+                    attacker.teamkills += 1
+                else:
+                    attacker.kills += 1
+            return
+
+        if " attacked " in body:
+            m = ATTACK_RE.match(body)
+            if m:
+                damage = int(m.group("damage"))
+                self.player(m, "a").damage += damage
+                self.player(m, "v").damageTaken += damage
+            return
+
+        if " triggered " in body:
+            m = TRIGGER_RE.match(body)
+            if m:
+                event = m.group("event")
+                if CAP_RE.search(event):
+                    self.player(m, "a").caps += 1
+                elif TOUCH_RE.search(event):
+                    self.player(m, "a").touches += 1
+            return
+
+        if " committed suicide " in body:
+            m = SUICIDE_RE.match(body)
+            if m:
+                stats = self.player(m, "a")
+                stats.suicides += 1
+                stats.deaths += 1
+            return
+
+        if " changed role to " in body:
+            m = ROLE_RE.match(body)
+            if m:
+                stats = self.player(m, "a")
+                role = m.group("role")
+                if role not in stats.roles:
+                    stats.roles.append(role)
+            return
+
+        if " joined team " in body:
+            m = TEAM_RE.match(body)
+            if m:
+                self.player(m, "a").team = m.group("newteam")
+            return
+
+        if " map " in body:
+            m = MAP_RE.match(body)
+            if m:
+                self.maps.append(m.group("map"))
+
+    def feed_file(self, path):
+        with open(path, "rb") as f:
+            for raw in f:
+                self.feed_line(raw.decode("utf-8", "replace"))
+        return self
+
+
+def parse_logs(paths):
+    """Totals over all the given logs (e.g. both rounds of a pickup)."""
+    stats = LogStats()
+    for path in paths:
+        stats.feed_file(path)
+    return stats
+
+
+def format_summary(stats, limit=1900):
+    players = [p for p in stats.players.values() if p.kills or p.deaths or p.damage or p.caps]
+    players.sort(key=lambda p: (p.team or "", -p.kills))
+
+    header = "%-16s %-5s %4s %4s %3s %4s %4s %6s" % ("player", "team", "K", "D", "TK", "caps", "flag", "dmg")
+    lines = [header]
+    for p in players:
+        lines.append(
+            "%-16s %-5s %4d %4d %3d %4d %4d %6d"
+            % (p.name[:16], (p.team or "")[:5], p.kills, p.deaths, p.teamkills, p.caps, p.touches, p.damage)
+        )
+
+    title = "Local stats" + (" (%s)" % stats.maps[0] if stats.maps else "")
+    text = title + "\n```\n"
+    for line in lines:
+        if len(text) + len(line) + 4 > limit:
+            break
+        text += line + "\n"
+    return text + "```"
+
+
+def write_synthetic_log(path, megabytes=50):
+    import random
+
+    rng = random.Random(3)
+    names = ["player%02d" % i for i in range(16)]
+    players = [
+        '"%s<%d><STEAM_0:%d:%d><%s>"' % (name, i + 1, i % 2, 10000 + i, "Blue" if i < 8 else "Red")
+        for i, name in enumerate(names)
+    ]
+    templates = [
+        lambda a, b: '%s killed %s with "rocket"' % (a, b),
+        lambda a, b: '%s attacked %s with "rocket" (damage "%d")' % (a, b, rng.randint(10, 120)),
+        lambda a, b: '%s attacked %s with "shotgun" (damage "%d")' % (a, b, rng.randint(5, 40)),
+        lambda a, b: '%s triggered "Blue Flag"' % a,
+        lambda a, b: '%s triggered "Team 1 dropoff"' % a,
+        lambda a, b: '%s changed role to "Soldier"' % a,
+        lambda a, b: '%s say "gg"' % a,
+    ]
+
+    target = megabytes * 1024 * 1024
+    written = 0
+    with open(path, "w") as f:
+        f.write('L 10/19/2024 - 20:00:00: Loading map "2fort"\n')
+        while written < target:
+            a, b = rng.sample(players, 2)
+            line = "L 10/19/2024 - 20:%02d:%02d: %s\n" % (
+                rng.randint(0, 59), rng.randint(0, 59), rng.choice(templates)(a, b)
+            )
+            f.write(line)
+            written += len(line)
+
+
+def benchmark(megabytes=50):
+    import os
+    import resource
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "synthetic.log")
+        write_synthetic_log(path, megabytes)
+        rssBefore = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        start = time.perf_counter()
+        stats = parse_logs([path])
+        elapsed = time.perf_counter() - start
+
+        rssAfter = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print(
+            "%d MB, %d lines in %.2f s: %.0f lines/s, %.1f MB/s"
+            % (megabytes, stats.lines, elapsed, stats.lines / elapsed, megabytes / elapsed)
+        )
+        print("peak RSS %.1f MB (grew %.1f MB while parsing)" % (rssAfter / 1024, (rssAfter - rssBefore) / 1024))
+        print(format_summary(stats))
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) > 1:
+        print(format_summary(parse_logs(sys.argv[1:])))
+    else:
+        benchmark()
@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+
+# Follows the game server's current log and keeps a live scoreboard, over whichever storage backend
+# the server's files are read with (see storage.py).
+#
+# Only the bytes appended since the last poll are read (by offset), so a poll costs one stat and
+# one small read. Over SFTP the log stays open between polls; other backends open it again for each
+# read, since their handles don't see appended data (a local mmap has the size it was opened with).
+# An FTP server without REST sends the log from the start on every read, so live score works there
+# but costs more the longer the game runs. The log directory is re-listed every so often to notice
+# the server starting a new log file (map change), and a dropped connection is re-opened at the
+# same offset.
+
+import logging
+import posixpath
+import time
+
+import logparser
+
+
+class LogTailer:
+    def __init__(self, connect, logDir=None, listInterval=15):
+        self.connect = connect  # returns a connected storage backend
+        self.logDir = logDir  # None: the backend's "logs" directory
+        self.listInterval = listInterval
+
+        self.stats = logparser.LogStats()
+        self.current = None
+        self.offset = 0
+        self.bytesRead = 0
+        self.reconnects = 0
+        self.lastData = time.monotonic()
+
+        self._store = None
+        self._file = None
+        self._partial = b""
+        self._lastList = 0
+
+    def close(self):
+        for handle in (self._file, self._store):
+            if handle is not None:
+                try:
+                    handle.close()
+                except Exception:
+                    pass
+        self._file = self._store = None
+
+    def poll(self):
+        """Read whatever was appended since the last poll; returns the number of new lines. Blocking."""
+        try:
+            return self._poll()
+        except Exception as e:
+            # keep current/offset so the next poll picks up where this one stopped
+            logging.warning("log tail on %s failed, reconnecting next poll: %s" % (self.current, e))
+            self.close()
+            self.reconnects += 1
+            return 0
+
+    def _poll(self):
+        if self._store is None:
+            self._store = self.connect()
+
+        now = time.monotonic()
+        newLines = 0
+        if self.current is None or now - self._lastList >= self.listInterval:
+            self._lastList = now
+            newest = self._newest_log()
+            if newest is not None and newest != self.current:
+                if self.current is not None:
+                    newLines += self._read_new()  # finish the old log before moving on
+                self._switch(newest)
+
+        if self.current is None:
+            return newLines
+        newLines += self._read_new()
+        if newLines:
+            self.lastData = now
+        return newLines
+
+    def _newest_log(self):
+        logs = [a for a in self._store.listdir_attr(self._dir()) if a.filename.endswith(".log")]
+        if not logs:
+            return None
+        return max(logs, key=lambda a: (a.st_mtime, a.filename)).filename
+
+    def _dir(self):
+        return self.logDir if self.logDir is not None else self._store.dirs["logs"]
+
+    def _switch(self, name):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.current = name
+        self.offset = 0
+        self._partial = b""
+        self.stats = logparser.LogStats()
+
+    def _read_new(self):
+        path = posixpath.join(self._dir(), self.current)
+        follow = "follow" in self._store.features
+        if follow:
+            if self._file is None:
+                self._file = self._store.open(path, "rb")
+            size = self._file.stat().st_size
+        else:
+            size = self._store.stat(path).st_size
+        if size < self.offset:
+            # same name but shorter: the file was replaced, start it over
+            self.offset = 0
+            self._partial = b""
+            self.stats = logparser.LogStats()
+        if size == self.offset:
+            return 0
+
+        if follow:
+            self._file.seek(self.offset)
+            data = self._file.read(size - self.offset)
+        else:
+            with self._store.open(path, "rb") as f:
+                f.seek(self.offset)
+                data = f.read(size - self.offset)
+        self.offset += len(data)
+        self.bytesRead += len(data)
+
+        lines = (self._partial + data).split(b"\n")
+        self._partial = lines.pop()  # last piece is an unfinished line
+        for line in lines:
+            self.stats.feed_line(line.decode("utf-8", "replace"))
+        return len(lines)
+
+    def scoreboard(self):
+        return logparser.format_summary(self.stats).replace("Local stats", "Live score", 1)
@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+
+# Notices when something blocks the event loop, and says what.
+#
+# A task on the loop records a heartbeat every few tens of milliseconds. A separate thread checks
+# the heartbeat; if it is older than the threshold, the loop thread is stuck in something
+# synchronous, so the thread grabs the loop thread's current stack (sys._current_frames) while it's
+# still stuck and logs it along with the command being run, found by looking for a discord.py
+# ctx/interaction in the stack's locals. When the loop wakes up the stall's full length is filled in.
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+
+STALL_THRESHOLD = 0.25
+BEAT_INTERVAL = 0.05
+STACK_FRAMES = 8  # innermost frames kept per stall
+
+
+class Stall:
+    def __init__(self, command, stack):
+        self.started = time.time()
+        self.seconds = None  # filled in once the loop runs again
+        self.command = command
+        self.stack = stack
+
+    def __str__(self):
+        return "loop blocked %s by %s at:\n%s" % (
+            "%.0f ms" % (1000 * self.seconds) if self.seconds is not None else "(ongoing)",
+            self.command or "unknown",
+            "".join(self.stack).rstrip(),
+        )
+
+
+def command_of(frame):
+    """Name of the command or interaction whose handler is somewhere in frame's call stack."""
+    while frame is not None:
+        local = frame.f_locals
+        ctx = local.get("ctx")
+        if ctx is not None and getattr(ctx, "command", None) is not None:
+            return "!" + ctx.command.qualified_name
+        interaction = local.get("interaction")
+        if interaction is not None:
+            data = getattr(interaction, "data", None) or {}
+            return "interaction %s" % data.get("custom_id", "")
+        frame = frame.f_back
+    return None
+
+
+class LoopWatchdog:
+    def __init__(self, threshold=STALL_THRESHOLD, interval=BEAT_INTERVAL, metrics=None):
+        self.threshold = threshold
+        self.interval = interval
+        self.metrics = metrics  # loop lag and stalls go here too, when given
+        self.stalls = []  # newest last, capped
+        self.worstLag = 0.0
+
+        self._lastBeat = None
+        self._loopThread = None
+        self._current = None  # stall being reported, until the loop wakes up
+        self._task = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """Start watching the running loop; call from a coroutine on it."""
+        self._loopThread = threading.get_ident()
+        self._lastBeat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.get_running_loop().create_task(self._beat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _beat(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - self._lastBeat - self.interval)
+            self._lastBeat = now
+            self.worstLag = max(self.worstLag, lag)
+            if self.metrics is not None:
+                self.metrics.observe("loop_lag_seconds", lag)
+
+            stall = self._current
+            if stall is not None:
+                self._current = None
+                stall.seconds = lag
+                logging.warning(str(stall))
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            if self._current is not None:
+                continue
+            if time.monotonic() - self._lastBeat - self.interval < self.threshold:
+                continue
+
+            frame = sys._current_frames().get(self._loopThread)
+            if frame is None:
+                continue
+            stall = Stall(command_of(frame), traceback.format_stack(frame)[-STACK_FRAMES:])
+            self._current = stall
+            self.stalls = (self.stalls + [stall])[-50:]
+            if self.metrics is not None:
+                self.metrics.inc("loop_stalls_total", command=stall.command or "unknown")
+
+
+async def measure(coro, budget=STALL_THRESHOLD):
+    """Run coro under its own watchdog; returns (worst loop lag in seconds, stalls over budget)."""
+    watchdog = LoopWatchdog(threshold=budget, interval=min(BEAT_INTERVAL, budget / 5))
+    watchdog.start()
+    try:
+        await coro
+        await asyncio.sleep(watchdog.interval * 2)  # let the beat catch up after a block at the very end
+    finally:
+        watchdog.stop()
+    return watchdog.worstLag, watchdog.stalls
+
+
+if __name__ == "__main__":
+    # Check the watchdog against stand-in handlers: one that blocks the loop the way timeleft's
+    # wait and hltv's download used to, and two that don't. Exits non-zero if it gets any wrong.
+
+    class Command:
+        qualified_name = "timeleft"
+
+    class Ctx:
+        command = Command()
+
+    async def blocking_handler(ctx):
+        time.sleep(0.4)
+
+    async def threaded_handler(ctx):
+        await asyncio.to_thread(time.sleep, 0.4)
+
+    async def sleeping_handler(ctx):
+        await asyncio.sleep(0.4)
+
+    async def main():
+        budget = 0.1
+        failures = 0
+        for handler, shouldBlock in (
+            (blocking_handler, True),
+            (threaded_handler, False),
+            (sleeping_handler, False),
+        ):
+            lag, stalls = await measure(handler(Ctx()), budget)
+            caught = bool(stalls)
+            print(
+                "%-18s worst lag %5.0f ms, %s"
+                % (handler.__name__, 1000 * lag, ("stall in %s" % stalls[0].command) if caught else "no stall")
+            )
+            if caught:
+                print("    " + stalls[0].stack[-1].strip().replace("\n", "\n    "))
+            if caught != shouldBlock or (caught and stalls[0].command != "!timeleft"):
+                failures += 1
+        return failures
+
+    sys.exit(1 if asyncio.run(main()) else 0)
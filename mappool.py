@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+
+# The map pool from maplist.json, parsed and validated once and cached until the file changes.
+# The pool is immutable (tuples and read-only mappings) so a pickup can hold on to it while
+# the file is being edited underneath.
+
+import json
+import logging
+import os
+
+from collections import namedtuple
+from types import MappingProxyType
+
+import mapselect
+
+MAPLIST_FILE = "maplist.json"
+DEFAULT_EXCLUDE_RECENT = 5
+MAX_SLOTS = 6  # 7 vote buttons, one of them is "New Maps" / the carried-over map
+
+MapPool = namedtuple("MapPool", ["tiers", "maps", "slots", "weights", "excludeRecent"])
+
+
+class MapPoolError(ValueError):
+    pass
+
+
+def parse_map_pool(config):
+    if not isinstance(config, dict) or not isinstance(config.get("tiers"), dict) or not config["tiers"]:
+        raise MapPoolError("maplist needs a non-empty \"tiers\" object")
+
+    tiers = {}
+    seen = set()
+    for tierName, maps in config["tiers"].items():
+        if not isinstance(maps, list) or not all(isinstance(m, str) and m for m in maps):
+            raise MapPoolError("tier %s must be a list of map names" % tierName)
+        duplicates = seen.intersection(maps)
+        if duplicates or len(set(maps)) != len(maps):
+            raise MapPoolError("tier %s repeats maps: %s" % (tierName, ", ".join(sorted(duplicates)) or tierName))
+        seen.update(maps)
+        tiers[tierName] = tuple(maps)
+
+    slots = {}
+    configSlots = config.get("slots", mapselect.DEFAULT_SLOTS)
+    for kind in ("initial", "reroll"):
+        template = configSlots.get(kind)
+        if not isinstance(template, list) or not 0 < len(template) <= MAX_SLOTS:
+            raise MapPoolError("slots.%s must list 1-%d slots" % (kind, MAX_SLOTS))
+        for slot in template:
+            if not isinstance(slot, list) or not slot or any(t not in tiers for t in slot):
+                raise MapPoolError("slots.%s has a slot with unknown tiers: %r" % (kind, slot))
+        slots[kind] = tuple(tuple(slot) for slot in template)
+
+    excludeRecent = config.get("excludeRecent", DEFAULT_EXCLUDE_RECENT)
+    # leave enough maps to fill both the first vote and a re-roll
+    maxExclude = len(seen) - len(slots["initial"]) - len(slots["reroll"])
+    if not isinstance(excludeRecent, int) or not 0 <= excludeRecent <= max(maxExclude, 0):
+        raise MapPoolError("excludeRecent must be between 0 and %d" % max(maxExclude, 0))
+
+    weights = config.get("weights", mapselect.DEFAULT_WEIGHTS)
+    _check_weights(weights)
+
+    return MapPool(
+        tiers=MappingProxyType(tiers),
+        maps=frozenset(seen),
+        slots=MappingProxyType(slots),
+        weights=MappingProxyType(weights),
+        excludeRecent=excludeRecent,
+    )
+
+
+def _number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _check_weights(weights):
+    # what mapselect.map_weights reads; a section left out (or null) turns that weighting off
+    if not isinstance(weights, dict):
+        raise MapPoolError("weights must be an object")
+    unknown = set(weights) - {"recency", "popularity"}
+    if unknown:
+        raise MapPoolError("weights has unknown sections: %s" % ", ".join(sorted(unknown)))
+
+    recency = weights.get("recency")
+    if recency:
+        if not isinstance(recency, dict) or "window" not in recency or "penalty" not in recency:
+            raise MapPoolError("weights.recency needs \"window\" and \"penalty\"")
+        window = recency["window"]
+        if not isinstance(window, int) or isinstance(window, bool) or window <= 0:
+            raise MapPoolError("weights.recency.window must be a whole number above 0")
+        if not _number(recency["penalty"]) or not 0 <= recency["penalty"] <= 1:
+            raise MapPoolError("weights.recency.penalty must be between 0 and 1")
+
+    popularity = weights.get("popularity")
+    if popularity:
+        if not isinstance(popularity, dict) or "penalty" not in popularity:
+            raise MapPoolError("weights.popularity needs \"penalty\"")
+        if not _number(popularity["penalty"]) or popularity["penalty"] < 0:
+            raise MapPoolError("weights.popularity.penalty must be 0 or more")
+
+
+def eligible_tiers(pool, recentMaps):
+    """The pool's tiers minus the recently played maps."""
+    excluded = pool.maps.intersection(recentMaps)
+    if not excluded:
+        return pool.tiers
+    return {
+        tierName: tuple(m for m in maps if m not in excluded)
+        for tierName, maps in pool.tiers.items()
+    }
+
+
+class MapPoolCache:
+    def __init__(self, path=MAPLIST_FILE):
+        self.path = path
+        self._pool = None
+        self._mtime = None
+
+    def get(self):
+        """Current pool; re-parsed only if the file's mtime changed. A broken edit, or the file going
+        missing (e.g. mid-rename), keeps the old pool."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            if self._pool is None:
+                raise
+            if self._mtime is not None:  # warn once, not on every !pickup while it's gone
+                logging.warning("can't read %s, keeping previous map pool: %s" % (self.path, e))
+            self._mtime = None
+            return self._pool
+        if mtime == self._mtime:
+            return self._pool
+
+        try:
+            with open(self.path, "r") as f:
+                pool = parse_map_pool(json.load(f))
+        except (ValueError, OSError) as e:
+            if self._pool is None:
+                raise
+            logging.warning("ignoring invalid %s, keeping previous map pool: %s" % (self.path, e))
+            self._mtime = mtime
+            return self._pool
+
+        logging.info("loaded map pool: %d maps in %d tiers" % (len(pool.maps), len(pool.tiers)))
+        self._pool = pool
+        self._mtime = mtime
+        return pool
@@ -0,0 +1,304 @@
+#!/usr/bin/python3
+
+# Map selection for the map vote.
+#
+# Each vote is drawn from a slot template declared in maplist.json: a list of slots, each slot
+# naming the tiers it may pick from. Picks are weighted (recently played and very popular maps
+# are less likely) and made without replacement: a map that has been offered is removed from
+# its tier in O(1) so it can't come up again for the rest of the pickup.
+
+import random
+import time
+
+DEFAULT_SLOTS = {
+    "initial": [
+        ["tier1", "tier2"],
+        ["tier2", "tier3"],
+        ["tier3"],
+        ["tier1", "tier2"],
+        ["tier2", "tier3"],
+        ["tier3"],
+    ],
+    "reroll": [
+        ["tier1", "tier2"],
+        ["tier1", "tier2"],
+        ["tier1", "tier2"],
+        ["tier1", "tier2"],
+        ["tier1", "tier2", "tier3"],
+        ["tier1", "tier2", "tier3"],
+    ],
+}
+
+DEFAULT_WEIGHTS = {
+    # maps played within the last `window` pickups lose up to `penalty` of their weight,
+    # the most recent one the most
+    "recency": {"window": 10, "penalty": 0.5},
+    # maps played more than average lose weight in proportion to how much more
+    "popularity": {"penalty": 0.25},
+}
+
+
+def map_weights(mapNames, recentMaps=(), playCounts=None, config=None):
+    """Weight per map from recency (oldest-first list of played maps) and all-time play counts."""
+    config = config or DEFAULT_WEIGHTS
+    weights = {mapName: 1.0 for mapName in mapNames}
+
+    recency = config.get("recency")
+    if recency and recentMaps:
+        window = recency["window"]
+        penalty = recency["penalty"]
+        lastPlayed = {}
+        for age, mapName in enumerate(reversed(list(recentMaps)[-window:])):
+            lastPlayed.setdefault(mapName, age)
+        for mapName, age in lastPlayed.items():
+            if mapName in weights:
+                weights[mapName] *= 1.0 - penalty * (window - age) / window
+
+    popularity = config.get("popularity")
+    if popularity and playCounts:
+        counts = [playCounts.get(mapName, 0) for mapName in weights]
+        meanCount = sum(counts) / len(counts) if counts else 0
+        if meanCount > 0:
+            for mapName in weights:
+                weights[mapName] /= 1.0 + popularity["penalty"] * playCounts.get(mapName, 0) / meanCount
+
+    return weights
+
+
+class MapSelector:
+    def __init__(self, tiers, weights=None):
+        weights = weights or {}
+        self._tiers = {}  # tier -> list of maps still available
+        self._pos = {}  # map -> (tier, index into that tier's list)
+        self._weights = {}
+        self._tierTotals = {}
+
+        for tierName, maps in tiers.items():
+            available = []
+            for mapName in maps:
+                if mapName in self._pos:
+                    continue
+                self._pos[mapName] = (tierName, len(available))
+                self._weights[mapName] = max(float(weights.get(mapName, 1.0)), 0.0)
+                available.append(mapName)
+            self._tiers[tierName] = available
+            self._tierTotals[tierName] = sum(self._weights[m] for m in available)
+
+    def __contains__(self, mapName):
+        return mapName in self._pos
+
+    def __len__(self):
+        return len(self._pos)
+
+    def remove(self, mapName):
+        # swap the last map of the tier into the removed slot
+        if mapName not in self._pos:
+            return
+        tierName, idx = self._pos.pop(mapName)
+        available = self._tiers[tierName]
+        last = available.pop()
+        if last != mapName:
+            available[idx] = last
+            self._pos[last] = (tierName, idx)
+
+        if available:
+            self._tierTotals[tierName] -= self._weights[mapName]
+        else:
+            self._tierTotals[tierName] = 0.0  # don't let float error leave a ghost weight
+
+    def pick(self, tierNames, rng=random):
+        """Weighted pick of one map from the union of the given tiers; removes it. None if empty."""
+        tierNames = [t for t in tierNames if self._tiers.get(t)]
+        total = sum(self._tierTotals[t] for t in tierNames)
+        if total <= 0:
+            # every candidate has zero weight; fall back to uniform
+            candidates = [m for t in tierNames for m in self._tiers[t]]
+            if not candidates:
+                return None
+            choice = rng.choice(candidates)
+            self.remove(choice)
+            return choice
+
+        r = rng.random() * total
+        choice = None
+        for tierName in tierNames:
+            tierTotal = self._tierTotals[tierName]
+            if r >= tierTotal:
+                r -= tierTotal
+                continue
+            for mapName in self._tiers[tierName]:
+                choice = mapName
+                r -= self._weights[mapName]
+                if r < 0:
+                    break
+            break
+
+        if choice is None:
+            # r landed past the end through float error
+            choice = self._tiers[tierNames[-1]][-1]
+        self.remove(choice)
+        return choice
+
+    def draw(self, template, rng=random):
+        """One map per slot of the template; slots whose tiers are exhausted are skipped."""
+        picks = []
+        for tierNames in template:
+            mapName = self.pick(tierNames, rng)
+            if mapName is not None:
+                picks.append(mapName)
+        return picks
+
+
+def _naive_draw(tiers, template, rng):
+    # reference implementation: rebuild the candidate list for every slot, like the old PickMaps
+    tiers = {name: list(maps) for name, maps in tiers.items()}
+    picks = []
+    for tierNames in template:
+        candidates = [m for t in tierNames for m in tiers[t]]
+        if not candidates:
+            continue
+        mapName = rng.choice(candidates)
+        for maps in tiers.values():
+            if mapName in maps:
+                maps.remove(mapName)
+        picks.append(mapName)
+    return picks
+
+
+def check_distribution(tiers, template, draws=1000000, seed=1):
+    """Chi-square comparison of per-slot map frequencies against the naive reference sampler."""
+    rng = random.Random(seed)
+    mapNames = [m for maps in tiers.values() for m in maps]
+
+    def counts(drawFn):
+        table = [dict.fromkeys(mapNames, 0) for _ in template]
+        for _ in range(draws):
+            for slot, mapName in enumerate(drawFn()):
+                table[slot][mapName] += 1
+        return table
+
+    selectorCounts = counts(lambda: MapSelector(tiers).draw(template, rng))
+    naiveCounts = counts(lambda: _naive_draw(tiers, template, rng))
+
+    ok = True
+    for slot in range(len(template)):
+        chi2 = 0.0
+        dof = -1
+        for mapName in mapNames:
+            a = selectorCounts[slot][mapName]
+            b = naiveCounts[slot][mapName]
+            if a + b == 0:
+                continue
+            chi2 += (a - b) ** 2 / (a + b)
+            dof += 1
+        # roughly the 99.99th percentile of chi-square for this many degrees of freedom
+        limit = dof + 4 * (2 * dof) ** 0.5 + 10
+        print("slot %d: chi2 %.1f (dof %d, limit %.1f)" % (slot + 1, chi2, dof, limit))
+        ok = ok and chi2 < limit
+    return ok
+
+
+def exact_slot_probabilities(tiers, template, weights):
+    """Probability of each map in each slot under sequential weighted sampling without replacement,
+    by walking every possible draw. Only feasible for small pools."""
+    table = [{} for _ in template]
+    available = {}
+    for tierName, maps in tiers.items():
+        available[tierName] = [m for m in maps if not any(m in other for other in available.values())]
+
+    def walk(slot, taken, prob):
+        if slot == len(template):
+            return
+        candidates = [m for t in template[slot] for m in available.get(t, ()) if m not in taken]
+        if not candidates:
+            walk(slot + 1, taken, prob)
+            return
+        slotWeights = [max(float(weights.get(m, 1.0)), 0.0) for m in candidates]
+        total = sum(slotWeights)
+        if total <= 0:
+            slotWeights, total = [1.0] * len(candidates), float(len(candidates))
+        for mapName, weight in zip(candidates, slotWeights):
+            if weight > 0:
+                p = prob * weight / total
+                table[slot][mapName] = table[slot].get(mapName, 0.0) + p
+                walk(slot + 1, taken | {mapName}, p)
+
+    walk(0, frozenset(), 1.0)
+    return table
+
+
+def check_weighted(draws=200000, seed=3):
+    """Chi-square check of MapSelector's weighted draws against the exact per-slot probabilities,
+    on a small pool with recency and popularity weights applied."""
+    tiers = {
+        "tier1": ["2fort", "well", "rock2"],
+        "tier2": ["avanti", "badlands"],
+        "tier3": ["cz2", "hunted", "dustbowl"],
+    }
+    template = [["tier1", "tier2"], ["tier2", "tier3"], ["tier3"], ["tier1", "tier2", "tier3"]]
+    mapNames = [m for maps in tiers.values() for m in maps]
+    weights = map_weights(
+        mapNames, recentMaps=["cz2", "well", "2fort"], playCounts={"2fort": 40, "avanti": 10, "hunted": 2}
+    )
+    expected = exact_slot_probabilities(tiers, template, weights)
+
+    rng = random.Random(seed)
+    observed = [dict.fromkeys(mapNames, 0) for _ in template]
+    for _ in range(draws):
+        for slot, mapName in enumerate(MapSelector(tiers, weights).draw(template, rng)):
+            observed[slot][mapName] += 1
+
+    ok = True
+    for slot in range(len(template)):
+        chi2 = 0.0
+        dof = -1
+        for mapName in mapNames:
+            e = expected[slot].get(mapName, 0.0) * draws
+            if e == 0:
+                ok = ok and observed[slot][mapName] == 0  # a map that can't come up here never does
+                continue
+            chi2 += (observed[slot][mapName] - e) ** 2 / e
+            dof += 1
+        limit = dof + 4 * (2 * dof) ** 0.5 + 10
+        print("weighted slot %d: chi2 %.1f (dof %d, limit %.1f)" % (slot + 1, chi2, dof, limit))
+        ok = ok and chi2 < limit
+    return ok
+
+
+def benchmark(tiers, template, iterations=100000):
+    rng = random.Random(2)
+    weights = map_weights([m for maps in tiers.values() for m in maps])
+
+    start = time.perf_counter()
+    selectors = [MapSelector(tiers, weights) for _ in range(iterations)]
+    buildTime = (time.perf_counter() - start) / iterations
+
+    start = time.perf_counter()
+    for selector in selectors:
+        selector.draw(template, rng)
+    selectorTime = (time.perf_counter() - start) / iterations
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        _naive_draw(tiers, template, rng)
+    naiveTime = (time.perf_counter() - start) / iterations
+
+    print(
+        "MapSelector: %.1f us to build, %.1f us per weighted vote; naive: %.1f us per vote"
+        % (buildTime * 1e6, selectorTime * 1e6, naiveTime * 1e6)
+    )
+
+
+if __name__ == "__main__":
+    import json
+    import sys
+
+    with open("maplist.json") as f:
+        mapConfig = json.load(f)
+    template = mapConfig.get("slots", DEFAULT_SLOTS)["initial"]
+
+    draws = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    passed = check_distribution(mapConfig["tiers"], template, draws)
+    passed = check_weighted(max(draws // 5, 1000)) and passed
+    benchmark(mapConfig["tiers"], template)
+    sys.exit(0 if passed else 1)
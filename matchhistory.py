@@ -0,0 +1,282 @@
+#!/usr/bin/python3
+
+# Match history store (map, players, timestamps, stats link, demo zip) backed by SQLite in WAL mode.
+# Writes go through a single background thread so the bot's event loop never waits on disk;
+# reads are cheap indexed lookups and run inline. serverComms reads the same file from its own process.
+
+import asyncio
+import json
+import os
+import sqlite3
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+HISTORY_DB = "matches.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS matches (
+    id INTEGER PRIMARY KEY,
+    map TEXT NOT NULL,
+    played_at REAL NOT NULL,
+    stats_url TEXT,
+    demo_zip TEXT,
+    winner INTEGER,
+    server TEXT
+);
+CREATE TABLE IF NOT EXISTS match_players (
+    match_id INTEGER NOT NULL REFERENCES matches(id),
+    player_id INTEGER,
+    player_name TEXT NOT NULL,
+    team INTEGER
+);
+CREATE TABLE IF NOT EXISTS ratings (
+    player_id INTEGER PRIMARY KEY,
+    rating REAL NOT NULL,
+    games INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_matches_map ON matches(map, id);
+CREATE INDEX IF NOT EXISTS idx_match_players_match ON match_players(match_id);
+CREATE INDEX IF NOT EXISTS idx_match_players_player ON match_players(player_id, match_id);
+CREATE INDEX IF NOT EXISTS idx_match_players_name ON match_players(player_name, match_id);
+"""
+
+
+def _connect(path):
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class MatchHistory:
+    def __init__(self, path=HISTORY_DB, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        if readonly:
+            # used by serverComms; never writes
+            self._reader = sqlite3.connect(
+                "file:%s?mode=ro" % path, uri=True, check_same_thread=False
+            )
+            self._writer = None
+            self._executor = None
+            return
+
+        self._writer = _connect(path)
+        self._writer.executescript(SCHEMA)
+        self._upgrade_schema()
+        self._reader = _connect(path)
+        # one worker thread: keeps writes ordered and the writer connection on a single thread
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="matchhistory")
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        if self._writer is not None:
+            self._writer.close()
+        self._reader.close()
+
+    def _upgrade_schema(self):
+        # columns added after a database may already have been created
+        columns = [row[1] for row in self._writer.execute("PRAGMA table_info(matches)")]
+        if "winner" not in columns:
+            self._writer.execute("ALTER TABLE matches ADD COLUMN winner INTEGER")
+        if "server" not in columns:
+            self._writer.execute("ALTER TABLE matches ADD COLUMN server TEXT")
+
+    # ---- writes (off-loop) ----
+
+    async def _submit(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    def _insert_match(self, mapName, players, playedAt=None, server=None):
+        # players: list of (player_id or None, name, team or None)
+        cur = self._writer.cursor()
+        cur.execute("BEGIN")
+        try:
+            cur.execute(
+                "INSERT INTO matches (map, played_at, server) VALUES (?, ?, ?)",
+                (mapName, playedAt if playedAt is not None else time.time(), server),
+            )
+            matchId = cur.lastrowid
+            cur.executemany(
+                "INSERT INTO match_players (match_id, player_id, player_name, team) VALUES (?, ?, ?, ?)",
+                [(matchId, playerId, name, team) for (playerId, name, team) in players],
+            )
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+        return matchId
+
+    def _update_last(self, column, value):
+        self._writer.execute(
+            "UPDATE matches SET %s = ? WHERE id = (SELECT MAX(id) FROM matches)" % column,
+            (value,),
+        )
+
+    def _update_match(self, matchId, column, value):
+        self._writer.execute("UPDATE matches SET %s = ? WHERE id = ?" % column, (value, matchId))
+
+    def _record_result(self, matchId, winner, newRatings):
+        cur = self._writer.cursor()
+        cur.execute("BEGIN")
+        try:
+            cur.execute("UPDATE matches SET winner = ? WHERE id = ?", (winner, matchId))
+            cur.executemany(
+                "INSERT INTO ratings (player_id, rating, games) VALUES (?, ?, 1) "
+                "ON CONFLICT(player_id) DO UPDATE SET rating = excluded.rating, games = games + 1",
+                list(newRatings.items()),
+            )
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+
+    async def record_match(self, mapName, players, server=None):
+        return await self._submit(self._insert_match, mapName, players, None, server)
+
+    async def set_last_map(self, mapName):
+        await self._submit(self._update_last, "map", mapName)
+
+    async def set_stats(self, matchId, statsUrl=None, demoZip=None):
+        if statsUrl is not None:
+            await self._submit(self._update_match, matchId, "stats_url", statsUrl)
+        if demoZip is not None:
+            await self._submit(self._update_match, matchId, "demo_zip", demoZip)
+
+    async def record_result(self, matchId, winner, newRatings):
+        """Store the winner (1, 2 or 0 for a draw) of a match and the players' updated ratings."""
+        await self._submit(self._record_result, matchId, winner, newRatings)
+
+    # ---- reads (inline, indexed) ----
+
+    def recent_maps(self, n):
+        # oldest first, same order the old prevmaps.json deque used
+        rows = self._reader.execute(
+            "SELECT map FROM matches ORDER BY id DESC LIMIT ?", (n,)
+        ).fetchall()
+        return [row[0] for row in reversed(rows)]
+
+    def last_match(self):
+        row = self._reader.execute(
+            "SELECT id, map, played_at, stats_url, demo_zip, winner, server FROM matches "
+            "ORDER BY id DESC LIMIT 1"
+        ).fetchone()
+        if row is None:
+            return None
+
+        players = self._reader.execute(
+            "SELECT player_id, player_name, team FROM match_players WHERE match_id = ? ORDER BY rowid",
+            (row[0],),
+        ).fetchall()
+        return {
+            "id": row[0],
+            "map": row[1],
+            "played_at": row[2],
+            "stats_url": row[3],
+            "demo_zip": row[4],
+            "winner": row[5],
+            "server": row[6],
+            "players": players,
+        }
+
+    def ratings(self, playerIds):
+        playerIds = list(playerIds)
+        if not playerIds:
+            return {}
+        rows = self._reader.execute(
+            "SELECT player_id, rating FROM ratings WHERE player_id IN (%s)"
+            % ",".join("?" * len(playerIds)),
+            playerIds,
+        ).fetchall()
+        return dict(rows)
+
+    def map_play_counts(self, since=None):
+        if since is None:
+            rows = self._reader.execute(
+                "SELECT map, COUNT(*) FROM matches GROUP BY map"
+            ).fetchall()
+        else:
+            rows = self._reader.execute(
+                "SELECT map, COUNT(*) FROM matches WHERE played_at >= ? GROUP BY map",
+                (since,),
+            ).fetchall()
+        return dict(rows)
+
+    def player_matches(self, playerId, n=10):
+        return self._reader.execute(
+            "SELECT m.id, m.map, m.played_at FROM match_players p JOIN matches m ON m.id = p.match_id "
+            "WHERE p.player_id = ? ORDER BY p.match_id DESC LIMIT ?",
+            (playerId, n),
+        ).fetchall()
+
+    def match_count(self):
+        return self._reader.execute("SELECT COUNT(*) FROM matches").fetchone()[0]
+
+    # ---- migration ----
+
+    def import_json(self, mapsPath="prevmaps.json", teamsPath="prevteams.json"):
+        """One-time import of the old prevmaps.json / prevteams.json files into an empty store."""
+        if self.match_count() > 0 or not os.path.exists(mapsPath):
+            return 0
+
+        with open(mapsPath, "r") as f:
+            prevmaps = json.load(f)
+
+        prevteam = []
+        if os.path.exists(teamsPath):
+            with open(teamsPath, "r") as f:
+                prevteam = json.load(f)
+
+        # the old files only kept the last team, which belongs to the last map
+        for idx, mapName in enumerate(prevmaps):
+            players = []
+            if idx == len(prevmaps) - 1:
+                players = [(None, name, None) for name in prevteam]
+            self._insert_match(mapName, players, playedAt=0)
+
+        return len(prevmaps)
+
+
+def benchmark(matches=100000, players=8, iterations=10000):
+    import random
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        history = MatchHistory(os.path.join(tmp, "bench.db"))
+        mapNames = ["map%d" % i for i in range(40)]
+
+        start = time.perf_counter()
+        cur = history._writer.cursor()
+        cur.execute("BEGIN")
+        for matchId in range(1, matches + 1):
+            cur.execute(
+                "INSERT INTO matches (id, map, played_at) VALUES (?, ?, ?)",
+                (matchId, random.choice(mapNames), matchId),
+            )
+            cur.executemany(
+                "INSERT INTO match_players (match_id, player_id, player_name, team) VALUES (?, ?, ?, ?)",
+                [(matchId, p, "player%d" % p, p % 2) for p in random.sample(range(200), players)],
+            )
+        cur.execute("COMMIT")
+        print("inserted %d matches in %.1f s" % (matches, time.perf_counter() - start))
+
+        for label, fn in (
+            ("recent_maps(5)", lambda: history.recent_maps(5)),
+            ("recent_maps(20)", lambda: history.recent_maps(20)),
+            ("last_match()", history.last_match),
+            ("player_matches(p, 10)", lambda: history.player_matches(42, 10)),
+        ):
+            start = time.perf_counter()
+            for _ in range(iterations):
+                fn()
+            elapsed = (time.perf_counter() - start) / iterations
+            print("%-24s %8.1f us/query" % (label, elapsed * 1e6))
+
+        history.close()
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+
+# Pulls a pickup's logs and demos from the game server while the game is still being played.
+#
+# Once a map is locked we know new round files are coming. Every minute or so the log and HLTV
+# directories are listed (one listdir each, over whichever storage backend is in use), and any file
+# that is new or has changed since the first listing after the lock, and has stopped changing between
+# polls, is copied into a local cache. Comparing listings with each other rather than mtimes with our
+# clock keeps a game server whose clock is off from hiding (or resending) files. By the time someone
+# asks for !stats or !hltv, or the server sends END, the big downloads are usually already done.
+# Cached files are only used while their size and mtime still match the server's.
+
+import json
+import logging
+import os
+import posixpath
+import shutil
+import time
+
+import roundpick
+
+CACHE_DIR = "prefetch"
+INDEX_FILE = "index.json"
+POLL_INTERVAL = 60
+SETTLE_SECONDS = 90  # unchanged for this long before we copy it
+MAX_WINDOW = 3 * 60 * 60  # give up watching this long after the lock
+
+
+class Prefetcher:
+    def __init__(
+        self, connect, kinds=("logs", "hltv"), cacheDir=CACHE_DIR, settle=SETTLE_SECONDS, window=MAX_WINDOW
+    ):
+        self.connect = connect  # returns a connected storage backend (see storage.py)
+        self.kinds = kinds  # which of the backend's dirs to watch
+        self.cacheDir = cacheDir
+        self.settle = settle
+        self.window = window
+
+        self.since = None  # lock time, on our clock; only for giving up after window
+        self.map = None
+        self.stats = {}
+        self.index = self._load_index()  # "kind/name" -> {"size", "mtime"} of the cached copy
+
+        self._store = None
+        self._seen = {}  # "kind/name" -> (size, mtime, unchanged since)
+        self._before = {}  # kind -> {name: (size, mtime)} in the first listing after the lock
+
+    # ---- lifecycle ----
+
+    def start(self, mapName=None):
+        """Start watching for a new pickup; drops whatever the last one left in the cache."""
+        self.close()
+        shutil.rmtree(self.cacheDir, ignore_errors=True)
+        self.index = {}
+        self._seen = {}
+        self._before = {}
+        self.since = time.time()
+        self.map = mapName
+        self.stats = {"polls": 0, "pollSeconds": 0.0, "listed": 0, "files": 0, "bytes": 0, "errors": 0}
+
+    def expired(self):
+        return self.since is None or time.time() - self.since > self.window
+
+    def close(self):
+        if self._store is not None:
+            try:
+                self._store.close()
+            except Exception:
+                pass
+            self._store = None
+
+    def summary(self):
+        s = self.stats
+        if not s:
+            return "prefetch idle"
+        return "prefetch: %d polls (%.0f ms avg, %d entries listed), %d files / %.1f MB fetched, %d errors" % (
+            s["polls"],
+            1000.0 * s["pollSeconds"] / max(s["polls"], 1),
+            s["listed"],
+            s["files"],
+            s["bytes"] / 1048576,
+            s["errors"],
+        )
+
+    # ---- polling ----
+
+    def poll(self):
+        """List the watched directories and copy anything that has settled. Blocking."""
+        start = time.perf_counter()
+        try:
+            if self._store is None:
+                self._store = self.connect()
+            ready = []
+            for kind in self.kinds:
+                ready.extend(self._settled(kind, self._store.dirs[kind]))
+            for kind, name, size, mtime in ready:
+                self._fetch(kind, name, size, mtime)
+        except Exception as e:
+            logging.warning("prefetch poll failed, reconnecting next poll: %s" % e)
+            self.stats["errors"] += 1
+            self.close()
+        finally:
+            self.stats["polls"] += 1
+            self.stats["pollSeconds"] += time.perf_counter() - start
+
+    def _wanted(self, kind, filename):
+        if kind == "hltv":
+            if not filename.endswith(".dem"):
+                return False
+            _, mapName = roundpick._demo_start(filename)
+            return self.map is None or mapName == self.map
+        return filename.endswith(".log")
+
+    def _settled(self, kind, remoteDir):
+        now = time.monotonic()
+        entries = self._store.listdir_attr(remoteDir)
+        self.stats["listed"] += len(entries)
+        if kind not in self._before:
+            self._before[kind] = {a.filename: (a.st_size, a.st_mtime) for a in entries}
+        before = self._before[kind]
+        for a in entries:
+            if before.get(a.filename) == (a.st_size, a.st_mtime) or not self._wanted(kind, a.filename):
+                continue
+            key = kind + "/" + a.filename
+            cached = self.index.get(key)
+            if cached is not None and cached == {"size": a.st_size, "mtime": a.st_mtime}:
+                continue
+
+            seen = self._seen.get(key)
+            if seen is None or seen[:2] != (a.st_size, a.st_mtime):
+                self._seen[key] = (a.st_size, a.st_mtime, now)
+            elif now - seen[2] >= self.settle:
+                yield kind, a.filename, a.st_size, a.st_mtime
+
+    def _fetch(self, kind, name, size, mtime):
+        localDir = os.path.join(self.cacheDir, kind)
+        os.makedirs(localDir, exist_ok=True)
+        stats = self._store.get(posixpath.join(self._store.dirs[kind], name), os.path.join(localDir, name))
+        self.index[kind + "/" + name] = {"size": size, "mtime": mtime}
+        self._save_index()
+        self.stats["files"] += 1
+        self.stats["bytes"] += stats["bytes"]
+        logging.info("prefetched %s/%s (%d bytes)" % (kind, name, stats["bytes"]))
+
+    # ---- cache ----
+
+    def cached(self, kind, name, size, mtime=None):
+        """Local path of the cached copy if it still matches the server's size (and mtime), else None."""
+        entry = self.index.get(kind + "/" + name)
+        if entry is None or entry["size"] != size or (mtime is not None and entry["mtime"] != mtime):
+            return None
+        path = os.path.join(self.cacheDir, kind, name)
+        return path if os.path.exists(path) else None
+
+    def _load_index(self):
+        path = os.path.join(self.cacheDir, INDEX_FILE)
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self):
+        path = os.path.join(self.cacheDir, INDEX_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(path + ".tmp", path)
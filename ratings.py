@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+
+# Player ratings (team Elo) and the team balancer used when a map is locked.
+#
+# Balancing splits the player list into two halves with the smallest rating difference:
+# every split is tried for small pickups, bigger ones (up to the 20 !playernumber allows)
+# use balanced largest-differencing (Karmarkar-Karp for equal-size teams) followed by a
+# pairwise-swap local search.
+
+import itertools
+import time
+
+DEFAULT_RATING = 1500.0
+K_FACTOR = 32.0
+EXHAUSTIVE_MAX_PLAYERS = 12
+
+
+def expected_score(ratingA, ratingB):
+    return 1.0 / (1.0 + 10 ** ((ratingB - ratingA) / 400.0))
+
+
+def team_rating(ratings, team):
+    return sum(ratings.get(p, DEFAULT_RATING) for p in team) / max(len(team), 1)
+
+
+def update_ratings(ratings, team1, team2, score1, k=K_FACTOR):
+    """Return new ratings for everyone in team1/team2; score1 is 1 (team1 won), 0 (lost) or 0.5 (draw)."""
+    expected1 = expected_score(team_rating(ratings, team1), team_rating(ratings, team2))
+    delta = k * (score1 - expected1)
+
+    newRatings = {}
+    for p in team1:
+        newRatings[p] = ratings.get(p, DEFAULT_RATING) + delta
+    for p in team2:
+        newRatings[p] = ratings.get(p, DEFAULT_RATING) - delta
+    return newRatings
+
+
+def split_difference(ratings, team1, team2):
+    return abs(
+        sum(ratings.get(p, DEFAULT_RATING) for p in team1)
+        - sum(ratings.get(p, DEFAULT_RATING) for p in team2)
+    )
+
+
+def _balance_exhaustive(values):
+    n = len(values)
+    total = sum(values)
+    size = n // 2
+    best = None
+    bestDiff = None
+
+    if n % 2 == 0:
+        # player 0 is always on team 1; the mirror image of each split is the same split
+        rest = range(1, n)
+        for combo in itertools.combinations(rest, size - 1):
+            s = values[0] + sum(values[i] for i in combo)
+            diff = abs(total - 2 * s)
+            if bestDiff is None or diff < bestDiff:
+                best, bestDiff = (0,) + combo, diff
+                if diff == 0:
+                    break
+    else:
+        for combo in itertools.combinations(range(n), size):
+            diff = abs(total - 2 * sum(values[i] for i in combo))
+            if bestDiff is None or diff < bestDiff:
+                best, bestDiff = combo, diff
+
+    return set(best)
+
+
+def _balance_heuristic(values):
+    n = len(values)
+    order = sorted(range(n), key=lambda i: values[i], reverse=True)
+    if n % 2:
+        order.append(None)  # pad odd counts with an empty slot so everyone is paired
+
+    def value(i):
+        return 0.0 if i is None else values[i]
+
+    # pair neighbours; each pair is split across the teams. KK then decides which way round
+    # each pair goes by repeatedly differencing the two largest remaining nodes.
+    nodes = []
+    for a, b in zip(order[::2], order[1::2]):
+        nodes.append((value(a) - value(b), [a], [b]))
+
+    while len(nodes) > 1:
+        nodes.sort(key=lambda node: node[0])
+        bigDiff, bigHi, bigLo = nodes.pop()
+        smallDiff, smallHi, smallLo = nodes.pop()
+        nodes.append((bigDiff - smallDiff, bigHi + smallLo, bigLo + smallHi))
+
+    team1 = set(i for i in nodes[0][1] if i is not None)
+    team2 = set(i for i in nodes[0][2] if i is not None)
+
+    # local search: keep swapping the best pair across the split while it helps
+    diff = sum(values[i] for i in team1) - sum(values[i] for i in team2)
+    improved = True
+    while improved and diff != 0:
+        improved = False
+        bestSwap = None
+        bestDiff = abs(diff)
+        for a in team1:
+            for b in team2:
+                newDiff = abs(diff - 2 * (values[a] - values[b]))
+                if newDiff < bestDiff:
+                    bestSwap, bestDiff = (a, b), newDiff
+        if bestSwap is not None:
+            a, b = bestSwap
+            diff -= 2 * (values[a] - values[b])
+            team1.remove(a)
+            team2.remove(b)
+            team1.add(b)
+            team2.add(a)
+            improved = True
+
+    return team1
+
+
+def balance_teams(ratings, players, exhaustiveMax=EXHAUSTIVE_MAX_PLAYERS):
+    """Split players into two teams of (nearly) equal size with the closest rating totals."""
+    players = list(players)
+    if len(players) < 2:
+        return players, []
+
+    values = [ratings.get(p, DEFAULT_RATING) for p in players]
+    if len(players) <= exhaustiveMax:
+        team1Idx = _balance_exhaustive(values)
+    else:
+        team1Idx = _balance_heuristic(values)
+
+    team1 = [p for i, p in enumerate(players) if i in team1Idx]
+    team2 = [p for i, p in enumerate(players) if i not in team1Idx]
+    return team1, team2
+
+
+def benchmark(trials=200):
+    import random
+
+    print("%7s %14s %14s %12s %12s" % ("players", "heuristic", "exhaustive", "heur. ms", "exh. ms"))
+    for n in range(4, 21, 2):
+        heurDiff = exhDiff = heurTime = exhTime = 0.0
+        exhTrials = trials if n <= 16 else 10
+        for t in range(trials):
+            ratings = {p: random.gauss(DEFAULT_RATING, 200) for p in range(n)}
+
+            start = time.perf_counter()
+            team1, team2 = balance_teams(ratings, range(n), exhaustiveMax=0)
+            heurTime += time.perf_counter() - start
+            heurDiff += split_difference(ratings, team1, team2)
+
+            if t < exhTrials:
+                start = time.perf_counter()
+                team1, team2 = balance_teams(ratings, range(n), exhaustiveMax=n)
+                exhTime += time.perf_counter() - start
+                exhDiff += split_difference(ratings, team1, team2)
+
+        print(
+            "%7d %14.2f %14.2f %12.3f %12.3f"
+            % (
+                n,
+                heurDiff / trials,
+                exhDiff / exhTrials,
+                heurTime / trials * 1000,
+                exhTime / exhTrials * 1000,
+            )
+        )
+
+
+if __name__ == "__main__":
+    benchmark()
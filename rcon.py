@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+
+# GoldSrc remote console over UDP, so the bot can changelevel a server as soon as a map is locked.
+#
+# A command needs a challenge first: "challenge rcon" is answered with "challenge rcon <n>", then
+# 'rcon <n> "<password>" <command>' runs the command and the server prints its output back
+# ('l' + text). A challenge stays good for a while, so RconClient keeps it and only asks again
+# when the server says "Bad challenge". Replies carry no id, so one client runs one command at a
+# time. A command that gets no reply is sent again, so only use it for commands that are fine to
+# run twice (changelevel to the map it's already loading is). A wrong password isn't retried:
+# the server bans addresses that keep getting it wrong.
+
+import asyncio
+
+HEADER = b"\xff\xff\xff\xff"
+PRINT_REPLY = ord("l")
+TIMEOUT = 2.0
+RETRIES = 2
+
+
+class RconError(Exception):
+    pass
+
+
+class _RconProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.replies = asyncio.Queue()
+
+    def datagram_received(self, data, addr):
+        if data.startswith(HEADER):
+            self.replies.put_nowait(data[len(HEADER):])
+
+    def error_received(self, exc):
+        self.replies.put_nowait(exc)
+
+
+class RconClient:
+    def __init__(self, host, port, password, timeout=TIMEOUT, retries=RETRIES):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.retries = retries
+        self._challenge = None
+        self._lock = asyncio.Lock()
+
+    async def _exchange(self, transport, protocol, request):
+        for _ in range(self.retries + 1):
+            while not protocol.replies.empty():
+                protocol.replies.get_nowait()  # a late answer to the previous try
+            transport.sendto(HEADER + request)
+            try:
+                reply = await asyncio.wait_for(protocol.replies.get(), self.timeout)
+            except asyncio.TimeoutError:
+                continue
+            if isinstance(reply, Exception):
+                raise RconError(str(reply))
+            return reply
+        raise RconError(
+            "no reply from %s:%d within %gs, %d tries" % (self.host, self.port, self.timeout, self.retries + 1)
+        )
+
+    async def execute(self, command):
+        """Run command on the server; returns what it printed. Raises RconError."""
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            try:
+                transport, protocol = await loop.create_datagram_endpoint(
+                    _RconProtocol, remote_addr=(self.host, self.port)
+                )
+            except OSError as e:
+                raise RconError(str(e)) from e
+            try:
+                for _ in range(2):  # one fresh challenge if the kept one went stale
+                    if self._challenge is None:
+                        reply = (await self._exchange(transport, protocol, b"challenge rcon\n")).split()
+                        if len(reply) != 3 or reply[:2] != [b"challenge", b"rcon"]:
+                            raise RconError("unexpected challenge reply %r" % b" ".join(reply))
+                        self._challenge = reply[2]
+                    request = b'rcon %s "%s" %s\n' % (self._challenge, self.password.encode(), command.encode())
+                    reply = await self._exchange(transport, protocol, request)
+                    if reply[:1] == bytes((PRINT_REPLY,)):
+                        reply = reply[1:]
+                    output = reply.rstrip(b"\x00").decode("utf-8", "replace")
+                    if output.startswith("Bad challenge"):
+                        self._challenge = None
+                        continue
+                    if output.startswith("Bad rcon_password"):
+                        raise RconError("wrong rcon password for %s:%d" % (self.host, self.port))
+                    return output
+                raise RconError("server keeps rejecting the rcon challenge")
+            finally:
+                transport.close()
+
+
+if __name__ == "__main__":
+    # A local stand-in for a GoldSrc server: hands out challenges, calls the first one stale, drops
+    # the first reply to a command, and prints what a changelevel would.
+    class StandIn(asyncio.DatagramProtocol):
+        def __init__(self):
+            self.issued = 0
+            self.commands = []
+            self.dropped = False
+
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def datagram_received(self, data, addr):
+            text = data[len(HEADER):].decode().strip()
+            if text == "challenge rcon":
+                self.issued += 1
+                reply = "challenge rcon %d\n" % (1000 + self.issued)
+            else:
+                _, challenge, rest = text.split(" ", 2)
+                password, command = rest[1:].split('" ', 1)
+                if password != "secret":
+                    reply = "lBad rcon_password.\n"
+                elif challenge != str(1000 + self.issued) or self.issued == 1:
+                    reply = "lBad challenge.\n"
+                elif not self.dropped:
+                    self.dropped = True
+                    return
+                else:
+                    self.commands.append(command)
+                    reply = "lchangelevel to %s\n" % command.split()[-1]
+            self.transport.sendto(HEADER + reply.encode(), addr)
+
+    async def main():
+        transport, standIn = await asyncio.get_running_loop().create_datagram_endpoint(
+            StandIn, local_addr=("127.0.0.1", 0)
+        )
+        port = transport.get_extra_info("sockname")[1]
+        client = RconClient("127.0.0.1", port, "secret", timeout=0.2)
+        output = await client.execute("changelevel 2fort")
+        print("%r after %d challenges; server ran %s" % (output.strip(), standIn.issued, standIn.commands))
+        output = await client.execute("changelevel well")
+        print("%r, challenge kept (%d issued)" % (output.strip(), standIn.issued))
+        assert standIn.issued == 2
+
+        try:
+            await RconClient("127.0.0.1", port, "wrong", timeout=0.2).execute("status")
+        except RconError as e:
+            print("wrong password: %s" % e)
+        transport.close()
+
+    asyncio.run(main())
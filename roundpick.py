@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+
+# Works out which two logs (and demos) on the game server belong to the last pickup.
+#
+# Instead of guessing from file sizes, only the first and last few KB of each recent log are read
+# (ranged reads) to get its map, start/end time and the players seen. Warmups and short maps fail
+# the duration/player checks, 2v2s pass them, and the two rounds are paired by map and by one
+# starting shortly after the other ended. Demos are then matched to the chosen rounds by the
+# timestamp and map in their file names.
+
+import datetime
+import logging
+import re
+
+from collections import namedtuple
+
+HEAD_BYTES = 16384
+TAIL_BYTES = 16384
+MAX_CANDIDATES = 12  # only look at the newest few logs
+MIN_ROUND_SECONDS = 8 * 60
+MIN_PLAYERS = 4  # 2v2
+MAX_ROUND_GAP = 15 * 60  # between the end of round 1 and the start of round 2
+DEMO_START_SLACK = 5 * 60
+
+TIMESTAMP_RE = re.compile(rb"^L (\d\d/\d\d/\d{4} - \d\d:\d\d:\d\d):")
+MAP_RE = re.compile(rb'(?:Loading|Started) map "([^"]+)"')
+STEAM_RE = re.compile(rb"<(STEAM_\d:\d:\d+)>")
+
+LogInfo = namedtuple("LogInfo", ["name", "size", "mtime", "map", "start", "end", "players"])
+
+
+def _timestamp(line):
+    m = TIMESTAMP_RE.match(line)
+    if m is None:
+        return None
+    return datetime.datetime.strptime(m.group(1).decode(), "%m/%d/%Y - %H:%M:%S")
+
+
+def read_log_info(sftp, name, size, mtime, headBytes=HEAD_BYTES, tailBytes=TAIL_BYTES):
+    with sftp.open(name, "rb") as f:
+        head = f.read(min(size, headBytes))
+        tail = b""
+        if size > headBytes:
+            f.seek(max(size - tailBytes, headBytes))
+            tail = f.read(tailBytes)
+
+    headLines = head.split(b"\n")
+    tailLines = tail.split(b"\n") if tail else []  # logs shorter than the head are read in one go
+    if tail:
+        headLines = headLines[:-1]  # cut mid-line
+        tailLines = tailLines[1:]
+
+    start = end = None
+    for line in headLines:
+        start = _timestamp(line)
+        if start is not None:
+            break
+    for line in reversed(tailLines or headLines):
+        end = _timestamp(line)
+        if end is not None:
+            break
+
+    mapMatch = MAP_RE.search(head)
+    players = set(STEAM_RE.findall(head)) | set(STEAM_RE.findall(tail))
+
+    return LogInfo(
+        name=name,
+        size=size,
+        mtime=mtime,
+        map=mapMatch.group(1).decode("utf-8", "replace") if mapMatch else None,
+        start=start,
+        end=end,
+        players=len(players),
+    )
+
+
+def log_info_to_json(info):
+    return [info.name, info.size, info.mtime, info.map, info.start.isoformat(), info.end.isoformat(), info.players]
+
+
+def log_info_from_json(state):
+    name, size, mtime, mapName, start, end, players = state
+    return LogInfo(
+        name, size, mtime, mapName,
+        datetime.datetime.fromisoformat(start), datetime.datetime.fromisoformat(end), players,
+    )
+
+
+def is_round(info, minSeconds=MIN_ROUND_SECONDS, minPlayers=MIN_PLAYERS):
+    if info.map is None or info.start is None or info.end is None:
+        return False
+    return (info.end - info.start).total_seconds() >= minSeconds and info.players >= minPlayers
+
+
+def recent_logs(sftp, limit=MAX_CANDIDATES):
+    """LogInfo for the newest logs in the current directory, newest first."""
+    entries = [a for a in sftp.listdir_attr() if a.filename.endswith(".log")]
+    entries.sort(key=lambda a: (a.st_mtime, a.filename), reverse=True)
+    return [read_log_info(sftp, a.filename, a.st_size, a.st_mtime) for a in entries[:limit]]
+
+
+def pair_rounds(logs, expectedMap=None):
+    """(round1, round2) for the most recent pickup, or None. logs must be newest first."""
+    rounds = [info for info in logs if is_round(info)]
+
+    for wantMap in ([expectedMap] if expectedMap else []) + [None]:
+        for idx, round2 in enumerate(rounds):
+            if wantMap is not None and round2.map != wantMap:
+                continue
+            for round1 in rounds[idx + 1:]:
+                if round1.map != round2.map:
+                    continue
+                gap = (round2.start - round1.end).total_seconds()
+                if 0 <= gap <= MAX_ROUND_GAP:
+                    return round1, round2
+                break  # the round before on this map is too far back; try an older round2
+        if wantMap is not None:
+            logging.warning("no round pair on %s, falling back to the newest pair" % wantMap)
+
+    return None
+
+
+def find_round_logs(sftp, expectedMap=None):
+    return pair_rounds(recent_logs(sftp), expectedMap)
+
+
+def _demo_start(filename):
+    # HLTV names demos <prefix>-<yymmddhhmm>-<map>.dem
+    parts = filename[: -len(".dem")].split("-")
+    if len(parts) < 3:
+        return None, None
+    try:
+        start = datetime.datetime.strptime(parts[1], "%y%m%d%H%M")
+    except ValueError:
+        return None, None
+    return start, "-".join(parts[2:])
+
+
+def find_round_demos(sftp, rounds):
+    """Demo file names for (round1, round2), matched on map and start time; None if either is missing."""
+    demos = []
+    for a in sftp.listdir_attr():
+        if not a.filename.endswith(".dem"):
+            continue
+        start, mapName = _demo_start(a.filename)
+        if start is not None:
+            demos.append((a.filename, start, mapName))
+
+    picked = []
+    for info in rounds:
+        best = None
+        for filename, start, mapName in demos:
+            if mapName != info.map or filename in picked:
+                continue
+            offset = abs((start - info.start).total_seconds())
+            if offset <= DEMO_START_SLACK and (best is None or offset < best[0]):
+                best = (offset, filename)
+        if best is None:
+            return None
+        picked.append(best[1])
+
+    return tuple(picked)
+
+
+if __name__ == "__main__":
+    # Pairs the logs in fixtures/roundpick/<case>/ and checks the pick for each edge case. The logs
+    # get mtimes in file name order, as the server's numbering would have left them.
+    import os
+    import shutil
+    import tempfile
+
+    import storage
+
+    FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "roundpick")
+    CASES = [
+        # case, expected map, round 1, round 2
+        ("truncated", "well", "L1018001.log", "L1018003.log"),  # round 2 crashed mid-line and was replayed
+        ("overtime", "2fort", "L1018010.log", "L1018011.log"),  # a 43 minute round 2, then an empty next map
+        ("disconnect", "avanti", "L1018020.log", "L1018021.log"),  # half the players left 10 minutes in
+        ("missing-end", "well", "L1018032.log", "L1018033.log"),  # round 2 never logged its end
+        ("missing-end", "2fort", "L1018030.log", "L1018031.log"),  # the pickup before it, asked for by map
+        ("missing-end", None, "L1018032.log", "L1018033.log"),
+    ]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for case, expectedMap, want1, want2 in CASES:
+            caseDir = os.path.join(tmp, case)
+            if not os.path.isdir(caseDir):
+                shutil.copytree(os.path.join(FIXTURES, case), caseDir)
+                for idx, name in enumerate(sorted(os.listdir(caseDir))):
+                    os.utime(os.path.join(caseDir, name), (1700000000 + idx * 60,) * 2)
+            sftp = storage.LocalBackend({})
+            sftp.chdir(caseDir)
+
+            logs = recent_logs(sftp)
+            rounds = pair_rounds(logs, expectedMap)
+            assert rounds is not None, case
+            demos = find_round_demos(sftp, rounds)
+            print(
+                "%-12s %-6s %s %s (%d and %d players, %s), demos %s"
+                % (
+                    case, expectedMap, rounds[0].name, rounds[1].name, rounds[0].players, rounds[1].players,
+                    rounds[1].end - rounds[1].start, demos,
+                )
+            )
+            assert (rounds[0].name, rounds[1].name) == (want1, want2), (case, rounds)
+            assert demos is not None, case
+            assert all(demo.endswith("-%s.dem" % info.map) for demo, info in zip(demos, rounds)), demos
+
+            if case == "truncated":
+                crashed = next(info for info in logs if info.name == "L1018002.log")
+                assert crashed.end is not None and not is_round(crashed), crashed
@@ -4,9 +4,12 @@ import asyncio
 import json
 import os
 
-from datetime import datetime
 from dotenv import load_dotenv
-from ftplib import FTP
+
+import matchhistory
+import wire
+
+LEGACY_PLUGIN_PORT = 16354
 
 async def start_udp_listener():
     loop = asyncio.get_event_loop()
@@ -26,126 +29,98 @@ def main_watcher():
         loop.close()
 
 def main():
-    global FTP_USER
-    global FTP_PASSWD
-    global FTP_SERVER
+    global BOT_PORT
 
     load_dotenv()
-    FTP_USER = os.getenv('FTP_USER')
-    FTP_PASSWD = os.getenv('FTP_PASSWD')
-    FTP_SERVER = os.getenv('FTP_SERVER')
+    BOT_PORT = int(os.getenv('BOT_PORT', '16534'))  # the bot's stats pipeline listens here
 
     main_watcher()
 
-def getLastGameLogs():
-    global FTP_USER
-    global FTP_PASSWD
-    global FTP_SERVER
-
-    if os.path.exists('prevlog.json'):
-        with open('prevlog.json', 'r') as f:
-            prevlog = json.load(f)
-    else:
-        prevlog = []
-
-    ftp = FTP(FTP_SERVER, user=FTP_USER, passwd=FTP_PASSWD)
-    ftp.cwd('/tfc/logs')
-    logFiles = ftp.nlst('-t') # get list of logs by time
-    logFiles.reverse() # sort descending
-
-    firstLog = None
-    secondLog = None
-    for logFile in logFiles:
-        if ".log" not in logFile:
-            continue
-
-        if 'logFiles' in prevlog and logFile in prevlog['logFiles']:
-            print("already parsed the latest log")
-            return
-
-        # check the size, should be >100kB
-        if int(ftp.size(logFile)) > 100000:
-            logModified = datetime.strptime(ftp.voidcmd("MDTM %s" % logFile).split()[-1], '%Y%m%d%H%M%S')
-            if firstLog is None:
-                firstLog = (logFile, logModified)
-                continue
-
-            # otherwise, verify that there was another round played at least <60 minutes within the last found log
-            if (firstLog[1] - logModified).total_seconds() < 3600:
-                secondLog = (logFile, logModified)
-
-            # if secondLog is not populated, this is probably the first pickup of the day; abort
-            break
-
-    # abort if we didn't find a log
-    if firstLog is None or secondLog is None:
-        return
-
-    ftp.retrbinary("RETR %s" % firstLog[0], open('logs/%s' % firstLog[0], 'wb').write)
-    ftp.retrbinary("RETR %s" % secondLog[0], open('logs/%s' % secondLog[0], 'wb').write)
-
-    hampalyze = 'curl -X POST -F logs[]=@%s -F logs[]=@%s http://app.hampalyzer.com/api/parseGame' % ('logs/'+secondLog[0], 'logs/'+firstLog[0])
-    output = os.popen(hampalyze).read()
-    print(output)
-
-    status = json.loads(output)
-    if 'success' in status:
-        site = "http://app.hampalyzer.com" + status['success']['path']
-        print("Parsed logs available: %s" % site)
-
-        with open('prevlog.json', 'w') as f:
-            prevlog = { 'site': site, 'logFiles': [ firstLog[0], secondLog[0] ] }
-            json.dump(prevlog, f)
-    else:
-        print('error parsing logs: %s' % output)
+def lastMatch():
+    # the bot owns the match history; we only read the latest match from it
+    if not os.path.exists(matchhistory.HISTORY_DB):
+        return None
+
+    history = matchhistory.MatchHistory(readonly=True)
+    try:
+        return history.last_match()
+    finally:
+        history.close()
 
 class InhouseServerProtocol:
     def connection_made(self, transport):
         self.transport = transport
+        # peers that have sent us wire.py frames get frames back; everyone else the old text format
+        self.links = {}
+        # END always goes to the bot framed, so a dropped datagram doesn't silently cost a match its stats
+        self.link(('127.0.0.1', BOT_PORT))
 
-    def datagram_received(self, data, addr):
-        message = data.decode()
-        print('received %r from %s' % (message, addr))
-
-        message_parts = message.split("@")
-        if message_parts[0] != "BOT_MSG":
-            return
-
-        if message_parts[1] == "IRC":
-            print("message inhouse! {}" % message)
+    def link(self, addr):
+        if addr not in self.links:
+            self.links[addr] = wire.Link(self.transport.sendto, addr)
+        return self.links[addr]
 
-        if message_parts[1] == "MAP":
-            with open('prevmaps.json', 'r') as f:
-                prevmaps = json.load(f)
-                curmap = prevmaps[-1]
-
-                self.send_message("MAP", curmap, addr)
-
-        if message_parts[1] == "RS":
-            with open('prevmaps.json', 'r') as f:
-                prevmaps = json.load(f)
-                curmap = prevmaps[-1]
-
-                self.send_message("RS", curmap, addr)
-
-        if message_parts[1] == "TEAMS":
-            with open('prevteams.json', 'r') as f:
-                prevteams = json.load(f)
-
-                self.send_message("TEAMS", ', '.join(prevteams[:4]), addr)
-                self.send_message("TEAMS", ', '.join(prevteams[4:]), addr)
-
-        if message_parts[1] == "END":
-            getLastGameLogs()
-
-        if message_parts[1] == "TIMELEFT":
+    def datagram_received(self, data, addr):
+        if wire.is_frame(data):
+            try:
+                messages = self.link(addr).receive(data)
+            except wire.FrameError as e:
+                print('bad frame from %s: %s' % (addr, e))
+                return
+        else:
+            message = data.decode(errors='replace')
+            print('received %r from %s' % (message, addr))
+            legacy = wire.legacy_decode(data)
+            messages = [] if legacy is None else [(legacy[0], '@'.join(legacy[1]))]
+
+        for msg_type, payload in messages:
+            self.handle(msg_type, payload, addr)
+
+    def handle(self, msg_type, payload, addr):
+        if msg_type == "IRC":
+            print("message inhouse! %s" % payload)
+
+        if msg_type == "MAP":
+            match = lastMatch()
+            if match is not None:
+                self.send_message("MAP", match['map'], addr)
+
+        if msg_type == "RS":
+            match = lastMatch()
+            if match is not None:
+                self.send_message("RS", match['map'], addr)
+
+        if msg_type == "TEAMS":
+            match = lastMatch()
+            if match is not None:
+                team1 = [name for (_, name, team) in match['players'] if team == 1]
+                team2 = [name for (_, name, team) in match['players'] if team == 2]
+                if not team1 and not team2:
+                    # matches recorded before team balancing have no team column
+                    names = [name for (_, name, _) in match['players']]
+                    half = len(names) // 2
+                    team1, team2 = names[:half], names[half:]
+
+                # one frame for a framed peer, two datagrams for an old plugin
+                self.send_message("TEAMS", ', '.join(team1), addr)
+                self.send_message("TEAMS", ', '.join(team2), addr)
+
+        if msg_type == "END":
+            # the bot runs the post-match stats job; just pass the event on
+            self.links[('127.0.0.1', BOT_PORT)].send("END", "")
+
+        if msg_type == "TIMELEFT":
             with open('timeleft.json', 'w') as f:
-                json.dump({ 'timeleft': message_parts[-1] }, f)
+                json.dump({ 'timeleft': payload.split("@")[-1] }, f)
 
 
     def send_message(self, msg_type, message, addr):
-        data = ("BOT_MSG@%s@%s" % (msg_type, message)).encode()
-        self.transport.sendto(data, (addr[0], 16354))  # bot only listens on this port
+        link = self.links.get(addr)
+        if link is not None:
+            link.send(msg_type, message)
+        else:
+            # old plugins only listen on this port, whatever port they sent from
+            self.transport.sendto(wire.legacy_encode(msg_type, message), (addr[0], LEGACY_PLUGIN_PORT))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,253 @@
+#!/usr/bin/python3
+
+# The game servers pickups can be played on, and which one to send the next pickup to.
+#
+# Every server is probed with A2S_INFO, all at once, so a round of probes takes as long as the
+# slowest reply (or the timeout) rather than the sum. When a map is locked the pickup goes to a
+# server that answered, preferring empty ones, then the lowest latency.
+#
+# servers.json lists them; without it there is one server built from the .env settings, as before.
+# It holds passwords, so it's not in git. Each entry needs "name" and "host"; the rest is optional:
+#   [{"name": "chicago", "host": "1.2.3.4", "port": 27015, "password": "...", "pluginPort": 27016,
+#     "joinUrl": "https://...", "vultrId": "...", "fileHost": "1.2.3.4", "fileUser": "root",
+#     "filePassword": "...", "storage": ["sftp", "ftp"], "rconPassword": "..."}, ...]
+# With an rconPassword the bot changes the server to the locked map right away.
+# The first one is the default, e.g. for matches recorded before there were several.
+
+import asyncio
+import json
+import logging
+import os
+import time
+
+import a2s
+import rcon
+
+SERVERS_FILE = "servers.json"
+PROBE_INTERVAL = 60
+PROBE_TIMEOUT = 1.0
+FRESH_SECONDS = 30  # a probe younger than this is good enough to pick a server with
+
+
+class ServerConfigError(Exception):
+    pass
+
+
+class GameServer:
+    def __init__(
+        self,
+        name,
+        host,
+        port=27015,
+        password=None,
+        pluginPort=None,
+        joinUrl=None,
+        vultrId=None,
+        fileHost=None,
+        fileUser=None,
+        filePassword=None,
+        storage=("sftp", "ftp"),
+        rconPassword=None,
+    ):
+        self.name = name
+        self.host = host
+        self.port = port  # game port; A2S queries go here too
+        self.password = password
+        self.pluginPort = pluginPort  # the server plugin's UDP port (TIMELEFT etc.)
+        self.joinUrl = joinUrl
+        self.vultrId = vultrId
+        self.fileHost = fileHost or host  # where logs and demos are fetched from (SSH/FTP)
+        self.fileUser = fileUser
+        self.filePassword = filePassword
+        self.storage = tuple(storage)  # backends to try, most preferred first
+        self.rcon = rcon.RconClient(host, port, rconPassword) if rconPassword else None
+
+        self.files = None  # storage.BackendPool, set up by the bot
+        self.query = a2s.A2SClient(host, port, timeout=PROBE_TIMEOUT)
+        self.info = None  # last A2S_INFO reply
+        self.latency = None
+        self.error = None
+        self.probed = 0  # monotonic time of the last probe
+
+    @classmethod
+    def from_json(cls, state):
+        try:
+            return cls(
+                state["name"],
+                state["host"],
+                int(state.get("port", 27015)),
+                state.get("password"),
+                int(state["pluginPort"]) if state.get("pluginPort") else None,
+                state.get("joinUrl"),
+                state.get("vultrId"),
+                state.get("fileHost"),
+                state.get("fileUser"),
+                state.get("filePassword"),
+                state.get("storage", ("sftp", "ftp")),
+                state.get("rconPassword"),
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            raise ServerConfigError("bad server entry %r: %s" % (state.get("name"), e))
+
+    @property
+    def up(self):
+        return self.info is not None
+
+    def load(self):
+        """Share of the slots in use, 0..1; 1 for a server we can't reach."""
+        if self.info is None:
+            return 1.0
+        return (self.info["players"] - self.info["bots"]) / max(self.info["maxPlayers"], 1)
+
+    def connect_command(self):
+        return "connect %s:%d;password %s" % (self.host, self.port, self.password)
+
+    def steam_url(self):
+        return "steam://connect/%s:%d/%s" % (self.host, self.port, self.password)
+
+    def status(self):
+        if self.probed == 0:
+            return "%s (%s:%d): not probed yet" % (self.name, self.host, self.port)
+        if self.info is None:
+            return "%s (%s:%d): down (%s)" % (self.name, self.host, self.port, self.error)
+        return "%s (%s:%d): %s, %d/%d players, %.0f ms" % (
+            self.name,
+            self.host,
+            self.port,
+            self.info["map"],
+            self.info["players"] - self.info["bots"],
+            self.info["maxPlayers"],
+            1000 * self.latency,
+        )
+
+
+class ServerRegistry:
+    def __init__(self, servers):
+        if not servers:
+            raise ServerConfigError("no game servers configured")
+        names = [server.name for server in servers]
+        if len(set(names)) != len(names):
+            raise ServerConfigError("server names must be unique: %s" % ", ".join(names))
+        self.servers = servers
+        self._byName = {server.name: server for server in servers}
+
+    @classmethod
+    def load(cls, default, path=SERVERS_FILE):
+        """The servers in path, or just default when there's no such file."""
+        if not os.path.exists(path):
+            return cls([default])
+        with open(path, "r") as f:
+            try:
+                entries = json.load(f)
+            except ValueError as e:
+                raise ServerConfigError("%s: %s" % (path, e))
+        if not isinstance(entries, list):
+            raise ServerConfigError("%s must hold a list of servers" % path)
+        return cls([GameServer.from_json(entry) for entry in entries])
+
+    @property
+    def default(self):
+        return self.servers[0]
+
+    def get(self, name):
+        """The server called name, or None."""
+        return self._byName.get(name)
+
+    async def probe(self, server):
+        try:
+            server.info = await server.query.info(fresh=True)
+            server.latency = server.info["latency"]
+            server.error = None
+        except a2s.QueryError as e:
+            if server.info is not None:
+                logging.warning("game server %s stopped answering: %s" % (server.name, e))
+            server.info = server.latency = None
+            server.error = str(e)
+        server.probed = time.monotonic()
+
+    async def probe_all(self):
+        """Probe every server concurrently; returns how long it took."""
+        start = time.perf_counter()
+        await asyncio.gather(*(self.probe(server) for server in self.servers))
+        return time.perf_counter() - start
+
+    async def pick(self):
+        """Where the next pickup should go: an empty server if any answers, else the least loaded,
+        lowest latency first. Only one server configured: that one, without probing."""
+        if len(self.servers) == 1:
+            return self.default
+        if any(time.monotonic() - server.probed > FRESH_SECONDS for server in self.servers):
+            await self.probe_all()
+
+        candidates = [server for server in self.servers if server.up]
+        if not candidates:
+            logging.warning("no game server answered, using %s" % self.default.name)
+            return self.default
+        return min(candidates, key=lambda server: (server.load() > 0, server.load(), server.latency))
+
+    def summary(self):
+        return "\n".join(server.status() for server in self.servers)
+
+
+if __name__ == "__main__":
+    # A few local UDP responders standing in for game servers: different latencies and player counts,
+    # one asking for a challenge, one in the old GoldSrc format, one that never answers. Probes them
+    # all concurrently and shows which would get the next pickup.
+    import struct
+
+    class Responder(asyncio.DatagramProtocol):
+        def __init__(self, name, players, delay, challenge=False, goldsrc=False, silent=False):
+            self.name = name
+            self.players = players
+            self.delay = delay
+            self.challenge = challenge
+            self.goldsrc = goldsrc
+            self.silent = silent
+
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def datagram_received(self, data, addr):
+            if self.silent or not data.startswith(a2s.A2S_INFO):
+                return
+            if self.challenge and data[len(a2s.A2S_INFO):] != b"\x01\x02\x03\x04":
+                reply = a2s.HEADER + b"A" + b"\x01\x02\x03\x04"
+            elif self.goldsrc:
+                reply = (
+                    a2s.HEADER + b"m127.0.0.1:0\x00" + self.name.encode() + b"\x00well\x00tfc\x00TFC\x00"
+                    + bytes((self.players, 24, 47))
+                )
+            else:
+                reply = (
+                    a2s.HEADER + b"I\x30" + self.name.encode() + b"\x002fort\x00tfc\x00TFC\x00"
+                    + struct.pack("<h", 20) + bytes((self.players, 24, 0))
+                )
+            asyncio.get_running_loop().call_later(self.delay, self.transport.sendto, reply, addr)
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        specs = [
+            ("busy", dict(players=12, delay=0.005)),
+            ("far", dict(players=0, delay=0.12)),
+            ("near", dict(players=0, delay=0.02, challenge=True)),
+            ("old", dict(players=2, delay=0.01, goldsrc=True)),
+            ("dead", dict(players=0, delay=0, silent=True)),
+        ]
+        servers = []
+        for name, kwargs in specs:
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda name=name, kwargs=kwargs: Responder(name, **kwargs), local_addr=("127.0.0.1", 0)
+            )
+            servers.append(GameServer(name, "127.0.0.1", transport.get_extra_info("sockname")[1], "pw"))
+        registry = ServerRegistry(servers)
+        for server in servers:
+            server.query.timeout = 0.5
+
+        elapsed = await registry.probe_all()
+        print(registry.summary())
+        print("probed %d servers in %.0f ms (timeout 500 ms)" % (len(servers), elapsed * 1000))
+        picked = await registry.pick()
+        print("next pickup goes to %s: %s" % (picked.name, picked.connect_command()))
+        assert picked.name == "near", picked.name
+
+    asyncio.run(main())
@@ -0,0 +1,532 @@
+#!/usr/bin/python3
+
+# Offline simulation of the pickup flow, for measuring and regression-testing the bot without Discord.
+#
+# inhouse-bot.py is imported (in a scratch directory, so matches.db etc. are throwaway) and its
+# command handlers are driven directly with fake ctx/guild/channel/member/interaction objects. Every
+# Discord call those fakes receive (send, edit, nick change, interaction response) is recorded
+# against the command that made it, instead of going anywhere. A randomized session runs many
+# pickups over a pool of players (adds, removes, !teams, votes through the map buttons, rerolls,
+# locks and the odd cancel) and reports per-command latency, API calls, loop stalls and memory.
+#
+# Anything that would touch the network (live score, prefetch) is switched off, the pickup
+# countdown is run straight through (its timers advanced) and other sleeps are skipped.
+#
+#   python simulate.py [--players 300] [--pickups 100] [--seed 1] [--budget-ms 100]
+#
+# Exits non-zero if any command blocked the event loop for longer than the budget.
+#
+#   python simulate.py --restart
+#
+# restarts the bot (a fresh import against the same files) in the middle of a map vote and checks
+# the restored pickup matches and can still be locked, timing the snapshot and the restore.
+#
+#   python simulate.py --startup [--runs 5]
+#
+# instead measures loading the bot in fresh interpreters under -X importtime: time to import
+# everything and load state, the slowest imports, and what the lazily imported modules would cost.
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import loopwatch
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SIM_ENV = {
+    "DISCORD_CHANNEL": "pickup",
+    "SERVER_IP": "127.0.0.1",
+    "SERVER_PORT": "27016",
+    "CLIENT_PORT": "27017",
+    "SERVER_PASSWORD": "sim",
+}
+
+
+# ---- recorded API backend ----
+
+
+class Recorder:
+    def __init__(self):
+        self.command = None  # the command being simulated; calls are charged to it
+        self.calls = {}  # command -> {api call -> count}
+        self.nextId = 1000
+
+    def record(self, call):
+        perCommand = self.calls.setdefault(self.command, {})
+        perCommand[call] = perCommand.get(call, 0) + 1
+
+    def new_id(self):
+        self.nextId += 1
+        return self.nextId
+
+
+class FakeMessage:
+    def __init__(self, recorder, channel, content=None, embed=None, view=None):
+        self.recorder = recorder
+        self.channel = channel
+        self.id = recorder.new_id()
+        self.content = content
+        self.embed = embed
+        self.view = view
+
+    async def edit(self, **kwargs):
+        self.recorder.record("message.edit")
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+        return self
+
+
+class FakeChannel:
+    def __init__(self, recorder, name, guild):
+        self.recorder = recorder
+        self.name = name
+        self.id = recorder.new_id()
+        self.guild = guild
+        self.history = []
+
+    async def send(self, content=None, embed=None, view=None, file=None):
+        self.recorder.record("channel.send")
+        message = FakeMessage(self.recorder, self, content, embed, view)
+        self.history = (self.history + [message])[-50:]
+        return message
+
+
+class FakeRole:
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeMember:
+    def __init__(self, recorder, memberId, name, roles=("TFC",)):
+        self.recorder = recorder
+        self.id = memberId
+        self.name = name
+        self.display_name = name
+        self.mention = "<@%d>" % memberId
+        self.roles = [FakeRole(role) for role in roles]
+        self.nick = None
+
+    async def edit(self, nick=None):
+        self.recorder.record("member.edit")
+        self.nick = nick
+
+
+class FakeGuild:
+    def __init__(self, recorder):
+        self.id = recorder.new_id()
+        self.me = FakeMember(recorder, recorder.new_id(), "inhouse-bot")
+        self.filesize_limit = 25 * 1024 * 1024
+
+
+class FakeCommand:
+    def __init__(self, name):
+        self.qualified_name = name
+        self.name = name
+
+
+class FakeCtx:
+    def __init__(self, channel, author, commandName, prefix="!"):
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.command = FakeCommand(commandName)
+        self.prefix = prefix
+        self.message = FakeMessage(channel.recorder, channel, "%s%s" % (prefix, commandName))
+        self.message.guild = channel.guild
+        self.message.author = author
+
+    async def send(self, content=None, embed=None, view=None, file=None):
+        return await self.channel.send(content=content, embed=embed, view=view, file=file)
+
+
+class FakeResponse:
+    def __init__(self, recorder):
+        self.recorder = recorder
+
+    async def edit_message(self, **kwargs):
+        self.recorder.record("interaction.edit_message")
+
+    async def defer(self):
+        self.recorder.record("interaction.defer")
+
+
+class FakeInteraction:
+    def __init__(self, recorder, user, customId):
+        self.user = user
+        self.data = {"custom_id": customId}
+        self.response = FakeResponse(recorder)
+
+
+# ---- loading the bot ----
+
+
+class FastAsyncio:
+    # the bot's asyncio, with sleeps skipped
+    def __getattr__(self, name):
+        return getattr(asyncio, name)
+
+    async def sleep(self, delay, result=None):
+        await asyncio.sleep(0)
+        return result
+
+
+def load_bot(workDir, path=os.path.join(HERE, "inhouse-bot.py")):
+    """Import inhouse-bot.py with workDir as its working directory; returns the module."""
+    shutil.copy(os.path.join(HERE, "maplist.json"), workDir)
+    os.chdir(workDir)
+    os.environ.update(SIM_ENV)
+    if HERE not in sys.path:
+        sys.path.insert(0, HERE)
+
+    spec = importlib.util.spec_from_file_location("inhousebot", path)
+    bot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bot)
+
+    bot.asyncio = FastAsyncio()
+    bot.StartLiveScore = lambda: None
+    bot.StartPrefetch = lambda mapName: None
+    return bot
+
+
+# ---- session ----
+
+
+class Simulation:
+    def __init__(self, bot, players, seed):
+        self.rng = random.Random(seed)
+        self.recorder = Recorder()
+        self.samples = {}  # command -> [seconds]
+        self.guild = FakeGuild(self.recorder)
+        self.channel = FakeChannel(self.recorder, "pickup", self.guild)
+        self.members = [
+            FakeMember(self.recorder, 10 ** 17 + idx, "player%03d" % idx) for idx in range(players)
+        ]
+        self.admin = FakeMember(self.recorder, 10 ** 16, "admin", roles=("admin", "TFC"))
+        self.attach(bot)
+
+    def attach(self, bot):
+        # the vote timers post to the pickup channel by id
+        self.bot = bot
+        bot.client.get_channel = lambda channelId: self.channel
+
+    async def timed(self, name, coro):
+        """Await coro, charging its time and API calls to name."""
+        self.recorder.command = name
+        start = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self.samples.setdefault(name, []).append(time.perf_counter() - start)
+            self.recorder.command = None
+
+    async def run(self, name, fn, *args, author=None):
+        await self.timed(name, fn(FakeCtx(self.channel, author or self.admin, name), *args))
+
+    async def click(self, member, idx):
+        bot = self.bot
+        view = bot.mapVoteMessageView
+        button = view.children[idx]
+        interaction = FakeInteraction(self.recorder, member, button.custom_id)
+        await self.timed("vote button", bot.HandleMapButtonCallback(view, interaction, button))
+
+        # the part of a click that grows with the number of players, on its own
+        start = time.perf_counter()
+        bot.GenerateMapVoteEmbed()
+        self.samples.setdefault("(vote embed)", []).append(time.perf_counter() - start)
+
+    async def pickup(self):
+        bot = self.bot
+        rng = self.rng
+
+        await self.fill()
+        if not bot.mapVote:
+            await self.run("cancel", bot.cancel)
+            return
+
+        if rng.random() < 0.05:
+            await self.run("cancel", bot.cancel)
+            await self.run("cancel", bot.cancel)
+            return
+
+        for _ in range(2):  # at most one reroll
+            await self.vote([m for m in self.members if m.id in bot.playerList])
+            # everyone has voted, so the vote locks itself once the grace period is up (a reroll
+            # replaces mapChoices and needs votes of its own first)
+            choices = bot.mapChoices
+            await self.timed("(auto-lock)", bot.pickupTimers.advance(bot.AUTOLOCK_GRACE))
+            if bot.mapVote and bot.mapChoices is choices:
+                await self.run("lockmap", bot.lockmap)
+            if not bot.mapVote:
+                break
+        if bot.mapVote:
+            await self.run("cancel", bot.cancel)
+            await self.run("cancel", bot.cancel)
+
+    async def fill(self):
+        """Start a pickup and add players until it fills (and the map vote opens)."""
+        bot = self.bot
+        rng = self.rng
+
+        await self.run("pickup", bot.pickup)
+        await self.timed("(countdown)", bot.pickupTimers.advance(2 * bot.COUNTDOWN_STEP))
+        if rng.random() < 0.3:
+            await self.run("playernumber", bot.playernumber, rng.choice((8, 10, 12)))
+
+        # fill up, with some people changing their minds
+        waiting = rng.sample(self.members, min(len(self.members), 40))
+        added = []
+        while bot.pickupActive and waiting:
+            if added and rng.random() < 0.15:
+                member = added.pop(rng.randrange(len(added)))
+                await self.run("remove", bot.remove, author=member)
+                waiting.append(member)
+                continue
+            if rng.random() < 0.05:
+                await self.run("teams", bot.teams)
+            member = waiting.pop(rng.randrange(len(waiting)))
+            await self.run("add", bot.add, author=member)
+            added.append(member)
+
+    async def vote(self, voters):
+        for member in voters:
+            # some people change their vote
+            for _ in range(1 + (self.rng.random() < 0.3)):
+                await self.click(member, self.rng.randrange(len(self.bot.mapChoices)))
+
+    def report(self, seconds, stalls):
+        print(
+            "%-14s %6s %8s %8s %8s %7s  %s"
+            % ("command", "n", "p50 ms", "p95 ms", "max ms", "api/cmd", "api calls")
+        )
+        for name, samples in sorted(self.samples.items()):
+            samples = sorted(samples)
+            calls = self.recorder.calls.get(name, {})
+            print(
+                "%-14s %6d %8.3f %8.3f %8.3f %7.2f  %s"
+                % (
+                    name,
+                    len(samples),
+                    1000 * samples[len(samples) // 2],
+                    1000 * samples[int(len(samples) * 0.95)],
+                    1000 * samples[-1],
+                    sum(calls.values()) / len(samples),
+                    ", ".join("%s %d" % item for item in sorted(calls.items())),
+                )
+            )
+
+        current, peak = tracemalloc.get_traced_memory()
+        print(
+            "\n%.1fs wall, %d API calls, session heap %.1f MB (peak %.1f MB), max RSS %.0f MB"
+            % (
+                seconds,
+                sum(sum(calls.values()) for calls in self.recorder.calls.values()),
+                current / 1048576,
+                peak / 1048576,
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            )
+        )
+        for stall in stalls:
+            print(stall)
+
+
+async def main(args):
+    workDir = tempfile.mkdtemp(prefix="inhouse-sim-")
+    cwd = os.getcwd()
+    try:
+        bot = load_bot(workDir)
+        sim = Simulation(bot, args.players, args.seed)
+        bot.random.seed(args.seed)
+
+        tracemalloc.start()
+        watchdog = loopwatch.LoopWatchdog(
+            threshold=args.budget_ms / 1000.0, interval=min(0.05, args.budget_ms / 5000.0)
+        )
+        watchdog.start()
+        start = time.perf_counter()
+        for _ in range(args.pickups):
+            await sim.pickup()
+        await asyncio.sleep(watchdog.interval * 2)
+        watchdog.stop()
+        bot.pickupTimers.close()
+        elapsed = time.perf_counter() - start
+
+        print(
+            "%d pickups, %d players, %d matches recorded\n"
+            % (args.pickups, args.players, bot.matchHistory.match_count())
+        )
+        sim.report(elapsed, watchdog.stalls)
+        tracemalloc.stop()
+        return 1 if watchdog.stalls else 0
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+# ---- restart ----
+
+
+def pickup_state(bot):
+    return (
+        bot.pickupStarted,
+        bot.pickupActive,
+        bot.mapVote,
+        dict(bot.playerList),
+        bot.playerNumber,
+        [(m.mapName, m.decoration, list(m.votes)) for m in bot.mapChoices] if bot.mapVote else [],
+    )
+
+
+async def restart_check(args):
+    """Restart the bot in the middle of a map vote and check the pickup carries on where it was."""
+    workDir = tempfile.mkdtemp(prefix="inhouse-restart-")
+    cwd = os.getcwd()
+    try:
+        before = load_bot(workDir)
+        sim = Simulation(before, args.players, args.seed)
+        while not before.mapVote:
+            await sim.fill()
+        voters = [m for m in sim.members if m.id in before.playerList]
+        await sim.vote(voters[: len(voters) // 2])
+        expected = pickup_state(before)
+
+        start = time.perf_counter()
+        for _ in range(100):
+            await before.FlushPickupState()
+        saveMs = (time.perf_counter() - start) * 10
+        size = os.path.getsize(before.snapshot.VOTE_SNAPSHOT)
+
+        # what Shutdown does, minus the Discord client
+        before.pickupTimers.close()
+        await asyncio.to_thread(before.matchHistory.close)
+
+        after = load_bot(workDir)
+        start = time.perf_counter()
+        restored = after.RestorePickupState()
+        restoreMs = (time.perf_counter() - start) * 1000
+        ok = restored is not None and pickup_state(after) == expected
+        print(
+            "snapshot %.3f ms (%d bytes), restore %.3f ms, %d players and %d votes %s"
+            % (
+                saveMs,
+                size,
+                restoreMs,
+                len(expected[3]),
+                sum(len(votes) for _, _, votes in expected[5]),
+                "match" if ok else "DIFFER",
+            )
+        )
+
+        # finish the pickup on the restored bot: the rest vote through the re-attached buttons, then lock
+        sim.attach(after)
+        after.mapVoteMessage = FakeMessage(sim.recorder, sim.channel)
+        await sim.vote(voters[len(voters) // 2:])
+        await sim.run("lockmap", after.lockmap)
+        locked = not after.mapVote and after.matchHistory.match_count() == 1
+        print("vote finished after the restart: %s" % ("locked and recorded" if locked else "FAILED"))
+        return 0 if ok and locked else 1
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+# ---- startup ----
+
+# the same as load_bot, but without importing this module first so -X importtime sees only the bot's imports
+STARTUP_CHILD = """
+import importlib.util, json, os, shutil, sys, time
+here, workDir = %r, %r
+shutil.copy(os.path.join(here, "maplist.json"), workDir)
+os.chdir(workDir)
+sys.path.insert(0, here)
+spec = importlib.util.spec_from_file_location("inhousebot", os.path.join(here, "inhouse-bot.py"))
+bot = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(bot)
+lazy = {}
+for name in ("paramiko", "ftplib"):
+    start = time.perf_counter()
+    __import__(name)
+    lazy[name] = time.perf_counter() - start
+print(json.dumps({
+    "imports": bot.IMPORTED - bot.STARTED,
+    "state": bot.STATE_LOADED - bot.IMPORTED,
+    "total": bot.STATE_LOADED - bot.STARTED,
+    "lazy": lazy,
+}))
+"""
+
+
+def parse_importtime(text):
+    """{module: cumulative microseconds} for the top-level imports in -X importtime output."""
+    modules = {}
+    for line in text.splitlines():
+        if not line.startswith("import time:") or "| cumulative |" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not name.startswith("  "):  # nested imports are indented by two spaces per level
+            modules[name.strip()] = int(cumulative)
+    return modules
+
+
+def startup_benchmark(runs):
+    results = []
+    imports = {}
+    for _ in range(runs):
+        workDir = tempfile.mkdtemp(prefix="inhouse-startup-")
+        try:
+            child = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", STARTUP_CHILD % (HERE, workDir)],
+                capture_output=True,
+                text=True,
+                check=True,
+                env=dict(os.environ, **SIM_ENV),
+            )
+        finally:
+            shutil.rmtree(workDir, ignore_errors=True)
+        results.append(json.loads(child.stdout.strip().splitlines()[-1]))
+        for name, micros in parse_importtime(child.stderr).items():
+            imports.setdefault(name, []).append(micros)
+
+    def median(values):
+        return sorted(values)[len(values) // 2]
+
+    print("startup over %d runs (median): imports %.0f ms, state %.1f ms, total %.0f ms before login" % (
+        runs,
+        1000 * median([r["imports"] for r in results]),
+        1000 * median([r["state"] for r in results]),
+        1000 * median([r["total"] for r in results]),
+    ))
+    print("\nslowest top-level imports:")
+    eager = {name: micros for name, micros in imports.items() if name not in results[0]["lazy"]}
+    for name, micros in sorted(eager.items(), key=lambda item: -median(item[1]))[:10]:
+        print("  %-20s %7.1f ms" % (name, median(micros) / 1000))
+    print("\nimported lazily (not paid at startup):")
+    for name in results[0]["lazy"]:
+        print("  %-20s %7.1f ms on first use" % (name, 1000 * median([r["lazy"][name] for r in results])))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline simulation of the pickup flow.")
+    parser.add_argument("--players", type=int, default=300)
+    parser.add_argument("--pickups", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--budget-ms", type=float, default=100.0)
+    parser.add_argument("--startup", action="store_true", help="measure loading the bot instead")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--restart", action="store_true", help="check a restart in the middle of a vote")
+    args = parser.parse_args()
+    if args.startup:
+        startup_benchmark(args.runs)
+    elif args.restart:
+        sys.exit(asyncio.run(restart_check(args)))
+    else:
+        sys.exit(asyncio.run(main(args)))
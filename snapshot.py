@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+
+# Compact on-disk snapshot of the pickup in progress (players, phase and any map vote), so a pm2
+# restart (every deploy) or a crash can put the pickup back in place instead of killing it.
+
+import json
+import os
+
+VOTE_SNAPSHOT = "votestate.json"
+SNAPSHOT_VERSION = 2  # 1: map votes only
+
+# what the pickup is doing; "starting" is the !add countdown
+PHASES = ("starting", "adding", "voting")
+
+
+def encode_pickup_state(
+    phase, channelId, messageId, playerList, mapChoices, playerNumber, recentMsg, lastAdd, cancelConfirms
+):
+    # Votes are stored as indexes into the player list rather than full ids to keep it small
+    playerIds = list(playerList.keys())
+    playerIndex = {playerId: idx for idx, playerId in enumerate(playerIds)}
+
+    return {
+        "v": SNAPSHOT_VERSION,
+        "ph": PHASES.index(phase),
+        "ch": channelId,
+        "msg": messageId,
+        "n": playerNumber,
+        "p": [[playerId, playerList[playerId]] for playerId in playerIds],
+        "m": [
+            [name, decoration, [playerIndex[v] for v in votes if v in playerIndex]]
+            for (name, decoration, votes) in mapChoices
+        ],
+        "r": recentMsg,
+        "la": int(lastAdd),
+        "cc": 1 if cancelConfirms else 0,
+    }
+
+
+def decode_pickup_state(state):
+    players = [(int(playerId), name) for (playerId, name) in state["p"]]
+    playerList = dict(players)
+    mapChoices = [
+        (name, decoration, [players[idx][0] for idx in votes])
+        for (name, decoration, votes) in state["m"]
+    ]
+
+    return {
+        "phase": PHASES[state.get("ph", PHASES.index("voting"))],  # version 1 was always a vote
+        "channelId": int(state["ch"]) if state["ch"] is not None else None,
+        "messageId": int(state["msg"]) if state["msg"] is not None else None,
+        "playerNumber": int(state["n"]),
+        "playerList": playerList,
+        "mapChoices": mapChoices,
+        "recentMsg": state.get("r"),
+        "lastAdd": state.get("la", 0),
+        "cancelConfirms": bool(state.get("cc", 0)),
+    }
+
+
+def save_snapshot(state, path=VOTE_SNAPSHOT):
+    # write to a temp file and rename over the old one so a crash mid-write can't leave half a snapshot
+    tmpPath = path + ".tmp"
+    with open(tmpPath, "w") as f:
+        json.dump(state, f, separators=(",", ":"))
+    os.replace(tmpPath, path)
+
+
+def load_snapshot(path=VOTE_SNAPSHOT):
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, "r") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if not isinstance(state, dict) or state.get("v") not in (1, SNAPSHOT_VERSION):
+        return None
+    return state
+
+
+def clear_snapshot(path=VOTE_SNAPSHOT):
+    if os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,224 @@
+#!/usr/bin/python3
+
+# Post-match stats as a queued background job: the server's END message (or !stats) submits a job,
+# and one worker runs it through the stages in order, timing each one. The job's progress is written
+# to disk after every stage, so a job interrupted by a restart carries on from the stage it was in.
+# On shutdown, drain() lets the running stage finish (within a time limit) before stopping.
+
+import asyncio
+import json
+import logging
+import os
+import time
+
+JOBS_FILE = "statsjobs.json"
+
+
+class StatsJob:
+    def __init__(self, jobId, reason, data=None, stage=0, timings=None, created=None):
+        self.id = jobId
+        self.reason = reason
+        self.data = data or {}  # stage results; must stay JSON-serialisable
+        self.stage = stage  # index of the next stage to run
+        self.timings = timings or {}
+        self.created = created or time.time()
+        self.error = None
+        self.local = {}  # per-run handles (connections etc.), never persisted
+
+    def to_json(self):
+        return {
+            "id": self.id,
+            "reason": self.reason,
+            "data": self.data,
+            "stage": self.stage,
+            "timings": self.timings,
+            "created": self.created,
+        }
+
+    @classmethod
+    def from_json(cls, state):
+        return cls(
+            state["id"], state["reason"], state["data"], state["stage"], state["timings"], state["created"]
+        )
+
+
+class StatsPipeline:
+    def __init__(self, stages, cleanup=None, path=JOBS_FILE, observe=None):
+        self.stages = stages  # list of (name, async fn(job)); a stage may set job.data["done"] to finish early
+        self.cleanup = cleanup  # async fn(job) run after every attempt, e.g. to close connections
+        self.observe = observe  # fn(stage name, seconds, failed) called after every stage, for metrics
+        self.path = path
+        self.queue = asyncio.Queue()
+        self.pending = []  # queued or running, oldest first
+        self.current = None
+        self.history = []  # finished jobs, newest last
+        self._nextId = 1
+        self._worker = None
+        self._stopping = False
+
+    def start(self):
+        for job in self._load():
+            logging.info("resuming stats job %d at stage %d" % (job.id, job.stage))
+            self._enqueue(job)
+        self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def drain(self, timeout):
+        """Stop after the running stage (or at once if idle), waiting at most timeout seconds.
+        Returns True if nothing had to be cut off; unfinished jobs resume on the next start."""
+        self._stopping = True
+        if self._worker is None:
+            return True
+        if self.current is None:
+            await self.stop()
+            return True
+        jobId = self.current.id
+        try:
+            await asyncio.wait_for(asyncio.shield(self._worker), timeout)
+            self._worker = None
+            return True
+        except asyncio.TimeoutError:
+            logging.warning("stats job %d still in a stage after %gs, cutting it off" % (jobId, timeout))
+            await self.stop()
+            return False
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    def busy(self):
+        return bool(self.pending)
+
+    def submit(self, reason, **data):
+        """Queue a new job unless one is already queued or running; returns the job or None."""
+        if self.pending:
+            return None
+        job = StatsJob(self._nextId, reason, data)
+        self._enqueue(job)
+        self._save()
+        return job
+
+    def _enqueue(self, job):
+        self._nextId = max(self._nextId, job.id + 1)
+        self.pending.append(job)
+        self.queue.put_nowait(job)
+
+    async def _run(self):
+        while True:
+            job = await self.queue.get()
+            self.current = job
+            try:
+                finished = await self._process(job)
+            finally:
+                # cancelled or drained jobs stay pending, saved at their next stage
+                self.current = None
+            if not finished:
+                return
+            self.pending.remove(job)
+            self.history = (self.history + [job])[-20:]
+            self._save()
+            if self._stopping:
+                return  # however the job ended (last stage, a failure, "done"), don't wait for another
+
+    async def _process(self, job):
+        """Run job's remaining stages; returns False if it was stopped part way by drain()."""
+        try:
+            while job.stage < len(self.stages) and not job.data.get("done"):
+                if self._stopping:
+                    return False
+                name, stage = self.stages[job.stage]
+                start = time.perf_counter()
+                try:
+                    await stage(job)
+                except Exception:
+                    if self.observe is not None:
+                        self.observe(name, time.perf_counter() - start, True)
+                    raise
+                elapsed = time.perf_counter() - start
+                if self.observe is not None:
+                    self.observe(name, elapsed, False)
+                job.timings[name] = round(elapsed, 3)
+                job.stage += 1
+                self._save()
+        except asyncio.CancelledError:
+            raise  # shutting down; the saved stage is where we pick up next time
+        except Exception as e:
+            job.error = "%s: %s" % (self.stages[job.stage][0], e)
+            logging.exception("stats job %d failed in %s" % (job.id, self.stages[job.stage][0]))
+        finally:
+            if self.cleanup is not None:
+                await self.cleanup(job)
+
+        logging.info(
+            "stats job %d (%s) %s: %s"
+            % (
+                job.id,
+                job.reason,
+                "failed" if job.error else "done",
+                ", ".join("%s %.1fs" % item for item in job.timings.items()),
+            )
+        )
+        return True
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return []
+        try:
+            with open(self.path, "r") as f:
+                return [StatsJob.from_json(state) for state in json.load(f)["jobs"]]
+        except (OSError, ValueError, KeyError):
+            logging.warning("ignoring unreadable %s" % self.path)
+            return []
+
+    def _save(self):
+        tmpPath = self.path + ".tmp"
+        with open(tmpPath, "w") as f:
+            json.dump({"jobs": [job.to_json() for job in self.pending]}, f)
+        os.replace(tmpPath, self.path)
+
+
+if __name__ == "__main__":
+    # drain() from each place a shutdown can find the worker: idle, part way through a job, in its
+    # last stage, in a stage that fails, and in one that finishes the job early. None of them may
+    # wait out the timeout.
+    import tempfile
+
+    async def check(case, running=None, outcome=None):
+        """Drain while stage `running` (of three) is in progress; outcome is None, "fail" or "done"."""
+        with tempfile.TemporaryDirectory() as tmp:
+            entered = asyncio.Event()
+
+            async def stage(job):
+                if job.stage == running:
+                    entered.set()
+                    await asyncio.sleep(0.05)
+                    if outcome == "fail":
+                        raise RuntimeError("could not find the two round logs")
+                    if outcome == "done":
+                        job.data["done"] = True
+
+            pipeline = StatsPipeline([(name, stage) for name in "abc"], path=os.path.join(tmp, "jobs.json"))
+            pipeline.start()
+            if running is not None:
+                pipeline.submit(case)
+                await entered.wait()
+            start = time.perf_counter()
+            drained = await pipeline.drain(2.0)
+            elapsed = time.perf_counter() - start
+            left = [job.stage for job in pipeline._load()]
+            print("%-10s drained=%s in %.2fs, left to resume at stage %s" % (case, drained, elapsed, left))
+            assert drained and elapsed < 1.0 and pipeline._worker is None, case
+            return left
+
+    async def main():
+        assert await check("idle") == []
+        assert await check("mid-stage", 1) == [2]  # picks up at the next stage after a restart
+        assert await check("last", 2) == []
+        assert await check("failed", 1, "fail") == []
+        assert await check("done", 0, "done") == []
+
+    asyncio.run(main())
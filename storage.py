@@ -0,0 +1,409 @@
+#!/usr/bin/python3
+
+# Where the game server's logs and demos are read from: SFTP, plain FTP, or a local directory when
+# the bot runs on the game server itself.
+#
+# Every backend looks like a small subset of paramiko's SFTPClient (chdir, listdir_attr, stat, open
+# for ranged reads) plus get() to copy a file down, so round selection (roundpick), the prefetcher
+# and the stats job run the same code whichever one is in use. GameStorage tries the backends in
+# order of preference once, remembers which one works (and what the FTP server supports) and goes
+# straight to it afterwards, only retrying the preferred ones every so often.
+
+import datetime
+import io
+import logging
+import mmap
+import os
+import posixpath
+import shutil
+import threading
+import time
+
+from collections import namedtuple
+
+import transfer
+
+RECHECK_SECONDS = 30 * 60  # how long to stick with a fallback before trying the preferred backend again
+CONNECT_TIMEOUT = 15
+POOL_SIZE = 2
+POOL_IDLE_SECONDS = 120  # FTP servers commonly drop idle sessions after 300s
+
+# the parts of paramiko's SFTPAttributes we use
+Attrs = namedtuple("Attrs", ["filename", "st_size", "st_mtime"])
+
+
+class StorageUnavailable(Exception):
+    pass
+
+
+class SFTPBackend:
+    kind = "sftp"
+    # exec: the server can zip/hash for us; follow: an open file sees data appended after opening
+    features = frozenset(("ranged", "resume", "exec", "follow"))
+
+    def __init__(self, connect, dirs):
+        import paramiko
+
+        self.dirs = dirs
+        self._connect = connect
+        try:
+            self.ssh = connect()
+            self.sftp = self.ssh.open_sftp()
+        except (OSError, paramiko.SSHException) as e:
+            raise StorageUnavailable("sftp: %s" % e) from e
+        self._downloader = None
+
+    def chdir(self, path):
+        self.sftp.chdir(path)
+
+    def listdir_attr(self, path="."):
+        return self.sftp.listdir_attr(path)
+
+    def stat(self, path):
+        return self.sftp.stat(path)
+
+    def open(self, path, mode="rb"):
+        return self.sftp.open(path, mode)
+
+    def alive(self):
+        transport = self.ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    def get(self, remotePath, localPath):
+        # demos are big; a dropped connection resumes where it stopped instead of starting over
+        if self._downloader is None:
+            self._downloader = transfer.ResumableDownloader(self._connect, self.ssh)
+        return self._downloader.get(remotePath, localPath)
+
+    def close(self):
+        for handle in (self._downloader, self.sftp, self.ssh):
+            if handle is not None:
+                try:
+                    handle.close()
+                except Exception:
+                    pass
+        self._downloader = None
+
+
+class FTPFile:
+    # read()/seek() over RETR with a REST offset, so roundpick can read a log's head and tail
+    # without downloading the whole thing
+    def __init__(self, backend, path):
+        self.backend = backend
+        self.path = path
+        self.offset = 0
+
+    def seek(self, offset, whence=0):
+        self.offset = offset if whence == 0 else self.offset + offset
+        return self.offset
+
+    def tell(self):
+        return self.offset
+
+    def read(self, n=-1):
+        data = self.backend._retr(self.path, self.offset, n)
+        self.offset += len(data)
+        return data
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class FTPBackend:
+    kind = "ftp"
+
+    def __init__(self, host, user, password, dirs, features=None, port=21):
+        import ftplib
+
+        self.dirs = dirs
+        self._errors = ftplib.all_errors
+        try:
+            self.ftp = ftplib.FTP(timeout=CONNECT_TIMEOUT)
+            self.ftp.connect(host, port)
+            self.ftp.login(user, password)
+            self.ftp.voidcmd("TYPE I")  # SIZE and REST offsets are in bytes only in binary mode
+            self.features = self._detect() if features is None else features
+        except ftplib.all_errors as e:
+            raise StorageUnavailable("ftp: %s" % e) from e
+
+    def _detect(self):
+        try:
+            lines = self.ftp.sendcmd("FEAT").splitlines()[1:-1]
+        except self._errors:
+            return frozenset()
+        found = {line.strip().split(" ")[0].upper() for line in lines}
+        features = {"ranged"} if "REST" in found else set()
+        if "MLST" in found:
+            features.add("mlsd")
+        return frozenset(features)
+
+    def chdir(self, path):
+        self.ftp.cwd(path)
+
+    def listdir_attr(self, path="."):
+        if "mlsd" in self.features:
+            # the default facts; not every server takes OPTS MLST to choose them
+            return [
+                Attrs(name, int(facts["size"]), _mdtm(facts["modify"]))
+                for name, facts in self.ftp.mlsd(path)
+                if facts.get("type") == "file"
+            ]
+        # one SIZE and one MDTM per file; only old servers without MLSD end up here
+        # NLST names come back bare from some servers and with the path in front from others
+        return [
+            self.stat(posixpath.join(path, posixpath.basename(name)))
+            for name in self.ftp.nlst(path)
+            if not name.endswith("/")
+        ]
+
+    def stat(self, path):
+        mtime = _mdtm(self.ftp.voidcmd("MDTM %s" % path).split()[-1])
+        return Attrs(posixpath.basename(path), self.ftp.size(path), mtime)
+
+    def open(self, path, mode="rb"):
+        return FTPFile(self, path)
+
+    def alive(self):
+        try:
+            self.ftp.voidcmd("NOOP")
+            return True
+        except self._errors:
+            return False
+
+    def _retr(self, path, offset, n):
+        if n == 0:
+            return b""
+        rest = offset if offset and "ranged" in self.features else None
+        skip = offset if rest is None else 0
+        chunks = []
+        wanted = None if n is None or n < 0 else n + skip
+        received = 0
+        with self.ftp.transfercmd("RETR %s" % path, rest) as conn:
+            while wanted is None or received < wanted:
+                chunk = conn.recv(min(transfer.CHUNK_SIZE, wanted - received) if wanted else transfer.CHUNK_SIZE)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                received += len(chunk)
+        # Hanging up early gets a 426 from some servers and 426 then 226 from others; a NOOP and
+        # reading up to its 200 leaves the control connection in step either way.
+        self.ftp.putcmd("NOOP")
+        while not self.ftp.getmultiline().startswith("200"):
+            pass
+        return b"".join(chunks)[skip:]
+
+    def get(self, remotePath, localPath):
+        partPath = localPath + ".part"
+        received = 0
+        with open(partPath, "wb") as out:
+
+            def write(chunk):
+                nonlocal received
+                out.write(chunk)
+                received += len(chunk)
+
+            self.ftp.retrbinary("RETR %s" % remotePath, write, transfer.CHUNK_SIZE)
+        os.replace(partPath, localPath)
+        return {"bytes": received}
+
+    def close(self):
+        try:
+            self.ftp.quit()
+        except self._errors:
+            self.ftp.close()
+
+
+def _mdtm(value):
+    # MDTM/MLSD times are UTC, YYYYMMDDHHMMSS with optional fractions
+    stamp = datetime.datetime.strptime(value[:14], "%Y%m%d%H%M%S")
+    return int(stamp.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+
+class LocalBackend:
+    # For a bot on the game server itself (and for trying things out): reads are memory-mapped, so
+    # reading a log's head and tail touches only those pages, and nothing goes over a network.
+    kind = "local"
+    features = frozenset(("ranged", "mmap"))
+
+    def __init__(self, dirs):
+        missing = [path for path in dirs.values() if not os.path.isdir(path)]
+        if missing:
+            raise StorageUnavailable("local: no directory %s" % ", ".join(missing))
+        self.dirs = dirs
+        self.cwd = os.getcwd()
+
+    def _path(self, path):
+        return os.path.join(self.cwd, path)
+
+    def chdir(self, path):
+        self.cwd = self._path(path)
+
+    def listdir_attr(self, path="."):
+        entries = []
+        with os.scandir(self._path(path)) as it:
+            for entry in it:
+                if entry.is_file():
+                    st = entry.stat()
+                    entries.append(Attrs(entry.name, st.st_size, int(st.st_mtime)))
+        return entries
+
+    def stat(self, path):
+        st = os.stat(self._path(path))
+        return Attrs(os.path.basename(path), st.st_size, int(st.st_mtime))
+
+    def open(self, path, mode="rb"):
+        with open(self._path(path), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return io.BytesIO()  # can't map an empty file
+            # the map keeps its own reference to the file; it has read/seek/tell and is a context manager
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get(self, remotePath, localPath):
+        shutil.copyfile(self._path(remotePath), localPath)
+        return {"bytes": os.path.getsize(localPath)}
+
+    def alive(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class GameStorage:
+    def __init__(self, backends, recheck=RECHECK_SECONDS):
+        self.backends = backends  # [(kind, fn(features) -> backend)], most preferred first
+        self.recheck = recheck
+        self.kind = None  # the backend that worked last
+        self.features = {}  # kind -> what it supported the first time we connected
+        self._fellBack = 0
+
+    def open(self):
+        """A connected backend; raises StorageUnavailable if none can be reached. Blocking."""
+        kinds = [kind for kind, _ in self.backends]
+        start = 0
+        if self.kind is not None and time.monotonic() - self._fellBack < self.recheck:
+            start = kinds.index(self.kind)  # the ones before it failed recently; don't wait on them again
+
+        errors = []
+        # the skipped ones go last rather than not at all: if the fallback is down too, they may be back
+        order = list(range(start, len(self.backends))) + list(range(start))
+        for idx in order:
+            kind, factory = self.backends[idx]
+            try:
+                backend = factory(self.features.get(kind))
+            except StorageUnavailable as e:
+                errors.append(str(e))
+                continue
+            if kind != self.kind:
+                logging.info(
+                    "reading game files over %s%s" % (kind, " (%s)" % "; ".join(errors) if errors else "")
+                )
+            if idx > 0 and idx != start:
+                self._fellBack = time.monotonic()  # a new fallback; sticking with the old one keeps its time
+            self.kind = kind
+            self.features.setdefault(kind, backend.features)
+            return backend
+        raise StorageUnavailable("no way to reach the game files: %s" % "; ".join(errors))
+
+    def detect(self):
+        """Find (and remember) the backend to use; returns its kind, or None if none works. Blocking."""
+        try:
+            self.open().close()
+        except StorageUnavailable as e:
+            logging.warning(str(e))
+            return None
+        return self.kind
+
+
+class BackendPool:
+    # A few idle connections to one server, so back-to-back fetches (the stats job, then !hltv) skip
+    # the SSH/FTP handshake. Connections idle for too long, or found dead, are closed instead of reused.
+    def __init__(self, storage, size=POOL_SIZE, maxIdle=POOL_IDLE_SECONDS):
+        self.storage = storage  # GameStorage for this server
+        self.size = size
+        self.maxIdle = maxIdle
+        self.opened = 0
+        self.reused = 0
+        self._idle = []  # (backend, released at), newest last
+        self._lock = threading.Lock()  # used from worker threads
+
+    def acquire(self):
+        """A connected backend, reused if possible; give it back with release(). Blocking."""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                backend, released = self._idle.pop()
+            if time.monotonic() - released <= self.maxIdle and backend.alive():
+                self.reused += 1
+                return backend
+            backend.close()
+        backend = self.storage.open()
+        self.opened += 1
+        return backend
+
+    def release(self, backend, reuse=True):
+        """Return backend to the pool; reuse=False (e.g. after an error) closes it instead."""
+        if reuse:
+            with self._lock:
+                if len(self._idle) < self.size:
+                    self._idle.append((backend, time.monotonic()))
+                    return
+        backend.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for backend, _ in idle:
+            backend.close()
+
+
+if __name__ == "__main__":
+    # Round selection on a local directory of synthetic logs, through the mmap backend and through
+    # plain buffered reads, to show what the local backend costs per selection.
+    import tempfile
+
+    import roundpick
+
+    class BufferedBackend(LocalBackend):
+        def open(self, path, mode="rb"):
+            return open(self._path(path), "rb")
+
+    def write_log(path, mapName, start, minutes, players, filler):
+        lines = ['L %s: Loading map "%s"' % (start.strftime("%m/%d/%Y - %H:%M:%S"), mapName)]
+        for minute in range(minutes):
+            stamp = (start + datetime.timedelta(minutes=minute)).strftime("%m/%d/%Y - %H:%M:%S")
+            for p in range(players):
+                lines.append('L %s: "p%d<%d><STEAM_0:0:%d><Blue>" %s' % (stamp, p, p, 1000 + p, filler))
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        logDir = os.path.join(tmp, "logs")
+        os.makedirs(logDir)
+        start = datetime.datetime(2024, 1, 1, 20, 0)
+        for idx in range(30):
+            begin = start + datetime.timedelta(minutes=25 * idx)
+            path = os.path.join(logDir, "L%04d.log" % idx)
+            write_log(path, "2fort" if (idx // 2) % 2 else "well", begin, 20, 8, "say " + "x" * 1200)
+            os.utime(path, (0, (begin + datetime.timedelta(minutes=20)).timestamp()))
+        total = sum(os.path.getsize(os.path.join(logDir, name)) for name in os.listdir(logDir))
+
+        for backendClass in (LocalBackend, BufferedBackend):
+            backend = backendClass({"logs": logDir})
+            backend.chdir(logDir)
+            runs = 200
+            begin = time.perf_counter()
+            for _ in range(runs):
+                rounds = roundpick.find_round_logs(backend)
+            elapsed = (time.perf_counter() - begin) / runs
+            print(
+                "%-15s %6.2f ms per selection over %d logs (%.1f MB): %s"
+                % (backendClass.__name__, elapsed * 1000, 30, total / 1048576, [info.name for info in rounds])
+            )
@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+
+# Keyed one-shot timers on the event loop, for pickup deadlines (idle cancel, the !add countdown,
+# vote reminders).
+#
+# Every timer has a key, e.g. ("idle", channel id), and scheduling a key again replaces its timer:
+# each !add pushes the pickup's idle deadline back, in O(log n). Timers sit in a heap ordered by
+# deadline, and one task sleeps until the earliest of them, so a deadline fires when it's due rather
+# than on the next tick of a polling loop, and nothing runs while nothing is due. A replaced or
+# cancelled timer is only marked dead and skipped when it reaches the top of the heap; the heap is
+# rebuilt when dead entries outnumber live ones, so rescheduling on every add doesn't grow it.
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+
+class Scheduler:
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.fired = 0
+        self._offset = 0.0  # advance() moves time forward by this much
+        self._heap = []  # [when, seq, key, fn, args, alive]
+        self._timers = {}  # key -> its live heap entry
+        self._seq = itertools.count()
+        self._wake = None
+        self._runner = None
+
+    def time(self):
+        return self.clock() + self._offset
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, key):
+        return key in self._timers
+
+    def deadline(self, key):
+        """When key's timer fires (on this scheduler's clock), or None."""
+        entry = self._timers.get(key)
+        return entry[0] if entry is not None else None
+
+    def call_later(self, key, delay, fn, *args):
+        """Run fn(*args) (a coroutine function or a plain one) delay seconds from now, replacing any
+        timer already under key."""
+        return self.call_at(key, self.time() + delay, fn, *args)
+
+    def call_at(self, key, when, fn, *args):
+        self.cancel(key)
+        entry = [when, next(self._seq), key, fn, args, True]
+        self._timers[key] = entry
+        heapq.heappush(self._heap, entry)
+        if self._heap[0] is entry:
+            self._start()
+            self._wake.set()  # new earliest deadline: the runner has to sleep less
+        return when
+
+    def cancel(self, key):
+        """Drop key's timer; True if there was one."""
+        entry = self._timers.pop(key, None)
+        if entry is None:
+            return False
+        entry[5] = False
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._timers):
+            self._heap = [e for e in self._heap if e[5]]
+            heapq.heapify(self._heap)
+        return True
+
+    def _pop_due(self, now):
+        due = []
+        while self._heap and (not self._heap[0][5] or self._heap[0][0] <= now):
+            entry = heapq.heappop(self._heap)
+            if entry[5]:
+                del self._timers[entry[2]]
+                due.append(entry)
+        return due
+
+    def _start(self):
+        if self._runner is None or self._runner.done():
+            self._wake = asyncio.Event()
+            self._runner = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            for entry in self._pop_due(self.time()):
+                # a slow callback doesn't hold up the timers due after it
+                task = asyncio.ensure_future(self._fire(entry))
+                task.add_done_callback(self._report)
+            self._wake.clear()
+            timeout = self._heap[0][0] - self.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, entry):
+        self.fired += 1
+        result = entry[3](*entry[4])
+        if asyncio.iscoroutine(result):
+            await result
+
+    @staticmethod
+    def _report(task):
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("timer callback failed", exc_info=task.exception())
+
+    async def advance(self, seconds):
+        """Act as if seconds more had passed: run everything that comes due meanwhile, in order,
+        each awaited before the next (including timers those callbacks schedule). For simulate.py."""
+        end = self.time() + seconds
+        started = self.clock()
+        while self._heap:
+            # time spent in the callbacks counts too, or a timer a callback sets for the end would miss it
+            horizon = end + self.clock() - started
+            entry = self._heap[0]
+            if entry[5] and entry[0] > horizon:
+                break
+            heapq.heappop(self._heap)
+            if not entry[5]:
+                continue
+            del self._timers[entry[2]]
+            self._offset += max(entry[0] - self.time(), 0)
+            await self._fire(entry)
+        self._offset += max(end + self.clock() - started - self.time(), 0)
+        if self._wake is not None:
+            self._wake.set()
+
+    def close(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            self._runner = None
+        for entry in self._timers.values():
+            entry[5] = False
+        self._timers.clear()
+        self._heap.clear()
+
+
+if __name__ == "__main__":
+    # How late timers fire, and what rescheduling costs: 10,000 pickups each pushed back on every
+    # one of 100,000 adds, against what the old 30-minute loop would have done.
+    import random
+
+    async def main():
+        rng = random.Random(49)
+        scheduler = Scheduler()
+
+        late = []
+        for idx in range(200):
+            delay = rng.uniform(0.01, 0.5)
+            due = scheduler.time() + delay
+            scheduler.call_later(("precision", idx), delay, lambda due=due: late.append(scheduler.time() - due))
+        # a couple that get pushed back or dropped before they fire
+        scheduler.call_later(("precision", 0), 0.6, lambda: late.append(0.0))
+        scheduler.cancel(("precision", 1))
+        await asyncio.sleep(0.7)
+        late.sort()
+        print(
+            "%d timers fired, late by p50 %.2f ms, max %.2f ms (the old loop: up to 30 min)"
+            % (len(late), late[len(late) // 2] * 1000, late[-1] * 1000)
+        )
+        assert len(late) == 199
+
+        start = time.perf_counter()
+        for _ in range(100000):
+            scheduler.call_later(("idle", rng.randrange(10000)), 3 * 60 * 60, lambda: None)
+        elapsed = time.perf_counter() - start
+        print(
+            "100000 reschedules over %d pickups: %.2f us each, heap %d entries"
+            % (len(scheduler), elapsed / 100000 * 1e6, len(scheduler._heap))
+        )
+
+        fired = scheduler.fired
+        await scheduler.advance(3 * 60 * 60)
+        print("advancing 3 hours fired all %d idle deadlines" % (scheduler.fired - fired))
+        assert len(scheduler) == 0
+        scheduler.close()
+
+    asyncio.run(main())
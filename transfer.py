@@ -0,0 +1,387 @@
+#!/usr/bin/python3
+
+# Resumable SFTP downloads for the big HLTV demos.
+#
+# Data goes to <file>.part next to a small <file>.part.json marker holding the remote size/mtime.
+# If the connection drops, we reconnect (with backoff) and carry on from the end of the .part file
+# as long as the remote file hasn't changed. A finished download is checked against the remote
+# size and, when the server can run sha256sum, the remote hash before being renamed into place.
+#
+# Demos deflate to about half their size, so fetch_remote_zip can instead have the server zip them
+# and stream the zip back over an exec channel on the same SSH connection. That halves the bytes
+# on the wire but can't resume, so callers fall back to ResumableDownloader when it fails.
+
+import hashlib
+import json
+import logging
+import os
+import random
+import time
+import zipfile
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class TransferError(Exception):
+    pass
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _quote(arg):
+    return "'%s'" % arg.replace("'", "'\\''")
+
+
+def fetch_remote_zip(ssh_client, remoteDir, names, localPath, sizes=None, level=6):
+    """Have the server zip names (in remoteDir) and stream the zip to localPath. sizes maps name to
+    the remote size, to check the zip against. Returns stats {bytes, seconds}; raises TransferError
+    if the server couldn't zip or the zip doesn't check out. Blocking."""
+    command = "cd %s && zip -q -%d - -- %s" % (_quote(remoteDir), level, " ".join(_quote(n) for n in names))
+    start = time.perf_counter()
+    partPath = localPath + ".part"
+    received = 0
+    try:
+        stdin, stdout, stderr = ssh_client.exec_command(command)
+        stdin.close()
+        with open(partPath, "wb") as out:
+            for chunk in iter(lambda: stdout.read(CHUNK_SIZE), b""):
+                out.write(chunk)
+                received += len(chunk)
+        status = stdout.channel.recv_exit_status()
+        if status != 0:
+            raise TransferError(
+                "remote zip exited with %d: %s" % (status, stderr.read().decode(errors="replace").strip())
+            )
+
+        # the central directory is at the end, so this also catches a truncated stream
+        try:
+            with zipfile.ZipFile(partPath) as zf:
+                listed = {info.filename: info.file_size for info in zf.infolist()}
+        except zipfile.BadZipFile as e:
+            raise TransferError("remote zip is corrupt: %s" % e)
+        if sorted(listed) != sorted(names):
+            raise TransferError("remote zip holds %s, expected %s" % (sorted(listed), sorted(names)))
+        for name, size in (sizes or {}).items():
+            if listed[name] != size:
+                raise TransferError("%s is %d bytes in the zip but %d on the server" % (name, listed[name], size))
+    except Exception:
+        if os.path.exists(partPath):
+            os.remove(partPath)
+        raise
+
+    os.replace(partPath, localPath)
+    return {"bytes": received, "seconds": round(time.perf_counter() - start, 3)}
+
+
+class ResumableDownloader:
+    def __init__(self, connect, ssh_client=None, retries=5, backoff=1.0, verifyHash=True):
+        self.connect = connect  # returns a new connected paramiko.SSHClient; None to only use ssh_client
+        self.ssh_client = ssh_client
+        self.retries = retries
+        self.backoff = backoff
+        self.verifyHash = verifyHash
+        self._sftp = None
+        self._ownsClient = ssh_client is None
+
+    def close(self):
+        if self._sftp is not None:
+            self._sftp.close()
+            self._sftp = None
+        if self._ownsClient and self.ssh_client is not None:
+            self.ssh_client.close()
+            self.ssh_client = None
+
+    def _drop_connection(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+        self._sftp = None
+        self.ssh_client = None
+        self._ownsClient = True
+
+    def _sftp_client(self):
+        if self.ssh_client is None:
+            if self.connect is None:
+                raise TransferError("the connection was closed and there's no way to reconnect")
+            self.ssh_client = self.connect()
+            self._ownsClient = True
+        if self._sftp is None:
+            self._sftp = self.ssh_client.open_sftp()
+        return self._sftp
+
+    def get(self, remotePath, localPath):
+        """Download remotePath to localPath, resuming any earlier partial download. Blocking."""
+        stats = {"bytes": 0, "resumedFrom": None, "attempts": 0}
+        for attempt in range(self.retries + 1):
+            stats["attempts"] = attempt + 1
+            try:
+                self._get_once(remotePath, localPath, stats)
+                return stats
+            except TransferError:
+                raise
+            except Exception as e:
+                if attempt == self.retries or self.connect is None:
+                    raise  # without connect, a dropped connection can't be reopened
+                delay = self.backoff * (2 ** attempt) * (0.5 + random.random())
+                logging.warning(
+                    "download of %s failed at %d bytes (%s), retrying in %.1fs"
+                    % (remotePath, self._part_size(localPath), e, delay)
+                )
+                self._drop_connection()
+                time.sleep(delay)
+
+    def _part_size(self, localPath):
+        partPath = localPath + ".part"
+        return os.path.getsize(partPath) if os.path.exists(partPath) else 0
+
+    def _get_once(self, remotePath, localPath, stats):
+        sftp = self._sftp_client()
+        remote = sftp.stat(remotePath)
+        partPath = localPath + ".part"
+        markerPath = localPath + ".part.json"
+        marker = {"size": remote.st_size, "mtime": remote.st_mtime}
+
+        offset = 0
+        if os.path.exists(partPath) and os.path.exists(markerPath):
+            with open(markerPath, "r") as f:
+                try:
+                    previous = json.load(f)
+                except ValueError:
+                    previous = None
+            if previous == marker:
+                offset = os.path.getsize(partPath)
+        if offset == 0 or offset > remote.st_size:
+            offset = 0
+            with open(markerPath, "w") as f:
+                json.dump(marker, f)
+            open(partPath, "wb").close()
+        if stats["resumedFrom"] is None and offset:
+            stats["resumedFrom"] = offset
+
+        with sftp.open(remotePath, "rb") as remoteFile, open(partPath, "ab") as localFile:
+            remoteFile.seek(offset)
+            if hasattr(remoteFile, "prefetch"):
+                remoteFile.prefetch(remote.st_size)  # pipeline the reads from here to the end
+            while offset < remote.st_size:
+                chunk = remoteFile.read(min(CHUNK_SIZE, remote.st_size - offset))
+                if not chunk:
+                    raise EOFError("remote file ended at %d of %d bytes" % (offset, remote.st_size))
+                localFile.write(chunk)
+                offset += len(chunk)
+                stats["bytes"] += len(chunk)
+
+        self._verify(remotePath, partPath, remote.st_size)
+        os.replace(partPath, localPath)
+        os.remove(markerPath)
+
+    def _verify(self, remotePath, partPath, size):
+        if os.path.getsize(partPath) != size:
+            raise EOFError("size mismatch for %s" % remotePath)
+        if not self.verifyHash:
+            return
+
+        remoteHash = self._remote_sha256(remotePath)
+        if remoteHash is None:
+            return  # no shell on the server; size check only
+        if sha256_file(partPath) != remoteHash:
+            # corrupt somewhere in the middle; the only fix is starting over
+            os.remove(partPath)
+            raise EOFError("sha256 mismatch for %s" % remotePath)
+
+    def _remote_sha256(self, remotePath):
+        try:
+            _, stdout, _ = self.ssh_client.exec_command("sha256sum -- %s" % _quote(remotePath))
+            output = stdout.read().decode(errors="replace").split()
+        except Exception:
+            return None
+        if not output or len(output[0]) != 64:
+            return None
+        return output[0]
+
+
+if __name__ == "__main__":
+    # Local stand-ins for the SSH server. With no arguments, exercise resume against one that drops
+    # the connection at random offsets. With "compress [MB/s]", compare downloading raw demos and
+    # zipping locally against zipping on the "server", over a link throttled to MB/s (default 10).
+    import io
+    import shutil
+    import subprocess
+    import sys
+    import tempfile
+
+    class Attrs:
+        def __init__(self, st):
+            self.st_size = st.st_size
+            self.st_mtime = st.st_mtime
+
+    class Link:
+        # counts bytes crossing the "network" and paces them to the link speed
+        def __init__(self, bytesPerSecond=None):
+            self.bytesPerSecond = bytesPerSecond
+            self.bytes = 0
+            self.start = None
+
+        def carry(self, data):
+            if self.start is None:
+                self.start = time.perf_counter()
+            self.bytes += len(data)
+            if self.bytesPerSecond:
+                ahead = self.start + self.bytes / self.bytesPerSecond - time.perf_counter()
+                if ahead > 0:
+                    time.sleep(ahead)
+            return data
+
+    class StandInFile:
+        def __init__(self, path, rng, link):
+            self.f = open(path, "rb")
+            self.rng = rng
+            self.link = link
+
+        def seek(self, offset):
+            self.f.seek(offset)
+
+        def read(self, n):
+            if self.rng is not None:
+                if self.rng.random() < 0.2:
+                    raise OSError("connection dropped at %d" % self.f.tell())
+                n = self.rng.randint(1, n)
+            return self.link.carry(self.f.read(n))
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            self.f.close()
+
+    class StandInChannelFile:
+        def __init__(self, proc, pipe, link):
+            self.proc = proc
+            self.pipe = pipe
+            self.link = link
+            self.channel = self
+
+        def read(self, n=-1):
+            return self.link.carry(self.pipe.read(n))
+
+        def close(self):
+            pass
+
+        def recv_exit_status(self):
+            return self.proc.wait()
+
+    class LocalStandIn:
+        def __init__(self, rng=None, link=None):
+            self.rng = rng  # drop reads at random when set
+            self.link = link or Link()
+
+        def open_sftp(self):
+            return self
+
+        def stat(self, path):
+            return Attrs(os.stat(path))
+
+        def open(self, path, mode="rb"):
+            return StandInFile(path, self.rng, self.link)
+
+        def exec_command(self, command):
+            if self.rng is not None:
+                out = subprocess.run(command, shell=True, capture_output=True)
+                return None, io.BytesIO(out.stdout), None
+            proc = subprocess.Popen(
+                command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+            return (
+                proc.stdin,
+                StandInChannelFile(proc, proc.stdout, self.link),
+                StandInChannelFile(proc, proc.stderr, Link()),
+            )
+
+        def close(self):
+            pass
+
+    def write_demo(path, size, rng):
+        # HLTV demos are a mix of incompressible entity deltas and repetitive network framing; this
+        # deflates to roughly the same ~50% a real demo does
+        framing = [bytes(rng.randrange(8) for _ in range(64)) * 8 for _ in range(32)]
+        with open(path, "wb") as f:
+            written = 0
+            while written < size:
+                block = rng.randbytes(512) + rng.choice(framing)
+                f.write(block)
+                written += len(block)
+
+    def resume_demo(tmp):
+        rng = random.Random(5)
+        remotePath = os.path.join(tmp, "remote.dem")
+        with open(remotePath, "wb") as f:
+            f.write(os.urandom(8 * 1024 * 1024))
+
+        downloader = ResumableDownloader(lambda: LocalStandIn(rng), retries=200, backoff=0.001)
+        start = time.perf_counter()
+        stats = downloader.get(remotePath, os.path.join(tmp, "local.dem"))
+        ok = sha256_file(remotePath) == sha256_file(os.path.join(tmp, "local.dem"))
+        print(
+            "%d attempts, %d bytes transferred for an 8 MB file in %.2fs, hash %s"
+            % (stats["attempts"], stats["bytes"], time.perf_counter() - start, "ok" if ok else "MISMATCH")
+        )
+
+    def compress_benchmark(tmp, megabytesPerSecond):
+        rng = random.Random(7)
+        remoteDir = os.path.join(tmp, "remote")
+        os.makedirs(remoteDir)
+        print("link %.0f MB/s" % megabytesPerSecond)
+        for sizeMB in (11, 25, 40):
+            names = ["r1-%d.dem" % sizeMB, "r2-%d.dem" % sizeMB]
+            for name in names:
+                write_demo(os.path.join(remoteDir, name), sizeMB * 1024 * 1024, rng)
+            sizes = {name: os.path.getsize(os.path.join(remoteDir, name)) for name in names}
+            localZip = os.path.join(tmp, "local.zip")
+
+            # current path: pull the raw demos, zip them here
+            link = Link(megabytesPerSecond * 1024 * 1024)
+            downloader = ResumableDownloader(None, LocalStandIn(link=link), verifyHash=False)
+            start = time.perf_counter()
+            with zipfile.ZipFile(localZip, "w", zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
+                for name in names:
+                    localPath = os.path.join(tmp, name)
+                    downloader.get(os.path.join(remoteDir, name), localPath)
+                    zf.write(localPath, name)
+                    os.remove(localPath)
+            rawSeconds = time.perf_counter() - start
+            rawBytes = link.bytes
+
+            # zip on the server, stream the zip back
+            link = Link(megabytesPerSecond * 1024 * 1024)
+            stats = fetch_remote_zip(LocalStandIn(link=link), remoteDir, names, localZip, sizes)
+            os.remove(localZip)
+            for name in names:
+                os.remove(os.path.join(remoteDir, name))
+
+            print(
+                "2 x %2d MB demos: raw %5.1f MB in %5.2fs, server zip %5.1f MB in %5.2fs (%.0f%% of the bytes, %.1fx faster)"
+                % (
+                    sizeMB,
+                    rawBytes / 1048576,
+                    rawSeconds,
+                    stats["bytes"] / 1048576,
+                    stats["seconds"],
+                    100.0 * stats["bytes"] / rawBytes,
+                    rawSeconds / stats["seconds"],
+                )
+            )
+
+    tmp = tempfile.mkdtemp()
+    try:
+        if sys.argv[1:2] == ["compress"]:
+            compress_benchmark(tmp, float(sys.argv[2]) if len(sys.argv) > 2 else 10.0)
+        else:
+            resume_demo(tmp)
+    finally:
+        shutil.rmtree(tmp)
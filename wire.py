@@ -0,0 +1,385 @@
+#!/usr/bin/python3
+
+# Binary framing for the UDP messages between the game server plugin, serverComms.py and the bot.
+#
+# The old format is one "BOT_MSG@TYPE@payload" string per datagram: no version, no way to tell a
+# lost message from one never sent. A frame here is
+#
+#   magic (0xB7) | version | flags | seq (uint16) | message | message | ...
+#   message = type (uint8) | length (uint16) | payload
+#
+# all big-endian. Messages sent in the same event loop pass go out together in as few frames as
+# fit the MTU (TEAMS used to be two datagrams). Frames holding data are "reliable": the receiver
+# acks their seq (ACK messages, piggybacked on its next frame or sent alone right away), the sender
+# retransmits with backoff until acked, and the receiver drops the duplicates that retransmits and
+# the network can produce. Anything that doesn't start with the magic byte is the old text format,
+# so old and new peers can share a port.
+
+import asyncio
+import collections
+import logging
+import random
+import struct
+import time
+
+MAGIC = 0xB7
+VERSION = 1
+FLAG_RELIABLE = 0x01
+
+HEADER = struct.Struct("!BBBH")
+MESSAGE = struct.Struct("!BH")
+MTU = 1200  # payload bytes per datagram; well under any path MTU, so no IP fragmentation
+RTO = 0.2  # first retransmit after this long, doubling each time
+RETRIES = 5
+WINDOW = 1024  # how many recent seqs a receiver remembers to drop duplicates...
+SEEN_SECONDS = 30  # ...and for how long: past the last retransmit, and a restarted peer's random
+# first seq can't be mistaken for one we saw before the restart
+
+# message types; keep the numbers stable, the plugin has them too
+ACK = 0
+TYPES = {"IRC": 1, "MAP": 2, "RS": 3, "TEAMS": 4, "END": 5, "TIMELEFT": 6}
+NAMES = {code: name for name, code in TYPES.items()}
+
+LEGACY_PREFIX = "BOT_MSG"
+
+
+class FrameError(Exception):
+    pass
+
+
+def is_frame(data):
+    return len(data) > 0 and data[0] == MAGIC
+
+
+def encode(seq, messages, reliable=True):
+    """One datagram holding messages, a list of (type code, payload bytes)."""
+    parts = [HEADER.pack(MAGIC, VERSION, FLAG_RELIABLE if reliable else 0, seq)]
+    for code, payload in messages:
+        if len(payload) > 0xFFFF:
+            raise ValueError("message too long (%d bytes)" % len(payload))
+        parts.append(MESSAGE.pack(code, len(payload)))
+        parts.append(payload)
+    return b"".join(parts)
+
+
+def decode(data):
+    """(seq, reliable, [(type code, payload bytes)]); raises FrameError for anything malformed."""
+    if len(data) < HEADER.size:
+        raise FrameError("frame shorter than its header")
+    magic, version, flags, seq = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise FrameError("not a frame")
+    if version != VERSION:
+        raise FrameError("unsupported frame version %d" % version)
+
+    messages = []
+    offset = HEADER.size
+    while offset < len(data):
+        if offset + MESSAGE.size > len(data):
+            raise FrameError("truncated message header at byte %d" % offset)
+        code, length = MESSAGE.unpack_from(data, offset)
+        offset += MESSAGE.size
+        if offset + length > len(data):
+            raise FrameError("message of %d bytes runs past the end of the frame" % length)
+        messages.append((code, data[offset:offset + length]))
+        offset += length
+    return seq, bool(flags & FLAG_RELIABLE), messages
+
+
+def legacy_encode(msgType, message):
+    return ("%s@%s@%s" % (LEGACY_PREFIX, msgType, message)).encode()
+
+
+def legacy_decode(data):
+    """(type, [payload parts]) of an old-style BOT_MSG@TYPE@... datagram, or None."""
+    parts = data.decode(errors="replace").split("@")
+    if parts[0] != LEGACY_PREFIX or len(parts) < 2:
+        return None
+    return parts[1], parts[2:]
+
+
+class Link:
+    # One peer's side of the reliable, batched channel. sendto(data, addr) puts a datagram on the
+    # wire; feed received frames to receive(). Must be used from the event loop.
+    def __init__(self, sendto, addr, rto=RTO, retries=RETRIES, mtu=MTU):
+        self.sendto = sendto
+        self.addr = addr
+        self.rto = rto
+        self.retries = retries
+        self.mtu = mtu
+        self.stats = collections.Counter()
+
+        self._nextSeq = random.randrange(0x10000)
+        self._unacked = {}  # seq -> [datagram, messages, attempts, timer, futures]
+        self._queue = []  # (code, payload, future) waiting for the next flush
+        self._acks = []  # seqs we still have to ack
+        self._flushing = False
+        self._seen = collections.deque()  # (monotonic time, seq), oldest first
+        self._seenSet = set()
+
+    @property
+    def pending(self):
+        """Messages queued or sent but not acked yet."""
+        return len(self._queue) + sum(len(entry[1]) for entry in self._unacked.values())
+
+    def send(self, msgType, payload):
+        """Queue a message; returns a future that comes true when the peer acks it, false when it
+        never does (retries used up, or the link closed)."""
+        code = TYPES[msgType] if isinstance(msgType, str) else msgType
+        acked = asyncio.get_running_loop().create_future()
+        self._queue.append((code, payload.encode() if isinstance(payload, str) else payload, acked))
+        self.stats["sent"] += 1
+        self._schedule_flush()
+        return acked
+
+    def _schedule_flush(self):
+        if not self._flushing:
+            self._flushing = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        """Put everything queued (and any acks owed) on the wire now."""
+        self._flushing = False
+        acks, self._acks = self._acks, []
+        ackMessages = []
+        for idx in range(0, len(acks), 0xFFFF // 2):
+            chunk = acks[idx:idx + 0xFFFF // 2]
+            ackMessages.append((ACK, struct.pack("!%dH" % len(chunk), *chunk), None))
+
+        queue, self._queue = self._queue, []
+        batch, size = [], HEADER.size
+        for message in ackMessages + queue:
+            cost = MESSAGE.size + len(message[1])
+            if batch and size + cost > self.mtu:
+                self._send_frame(batch)
+                batch, size = [], HEADER.size
+            batch.append(message)
+            size += cost
+        if batch:
+            self._send_frame(batch)
+
+    def _send_frame(self, batch):
+        messages = [(code, payload) for code, payload, _ in batch]
+        data = [message for message in messages if message[0] != ACK]
+        if not data:
+            # acks alone are never acked themselves
+            self.stats["datagrams"] += 1
+            self.sendto(encode(0, messages, reliable=False), self.addr)
+            return
+        seq = self._nextSeq
+        self._nextSeq = (seq + 1) & 0xFFFF
+        futures = [acked for _, _, acked in batch if acked is not None]
+        self._unacked[seq] = [encode(seq, messages), data, 0, None, futures]
+        self._transmit(seq)
+
+    @staticmethod
+    def _settle(entry, acked):
+        if entry[3] is not None:
+            entry[3].cancel()
+        for future in entry[4]:
+            if not future.done():
+                future.set_result(acked)
+
+    def _transmit(self, seq):
+        entry = self._unacked[seq]
+        self.stats["datagrams"] += 1
+        self.sendto(entry[0], self.addr)
+        entry[3] = asyncio.get_running_loop().call_later(self.rto * 2 ** entry[2], self._retransmit, seq)
+
+    def _retransmit(self, seq):
+        entry = self._unacked.get(seq)
+        if entry is None:
+            return
+        entry[2] += 1
+        if entry[2] > self.retries:
+            del self._unacked[seq]
+            self.stats["lost"] += len(entry[1])
+            logging.warning(
+                "%d message(s) to %s:%s never acked: %s"
+                % (len(entry[1]), self.addr[0], self.addr[1], ", ".join(NAMES.get(c, str(c)) for c, _ in entry[1]))
+            )
+            self._settle(entry, False)
+            return
+        self.stats["retransmits"] += 1
+        self._transmit(seq)
+
+    def receive(self, data):
+        """Handle one frame from the peer; returns its new data messages as (type name, payload str),
+        an empty list for acks and duplicates. Raises FrameError."""
+        seq, reliable, messages = decode(data)
+        fresh = []
+        for code, payload in messages:
+            if code == ACK:
+                if len(payload) % 2:
+                    raise FrameError("odd-length ack")
+                for ackedSeq in struct.unpack("!%dH" % (len(payload) // 2), payload):
+                    entry = self._unacked.pop(ackedSeq, None)
+                    if entry is not None:
+                        self._settle(entry, True)
+            else:
+                fresh.append((NAMES.get(code, str(code)), payload.decode("utf-8", "replace")))
+
+        if not reliable:
+            return []
+        # ack even a duplicate: our earlier ack may be the thing that got lost
+        self._acks.append(seq)
+        self._schedule_flush()
+        if seq in self._seenSet:
+            self.stats["duplicates"] += 1
+            return []
+        now = time.monotonic()
+        while self._seen and (len(self._seen) >= WINDOW or now - self._seen[0][0] > SEEN_SECONDS):
+            self._seenSet.discard(self._seen.popleft()[1])
+        self._seen.append((now, seq))
+        self._seenSet.add(seq)
+        self.stats["received"] += len(fresh)
+        return fresh
+
+    def close(self):
+        for entry in self._unacked.values():
+            self._settle(entry, False)
+        self._unacked.clear()
+        for _, _, acked in self._queue:
+            acked.set_result(False)
+        self._queue.clear()
+
+
+if __name__ == "__main__":
+    # Fuzzing of the codec and of the link over a lossy, duplicating, reordering fake network, then
+    # throughput on loopback: old text datagrams vs batched frames.
+    import sys
+
+    def fuzz_codec(rng, rounds=20000):
+        for _ in range(rounds):
+            messages = [
+                (rng.choice(list(NAMES)), bytes(rng.randrange(256) for _ in range(rng.randrange(40))))
+                for _ in range(rng.randrange(6))
+            ]
+            seq = rng.randrange(0x10000)
+            data = encode(seq, messages, reliable=bool(messages))
+            assert decode(data) == (seq, bool(messages), messages)
+
+            # flip, cut or extend bytes: must decode or raise FrameError, nothing else
+            mutated = bytearray(data)
+            for _ in range(rng.randrange(1, 4)):
+                op = rng.randrange(3)
+                if op == 0 and mutated:
+                    mutated[rng.randrange(len(mutated))] = rng.randrange(256)
+                elif op == 1:
+                    del mutated[rng.randrange(len(mutated) + 1):]
+                else:
+                    mutated += bytes(rng.randrange(256) for _ in range(rng.randrange(5)))
+            try:
+                decode(bytes(mutated))
+            except FrameError:
+                pass
+            try:
+                legacy_decode(bytes(mutated))
+            except Exception as e:  # noqa: the point is that it never gets here
+                raise AssertionError("legacy_decode raised %r" % e)
+        print("codec: %d random frames round-tripped, mutations only ever raised FrameError" % rounds)
+
+    async def fuzz_link(rng, messages=2000, loss=0.2, dup=0.1):
+        loop = asyncio.get_running_loop()
+        delivered = []
+        links = {}
+
+        def network(data, addr):
+            # addr is who it's for; drop, duplicate and delay (reorder) at random
+            if rng.random() < loss:
+                return
+            for _ in range(2 if rng.random() < dup else 1):
+                loop.call_later(rng.random() * 0.01, deliver, addr, data)
+
+        def deliver(addr, data):
+            delivered.extend((addr, m) for m in links[addr].receive(data))
+
+        links["a"] = Link(network, "b", rto=0.02, retries=12)
+        links["b"] = Link(network, "a", rto=0.02, retries=12)
+        acks = []
+        for idx in range(messages):
+            acks.append(links["a"].send("TEAMS", "msg %d" % idx))
+            if idx % 50 == 0:
+                await asyncio.sleep(0)
+        assert all(await asyncio.gather(*acks)), "given up on"
+        got = [payload for (addr, (_, payload)) in delivered if addr == "b"]
+        assert sorted(got) == sorted("msg %d" % idx for idx in range(messages)), "lost or duplicated"
+        stats = links["a"].stats
+        print(
+            "link: %d messages over %d%% loss / %d%% duplication: all delivered once, in %d datagrams "
+            "(%d retransmits), %d duplicates dropped"
+            % (messages, loss * 100, dup * 100, stats["datagrams"], stats["retransmits"], links["b"].stats["duplicates"])
+        )
+
+    class Sink(asyncio.DatagramProtocol):
+        def __init__(self, framed):
+            self.framed = framed
+            self.count = 0
+            self.datagrams = 0
+            self.last = None
+
+        def connection_made(self, transport):
+            self.transport = transport
+            self.link = Link(transport.sendto, None)
+
+        def datagram_received(self, data, addr):
+            self.datagrams += 1
+            if self.framed:
+                self.link.addr = addr
+                self.count += len(self.link.receive(data))
+            elif legacy_decode(data) is not None:
+                self.count += 1
+            self.last = time.perf_counter()
+
+    class Source(asyncio.DatagramProtocol):
+        def connection_made(self, transport):
+            self.transport = transport
+            self.link = Link(transport.sendto, transport.get_extra_info("peername"))
+
+        def datagram_received(self, data, addr):
+            self.link.receive(data)
+
+    async def throughput(framed, messages=50000):
+        loop = asyncio.get_running_loop()
+        sinkTransport, sink = await loop.create_datagram_endpoint(lambda: Sink(framed), local_addr=("127.0.0.1", 0))
+        transport, source = await loop.create_datagram_endpoint(
+            Source, remote_addr=sinkTransport.get_extra_info("sockname")
+        )
+        source.link.addr = None  # connected socket
+        start = time.perf_counter()
+        for idx in range(messages):
+            if framed:
+                source.link.send("TEAMS", "player%d, player%d, player%d, player%d" % (idx, idx, idx, idx))
+            else:
+                transport.sendto(legacy_encode("TEAMS", "player%d, player%d, player%d, player%d" % (idx, idx, idx, idx)))
+            # asyncio reads one datagram per loop pass, so yield once per datagram either way: after
+            # every text message, after a frame's worth (~1200 bytes) of framed ones
+            if not framed or idx % 20 == 19:
+                await asyncio.sleep(0)
+        # done once everything arrived, or nothing more has for a while (text has no retransmits)
+        while sink.count < messages and time.perf_counter() - (sink.last or start) < 0.5:
+            await asyncio.sleep(0.01)
+        elapsed = sink.last - start
+        print(
+            "%-6s %7.0f messages/s, %d of %d delivered in %d datagrams (%d retransmits)"
+            % (
+                "framed" if framed else "text",
+                sink.count / elapsed,
+                sink.count,
+                messages,
+                sink.datagrams,
+                source.link.stats["retransmits"],
+            )
+        )
+        source.link.close()
+        transport.close()
+        sinkTransport.close()
+
+    async def main():
+        rng = random.Random(int(sys.argv[1]) if len(sys.argv) > 1 else 47)
+        fuzz_codec(rng)
+        await fuzz_link(rng)
+        await throughput(False)
+        await throughput(True)
+
+    asyncio.run(main())